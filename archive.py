@@ -0,0 +1,379 @@
+'''Compact binary session snapshots for the campaign archive.
+
+An archive holds the same data as `Session.state()`, laid out so it can be
+read through mmap without loading the whole file:
+
+    header | encounter directory | player records | monster records, one
+    block per encounter | JSON extras | string table
+
+Players and monsters are fixed-width records, so combatant n of an encounter
+is at a known offset, and a whole block can be unpacked column by column in
+one call. Every string (names, effect lists, the session date) is stored
+once in the string table and referred to by number; a hundred goblins that
+are all "dazed (save ends)" share one entry. What doesn't fit a record (dice
+streams, the turn pointer, running effects) goes in a small JSON blob per
+encounter, only parsed when the whole encounter is loaded.
+'''
+import json
+import mmap
+import struct
+from array import array
+from collections import namedtuple
+
+from dm_common import CONDITION_BITS
+from combatants import DEFENSES
+
+MAGIC = '4eSS'
+VERSION = 1
+
+# magic, version, reserved, session name, date, string table offset, string
+# count, players offset, player count, directory offset, encounter count,
+# session extras offset and length
+HEADER = struct.Struct('<4sHH10I')
+# name, round, p_mod, m_mod, monster count, records offset, extras offset
+# and length
+ENCOUNTER = struct.Struct('<2I2h4I')
+# name, effects, condition bits, init_mod, max_hp, hp, ac, fortitude,
+# reflex, will, flags, presence, initiative sort key
+RECORD = '3I3h6B2hd'
+COMBATANT = struct.Struct('<' + RECORD)
+_FIELDS = len(COMBATANT.unpack('\0' * COMBATANT.size))
+
+# presence bits
+LISTED = 1  # in Encounter.monsters
+INDEXED = 2  # in Encounter.monster_index
+IN_ORDER = 4  # in the initiative order
+
+EncounterInfo = namedtuple('EncounterInfo', 'name round monsters')
+Combatant = namedtuple(
+    'Combatant', 'name effects conditions init_mod max_hp hp defenses flags')
+
+_dumps = json.JSONEncoder(separators=(',', ':')).encode
+
+
+class _Strings(object):
+    '''Interns strings for the string table'''
+
+    def __init__(self):
+        self.ids = {}
+        self.strings = []
+        self.intern('')
+
+    def intern(self, text):
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        try:
+            return self.ids[text]
+        except KeyError:
+            number = self.ids[text] = len(self.strings)
+            self.strings.append(text)
+            return number
+
+    def pack(self):
+        offsets, position = [], 0
+        for text in self.strings:
+            offsets.append(position)
+            position += len(text)
+        offsets.append(position)
+        return struct.pack('<{}I'.format(len(offsets)), *offsets) + \
+            ''.join(self.strings)
+
+
+def _conditions(effects):
+    bits = 0
+    for effect, _ in effects:
+        bits |= CONDITION_BITS.get(effect.lower(), 0)
+    return bits
+
+
+def _record(strings, name, init_mod, max_hp, hp, effects, defenses=(0,) * 4,
+            flags=0, presence=0, key=(0, 0, 0)):
+    effects = effects or ()
+    return COMBATANT.pack(
+        strings.intern(name),
+        strings.intern(_dumps(effects) if effects else ''),
+        _conditions(effects), init_mod, max_hp, hp,
+        *(tuple(defenses) + (flags, presence) + tuple(key)))
+
+
+def _encounter_block(strings, number, enc):
+    '''Monster records and JSON extras for one encounter's state'''
+    table = enc['table']
+    effects = dict(table['effects'])
+    defenses = zip(*[table['defenses'][name] for name in DEFENSES])
+    presence = [0] * len(table['names'])
+    for row in enc['monsters']:
+        presence[row] |= LISTED
+    for row in enc['index']:
+        presence[row] |= INDEXED
+    keys, player_keys = {}, []
+    for key, ref in enc['initiative']['keys']:
+        if ref[0] == 'm' and ref[1] == number:
+            presence[ref[2]] |= IN_ORDER
+            keys[ref[2]] = key
+        else:
+            player_keys.append([key, ref])
+    block = ''.join(
+        _record(strings, table['names'][row], table['init_mod'][row],
+                table['max_hp'][row], table['hp'][row], effects.get(row),
+                defenses[row], table['flags'][row], presence[row],
+                keys.get(row, (0, 0, 0)))
+        for row in xrange(len(presence)))
+    initiative = dict(enc['initiative'], keys=player_keys)
+    extras = _dumps({'rng': enc['rng'], 'initiative': initiative,
+                     'effects': enc['effects']})
+    return block, extras
+
+
+def dumps(state):
+    '''Packs a `Session.state()` dict into archive bytes'''
+    strings = _Strings()
+    players = ''.join(
+        _record(strings, name, init_mod, max_hp, hp, effects)
+        for name, init_mod, max_hp, hp, _, effects in state['players'])
+    extras = [_dumps({
+        'rng': state['rng'],
+        'playernames': [player[4] for player in state['players']],
+    })]
+    blocks, directory = [], []
+    for number, enc in enumerate(state['encounters']):
+        block, extra = _encounter_block(strings, number, enc)
+        blocks.append(block)
+        extras.append(extra)
+        directory.append((strings.intern(enc['name']), enc['round'],
+                          enc['p_mod'], enc['m_mod'],
+                          len(enc['table']['names'])))
+    name, date = strings.intern(state['name']), strings.intern(state['date'])
+
+    position = HEADER.size
+    directory_offset = position
+    position += ENCOUNTER.size * len(directory)
+    players_offset = position
+    position += len(players)
+    block_offsets = []
+    for block in blocks:
+        block_offsets.append(position)
+        position += len(block)
+    extra_offsets = []
+    for extra in extras:
+        extra_offsets.append(position)
+        position += len(extra)
+
+    parts = [HEADER.pack(
+        MAGIC, VERSION, 0, name, date, position, len(strings.strings),
+        players_offset, len(state['players']), directory_offset,
+        len(directory), extra_offsets[0], len(extras[0]))]
+    for entry, block_offset, extra_offset, extra in zip(
+            directory, block_offsets, extra_offsets[1:], extras[1:]):
+        parts.append(ENCOUNTER.pack(*entry + (block_offset, extra_offset,
+                                              len(extra))))
+    parts.append(players)
+    parts.extend(blocks)
+    parts.extend(extras)
+    parts.append(strings.pack())
+    return ''.join(parts)
+
+
+def write(session, path):
+    '''Archives a session to `path`'''
+    with open(path, 'wb') as f:
+        f.write(dumps(session.state()))
+
+
+def _tiebreak(value):
+    return int(value) if value.is_integer() else value
+
+
+class Archive(object):
+    '''Reads an archive in place, decoding only what is asked for'''
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header = HEADER.unpack_from(self.data)
+        if header[0] != MAGIC:
+            raise ValueError('{} is not a session archive'.format(path))
+        if header[1] != VERSION:
+            raise ValueError('Unknown archive version {}'.format(header[1]))
+        (_, _, _, self._name, self._date, self._strings, string_count,
+         self._players, self.player_count, self._directory,
+         self.encounter_count, self._extras, self._extras_length) = header
+        self._string_count = string_count
+        self._string_data = self._strings + 4 * (string_count + 1)
+        self._all_strings = None
+        self._effects = {}
+
+    def close(self):
+        self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def string(self, number):
+        start, end = struct.unpack_from(
+            '<2I', self.data, self._strings + 4 * number)
+        base = self._string_data
+        return self.data[base + start:base + end].decode('utf-8')
+
+    def strings(self):
+        '''The whole string table, decoded once'''
+        if self._all_strings is None:
+            offsets = array('I')
+            if offsets.itemsize == 4:
+                offsets.fromstring(
+                    self.data[self._strings:self._string_data])
+            else:
+                offsets = struct.unpack_from(
+                    '<{}I'.format(self._string_count + 1), self.data,
+                    self._strings)
+            text = self.data[self._string_data:self._string_data +
+                             offsets[-1]]
+            try:
+                # byte offsets are character offsets in plain ASCII
+                text, decode = text.decode('ascii'), None
+            except UnicodeDecodeError:
+                decode = 'utf-8'
+            self._all_strings = [
+                text[start:end].decode(decode) if decode else
+                text[start:end] for start, end in zip(offsets, offsets[1:])]
+        return self._all_strings
+
+    def effects(self, number):
+        '''The `EffectSet.state()` stored as string `number`'''
+        try:
+            return self._effects[number]
+        except KeyError:
+            text = self.string(number)
+            effects = self._effects[number] = json.loads(text) if text \
+                else []
+            return effects
+
+    def _load_effects(self, numbers):
+        '''Parses many effect strings with a single json.loads'''
+        numbers = [n for n in set(numbers) if n not in self._effects]
+        strings = self.strings()
+        parsed = json.loads(
+            '[' + ','.join(strings[n] or '[]' for n in numbers) + ']')
+        self._effects.update(zip(numbers, parsed))
+
+    @property
+    def name(self):
+        return self.string(self._name)
+
+    @property
+    def date(self):
+        return self.string(self._date)
+
+    def _encounter(self, number):
+        if not 0 <= number < self.encounter_count:
+            raise IndexError('No encounter {}'.format(number))
+        return ENCOUNTER.unpack_from(
+            self.data, self._directory + ENCOUNTER.size * number)
+
+    def encounters(self):
+        '''Name, round and monster count of each encounter'''
+        return [EncounterInfo(self.string(name), round, count)
+                for name, round, _, _, count, _, _, _
+                in map(self._encounter, xrange(self.encounter_count))]
+
+    def _combatant(self, offset):
+        fields = COMBATANT.unpack_from(self.data, offset)
+        return Combatant(
+            self.string(fields[0]),
+            tuple(name for name, _ in self.effects(fields[1])),
+            fields[2], fields[3], fields[4], fields[5],
+            dict(zip(DEFENSES, fields[6:10])), fields[10])
+
+    def combatant(self, encounter, row):
+        '''One monster of an encounter'''
+        entry = self._encounter(encounter)
+        if not 0 <= row < entry[4]:
+            raise IndexError('No monster {} in encounter {}'.format(
+                row, encounter))
+        return self._combatant(entry[5] + COMBATANT.size * row)
+
+    def monsters(self, encounter):
+        entry = self._encounter(encounter)
+        return [self._combatant(entry[5] + COMBATANT.size * row)
+                for row in xrange(entry[4])]
+
+    def players(self):
+        return [self._combatant(self._players + COMBATANT.size * n)
+                for n in xrange(self.player_count)]
+
+    def with_condition(self, encounter, condition):
+        '''Rows of an encounter's monsters with one of the standard
+        conditions, read straight from the records'''
+        bit, entry = CONDITION_BITS[condition], self._encounter(encounter)
+        conditions = self._columns(entry[5], entry[4])[2]
+        return [row for row, bits in enumerate(conditions) if bits & bit]
+
+    def _json(self, offset, length):
+        return json.loads(self.data[offset:offset + length])
+
+    def _columns(self, offset, count):
+        '''Every field of `count` records at once, as one list per field'''
+        fields = struct.unpack_from('<' + RECORD * count, self.data, offset)
+        return [list(fields[i::_FIELDS]) for i in xrange(_FIELDS)]
+
+    def encounter_state(self, number):
+        '''One encounter as `Encounter.state()` would give it'''
+        name, round, p_mod, m_mod, count, records, offset, length = \
+            self._encounter(number)
+        state = self._json(offset, length)
+        columns = self._columns(records, count)
+        strings = self.strings()
+        names = map(strings.__getitem__, columns[0])
+        effects, presence = columns[1], columns[11]
+        rows = xrange(count)
+        self._load_effects(effects)
+        keys = state['initiative']['keys']
+        keys.extend([[columns[12][row], columns[13][row],
+                      _tiebreak(columns[14][row])], ['m', number, row]]
+                    for row in rows if presence[row] & IN_ORDER)
+        keys.sort()
+        state.update(name=strings[name], round=round, p_mod=p_mod,
+                     m_mod=m_mod)
+        state['monsters'] = [row for row in rows if presence[row] & LISTED]
+        state['index'] = sorted(
+            (row for row in rows if presence[row] & INDEXED),
+            key=names.__getitem__)
+        state['table'] = {
+            'names': names,
+            'init_mod': columns[3],
+            'max_hp': columns[4],
+            'hp': columns[5],
+            'flags': columns[10],
+            'defenses': dict(zip(DEFENSES, columns[6:10])),
+            'effects': [[row, self.effects(effects[row])]
+                        for row in rows if effects[row]],
+        }
+        return state
+
+    def state(self):
+        '''The whole session as `Session.state()` would give it'''
+        extras = self._json(self._extras, self._extras_length)
+        columns = self._columns(self._players, self.player_count)
+        strings = self.strings()
+        return {
+            'name': self.name,
+            'date': self.date,
+            'rng': extras['rng'],
+            'players': [
+                [strings[name], init_mod, max_hp, hp, playername,
+                 self.effects(effects)]
+                for name, effects, init_mod, max_hp, hp, playername in zip(
+                    columns[0], columns[1], columns[3], columns[4],
+                    columns[5], extras['playernames'])],
+            'encounters': map(self.encounter_state,
+                              xrange(self.encounter_count)),
+        }
+
+
+def read(path):
+    '''The `Session.state()` stored in an archive'''
+    with Archive(path) as archive:
+        return archive.state()
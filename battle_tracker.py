@@ -1,14 +1,31 @@
 from __future__ import print_function
 from time import strftime
-from random import choice, sample
 import cmd
 import shlex
 import functools
 import json
 import string
+from array import array
+from collections import namedtuple
+from fnmatch import fnmatchcase
 
 from dm_common import (d20, PlayerCharacter, Monster, Commandline, ordinal,
-                       letterer, Completer)
+                       letterer, Completer, NameIndex, EffectIndex,
+                       argument_start, complete_argument)
+from dice import RNG, default_rng, roll_many, compile_dice
+from distribution import distribution
+from simulator import simulate
+from initiative import InitiativeOrder
+from combatants import (CombatantTable, MonsterRow, StatusBoard, DEFENSES,
+                        DEFENSE_NAMES, REMOVED)
+from effects import (EffectQueue, TimedEffect, START, END, SAVE_ENDS,
+                     DURATIONS, due_time, parse_duration)
+from journal import Journal, JOURNAL_PATH, journal_exists, recover
+from history import History, frozen
+from codec import codec_for
+import archive
+from create_db import setup_db
+from persistence import BackgroundWriter
 
 
 def fprint(template, *args, **kwargs):
@@ -16,9 +33,19 @@ def fprint(template, *args, **kwargs):
     print(template.format(*args, **kwargs))
 
 
-def rand_string(l=5):
+def rand_string(l=5, rng=None):
     '''Return a random string of length l'''
-    return ''.join(sample(string.ascii_letters, l))
+    return ''.join((rng or default_rng).sample(string.ascii_letters, l))
+
+
+def parse_defenses(text):
+    '''Turns "AC FORT REF WILL" into a defenses dict (None if blank)'''
+    values = text.split()
+    if not values:
+        return None
+    if len(values) != len(DEFENSES):
+        raise ValueError('Need {} numbers'.format(len(DEFENSES)))
+    return dict(zip(DEFENSES, map(int, values)))
 
 
 def keep_asking(prompt, validator=None):
@@ -35,23 +62,96 @@ def keep_asking(prompt, validator=None):
 
 class Session(object):
     "A series of encounters "
-    def __init__(self, name=None):
-        self.date = strftime("%A %B %d, %Y %I:%M %p")
+    def __init__(self, name=None, seed=None, date=None):
+        self.date = date or strftime("%A %B %d, %Y %I:%M %p")
+        self.rng = RNG(seed)
         if name is None:
-            name = 'Unnamed Session [{}]'.format(rand_string())
+            name = 'Unnamed Session [{}]'.format(rand_string(rng=self.rng))
         self.name = name
         self.encounters = []
         self.players = []
-        return
-        self.new_players()
-        self.next_encounter()
+        self.listeners = []  # e.g. the journal, told of every change
+
+    def emit(self, kind, *args):
+        "Passes a change to the session on to the listeners"
+        for listener in self.listeners:
+            listener.append(kind, args)
+
+    def rename(self, name):
+        self.name = name
+        self.emit('name', name)
+
+    def add_player(self, player):
+        "Adds a player character to the session"
+        self.players.append(player)
+        self.emit('player', player.name, player.init_mod, player.max_hp,
+                  player.playername)
+        return player
 
-    def add_encounter(self):
+    def add_encounter(self, name=None):
         "Adds a new encounter to the encounter list"
-        encounter = Encounter(session=self)
+        encounter = Encounter(name, session=self)
         self.encounters.append(encounter)
         return encounter
 
+    def ref(self, combatant):
+        "A plain-data reference to a player or encounter monster"
+        if isinstance(combatant, MonsterRow) and combatant.encounter:
+            return ['m', combatant.encounter.number, combatant.row]
+        if combatant in self.players:
+            return ['p', self.players.index(combatant)]
+        return None
+
+    def resolve(self, ref):
+        "The combatant a `ref` refers to"
+        if ref is None:
+            return None
+        if ref[0] == 'p':
+            return self.players[ref[1]]
+        return self.encounters[ref[1]].table.rows[ref[2]]
+
+    def rng_states(self):
+        "State of the session's dice stream, then of each encounter's"
+        return [self.rng.state()] + [enc.rng.state()
+                                     for enc in self.encounters]
+
+    def set_rng_states(self, changed):
+        "Puts dice streams back from [(position, state)] of rng_states()"
+        for i, state in changed:
+            rng = RNG.from_state(state)
+            if i == 0:
+                self.rng = rng
+            else:
+                self.encounters[i - 1].rng = rng
+
+    def state(self):
+        "The whole session as plain data, for snapshots"
+        return {
+            'name': self.name,
+            'date': self.date,
+            'rng': self.rng.state(),
+            'players': [player_codec.to_row(p, self.ref)
+                        for p in self.players],
+            'encounters': [enc.state() for enc in self.encounters],
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        "Rebuilds a session from `state()`"
+        session = cls(state['name'], date=state['date'])
+        for name, init_mod, max_hp, hp, playername, _ in state['players']:
+            session.players.append(player_codec.from_row(
+                [name, init_mod, max_hp, hp, playername, []]))
+        for enc_state in state['encounters']:
+            session.encounters.append(Encounter.from_state(session, enc_state))
+        # effects and initiative can refer to anyone, so they go last
+        for player, player_state in zip(session.players, state['players']):
+            restore_effects(player, player_state[5], session.resolve)
+        for enc, enc_state in zip(session.encounters, state['encounters']):
+            enc.load_references(enc_state)
+        session.rng = RNG.from_state(state['rng'])
+        return session
+
     def __repr__(self):
         pieces = [self.name, self.date]
         pieces.extend(str(enc) for enc in self.encounters)
@@ -75,48 +175,39 @@ class Session(object):
 
     def damage(self):
         "Damages a monster"
-        monsters = self.curr_enc().monsters
-        valid_mons = [mon.name for mon in monsters]
-        with Completer(valid_mons):
+        index = self.encounter.monster_index
+        with Completer(index):
             print("Which Monster gets the damage?")
-            print("\n".join([mon.name for mon in monsters]))
+            print("\n".join(index.names))
             monster_name = raw_input("Name: ")
-
-        for mnstr in monsters:
-            if mnstr.name == monster_name:
-                monster = mnstr
-                break
-        else:
+        if monster_name not in index:
             print("No monster with that name.")
             return
-        monster.damage(int(raw_input("How much damage?: ")))
+        monster = index.get(monster_name)
+        self.encounter.damage_monsters(
+            [monster], int(raw_input("How much damage?: ")))
 
-    def print_mon_status(self):
+    def print_mon_status(self, changed_only=False):
         "Prints the status of all Monsters"
         print("<<Monster Status'>>".center(80))
-        print("\n".join([mon.status() for mon in self.curr_enc().monsters]))
+        self.encounter.status_board.draw(changed_only=changed_only)
 
     def affect(self):
-        monsters = self.curr_enc().monsters
-        valid_mons = [mon.name for mon in monsters]
-        with Completer(valid_mons):
+        index = self.encounter.monster_index
+        with Completer(index):
             print("Which Monster gets affected?")
-            print("\n".join(valid_mons))
+            print("\n".join(index.names))
             monster_name = raw_input("Name: ")
-        
-        for mon in monsters:
-            if mon.name == monster_name:
-                monster = mon
-                break
-        else:
+        if monster_name not in index:
             print("No monster with that name")
             return
-        monster.affect(raw_input("What is the effect?: "))
+        self.encounter.affect(index.get(monster_name),
+                              raw_input("What is the effect?: "))
 
     def defect(self):
         "Removes an affect from a monster"
-        monsters = self.curr_enc().monsters
-        valid_mons = [mon.name for mon in monsters if mon.effects]
+        index = self.encounter.monster_index
+        valid_mons = [mon.name for mon in index if mon.effects]
         if not valid_mons:
             print("No monsters have effects currently.")
             return
@@ -125,87 +216,469 @@ class Session(object):
             print("Which monster's effect is gone?")
             print("\n".join(valid_mons))
             monster_name = raw_input("Name: ")
-        for monster in monsters:
-            if monster.name == monster_name:
-                break
-        else:
+        if monster_name not in index:
             print("No monster with that name")
             return
+        monster = index.get(monster_name)
 
         with Completer(monster.effects):
             print("Which effect needs to be removed?")
             print("\n".join(monster.effects))
-            monster.defect(raw_input("Effect: "))
+            self.encounter.defect(monster, raw_input("Effect: "))
+
+
+Turn = namedtuple('Turn', 'combatant round expired saves')
+player_codec = codec_for(PlayerCharacter)
+AreaResult = namedtuple('AreaResult', 'monster natural total outcome damage')
 
 
 class Encounter(object):
     "Simulates an encounter given a player and monster list"
 
     def __init__(self, name=None, session=None):
+        self.session = session
+        self.number = len(session.encounters)
+        self.rng = session.rng.split()
         if name is None:
-            name = 'Encounter [{}]'.format(rand_string())
+            name = 'Encounter [{}]'.format(rand_string(rng=self.rng))
         self.name = name
-        self.session = session
+        session.emit('encounter', name)
         self.p_mod = 0
         self.m_mod = 0
-        self.initiative_order = []
+        self.initiative_order = InitiativeOrder()
+        self.effect_queue = EffectQueue()
+        self.round = 0
         self.players = self.session.players
         self.monsters = []
+        self.table = CombatantTable(self)
+        self.status_board = StatusBoard(self.table)
+        self.monster_index = NameIndex()
+        self.effect_index = EffectIndex()
         self.roll_initiative()
 
+    def emit(self, kind, *args):
+        self.session.emit(kind, self.number, *args)
+
     def roll_initiative(self):
         "Rolls the initiative and creates the initiative order"
-        self.initiative_order.extend([(d20() + plyr.init_mod + self.p_mod,
-                                plyr) for plyr in self.players])
+        totals = []
+        for plyr in self.players:
+            totals.append((plyr, d20(self.rng) + plyr.init_mod + self.p_mod))
+        for mnstr in self.monsters:
+            totals.append(
+                (mnstr, d20(self.rng) + mnstr.init_mod + self.m_mod))
+        self.set_initiative(totals)
 
-        self.initiative_order.extend([(d20() + mnstr.init_mod + self.m_mod,
-                                mnstr) for mnstr in self.monsters])
-
-        self.initiative_order.sort(cmp=init_comparer)
+    def set_initiative(self, totals):
+        "Starts the initiative order over from (combatant, total) pairs"
+        self.initiative_order.clear()
+        for combatant, total in totals:
+            if not isinstance(combatant, MonsterRow):
+                self.watch(combatant)
+            self.initiative_order.add(combatant, total)
+        self.effect_queue.rekey(self.initiative_order.key_of)
+        self.emit('initiative', [[self.session.ref(combatant), total]
+                                 for combatant, total in totals])
 
     def add_monster(self, mon):
+        '''Adds a monster, returning the table-backed copy the encounter
+        tracks'''
+        if not isinstance(mon, MonsterRow) or mon.table is not self.table:
+            mon = self.table.adopt(mon)
+        total = d20(self.rng) + mon.init_mod + self.m_mod
+        self.enter(mon, total)
+        self.emit('monster', mon.name, mon.init_mod, mon.max_hp, mon.hp,
+                  mon.defenses, list(mon.effects), total)
+        return mon
+
+    def enter(self, mon, total):
+        "Brings a table row into play on an initiative total"
         self.monsters.append(mon)
-        mon.encounter = self
+        self.monster_index.add(mon.name, mon)
+        self.initiative_order.add(mon, total)
+
+    def watch(self, character):
+        "Keeps effect_index up to date with a player's effects"
+        if character.effects.watcher is not self.effect_index:
+            character.effects.watch(self.effect_index, character)
+
+    def affected(self, effect):
+        "Everyone in play currently affected by `effect`"
+        return self.effect_index[effect]
+
+    def retire_dead(self, monsters):
+        "Takes any of these monsters that have died out of play"
+        for mon in monsters:
+            if mon.dead:
+                self.initiative_order.remove(mon)
+                self.monster_index.remove(mon.name, mon)
+                self.effect_index.forget(mon, mon.effects)
+                self.effect_queue.forget(mon)
+
+    def bloodied_monsters(self):
+        "Living monsters at or below half hp"
+        rows = [mon.row for mon in self.monster_index]
+        return self.table.views(self.table.bloodied(rows))
+
+    def damage_monsters(self, monsters, amount):
+        "Deals the same damage to many monsters in one pass"
+        rows = [mon.row for mon in monsters]
+        self.table.damage(rows, amount)
+        self.emit('damage', rows, amount)
+        self.retire_dead(self.table.views(self.table.dead(rows)))
+
+    def damage_each(self, monsters, amounts):
+        "Deals amounts[n] damage to monsters[n]"
+        rows = [mon.row for mon in monsters]
+        self.table.damage_each(rows, amounts)
+        self.emit('damage_each', rows, list(amounts))
+        self.retire_dead(self.table.views(self.table.dead(rows)))
+
+    def next_turn(self):
+        '''Ends the current turn and starts the next one, expiring any
+        effects that are due along the way'''
+        order = self.initiative_order
+        expired, saves = [], []
+        ending = order.acting
+        if order.current is not None:
+            expired.extend(self.effect_queue.pop_due(
+                self.round, order.current, END))
+            if ending is not None:
+                saves = self.effect_queue.save_ends(ending)
+        combatant, wrapped = order.next_turn()
+        if wrapped or self.round == 0:
+            self.round += 1
+        if combatant is not None:
+            expired.extend(self.effect_queue.pop_due(
+                self.round, order.current, START))
+        for effect in expired:
+            if effect.name in effect.target.effects:
+                effect.target.defect(effect.name)
+        self.emit('next')
+        return Turn(combatant, self.round, expired, saves)
+
+    def affect(self, target, effect, source=None, duration=None):
+        "Puts an untimed effect on a combatant"
+        target.affect(effect, source, duration)
+        self.emit('affect', self.session.ref(target), effect,
+                  self.session.ref(source), duration)
+
+    def defect(self, target, effect):
+        "Takes an effect off a combatant"
+        target.defect(effect)
+        self.emit('defect', self.session.ref(target), effect)
+
+    def delay(self, combatant):
+        self.initiative_order.delay(combatant)
+        self.emit('delay', self.session.ref(combatant))
+
+    def ready(self, combatant):
+        self.initiative_order.ready(combatant)
+        self.emit('ready', self.session.ref(combatant))
+
+    def resume(self, combatant):
+        self.initiative_order.resume(combatant)
+        self.effect_queue.rekey(self.initiative_order.key_of)
+        self.emit('resume', self.session.ref(combatant))
+
+    def add_effect(self, target, name, duration=SAVE_ENDS, source=None,
+                   rounds=None):
+        '''Puts a timed effect on `target`. Turn based durations are
+        measured in `source`'s turns, defaulting to whoever is acting'''
+        order = self.initiative_order
+        source = source or order.acting or target
+        anchor = order.key(source) if source in order else order.current
+        effect = TimedEffect(name, target, source, duration, due_time(
+            duration, self.round, order.current, anchor, rounds))
+        if not isinstance(target, MonsterRow):
+            self.watch(target)
+        target.affect(name, source, duration)
+        self.effect_queue.add(effect, order.at(effect.due[1])
+                              if effect.due else None)
+        ref = self.session.ref
+        self.emit('effect', ref(target), name, duration, ref(source), rounds)
+        return effect
+
+    def save_ends(self, target, name):
+        "The save-ends effect called `name` on `target`"
+        for effect in self.effect_queue.save_ends(target):
+            if effect.name.lower() == name.lower():
+                return effect
+        raise KeyError('{} has no save-ends {}'.format(target.name, name))
+
+    def saved(self, effect):
+        "Ends a save-ends effect after a successful saving throw"
+        self.effect_queue.saved(effect)
+        if effect.name in effect.target.effects:
+            effect.target.defect(effect.name)
+        self.emit('saved', self.session.ref(effect.target), effect.name)
+
+    def combatant(self, name):
+        "Finds a player or living monster by name"
+        if name in self.monster_index:
+            return self.monster_index.get(name)
+        for character in self.players:
+            if character.name == name:
+                return character
+        raise KeyError(name)
+
+    def state(self):
+        "The encounter as plain data, for snapshots"
+        table, ref = self.table, self.session.ref
+        return {
+            'name': self.name,
+            'p_mod': self.p_mod,
+            'm_mod': self.m_mod,
+            'round': self.round,
+            'rng': self.rng.state(),
+            'table': {
+                'names': table.names,
+                'init_mod': table.init_mod.tolist(),
+                'max_hp': table.max_hp.tolist(),
+                'hp': table.hp.tolist(),
+                'flags': table.flags.tolist(),
+                'defenses': dict((name, column.tolist())
+                                 for name, column in table.defenses.items()),
+                'effects': [[row, effects.state(ref)]
+                            for row, effects in table.effects.items()],
+            },
+            'monsters': [mon.row for mon in self.monsters],
+            'index': [mon.row for mon in self.monster_index],
+            'initiative': self.initiative_order.state(ref),
+            'effects': [[effect.name, ref(effect.target), ref(effect.source),
+                         effect.duration, effect.due]
+                        for effect in self.effect_queue.pending()],
+        }
+
+    @classmethod
+    def from_state(cls, session, state):
+        '''Rebuilds an encounter's monsters from `state()`. Effects and
+        initiative are restored by load_references once every encounter
+        exists'''
+        enc = cls(state['name'], session)
+        enc.p_mod, enc.m_mod = state['p_mod'], state['m_mod']
+        enc.round = state['round']
+        enc.rng = RNG.from_state(state['rng'])
+        table, columns = enc.table, state['table']
+        for row, name in enumerate(columns['names']):
+            table.append(name, columns['init_mod'][row],
+                         columns['max_hp'][row], columns['hp'][row],
+                         dict((defense, values[row]) for defense, values
+                              in columns['defenses'].items()))
+        table.flags = array('B', columns['flags'])
+        enc.monsters = table.views(state['monsters'])
+        enc.monster_index.update(
+            (mon.name, mon) for mon in table.views(state['index']))
+        return enc
+
+    def load_references(self, state):
+        "Restores effects and initiative from `state()`"
+        resolve = self.session.resolve
+        for row, effects in state['table']['effects']:
+            restore_effects(self.table.rows[row], effects, resolve)
+        self.initiative_order.load(state['initiative'], resolve)
+        self.load_effects(state['effects'])
 
-    def add_monsters(self, amount, monster_type, init_mod, hp):
+    def load_effects(self, effects):
+        "Replaces the running effects with ones from `state()`"
+        resolve, order = self.session.resolve, self.initiative_order
+        self.effect_queue.clear()
+        for name, target, source, duration, due in effects:
+            due = tuple(tuple(part) if isinstance(part, list) else part
+                        for part in due) if due else None
+            self.effect_queue.add(
+                TimedEffect(name, resolve(target), resolve(source), duration,
+                            due), order.at(due[1]) if due else None)
+
+    def restore(self, changes):
+        '''Puts rows, players and the turn back the way `changes` describes
+        them, as made by History.changes'''
+        table, order = self.table, self.initiative_order
+        for row, hp, flags, indexed, effects, slot in changes['rows']:
+            mon = table.rows[row]
+            was_listed = not table.flags[row] & REMOVED
+            was_indexed = mon in self.monster_index.by_name.get(mon.name, ())
+            mon.hp = hp
+            table.flags[row] = flags
+            if was_listed and flags & REMOVED:
+                self.monsters.remove(mon)
+            elif not was_listed and not flags & REMOVED:
+                position = sum(1 for other in self.monsters if other.row < row)
+                self.monsters.insert(position, mon)
+            if was_indexed and not indexed:
+                self.monster_index.remove(mon.name, mon)
+                self.effect_index.forget(mon, mon.effects)
+            elif indexed and not was_indexed:
+                self.monster_index.add(mon.name, mon)
+                for effect in mon.effects:
+                    self.effect_index.add(effect, mon)
+            set_effects(mon, effects, self.session)
+            if not indexed:
+                self.effect_index.forget(mon, mon.effects)
+            order.place(mon, slot)
+        for i, hp, effects, slot in changes['players']:
+            player = self.session.players[i]
+            player.hp = hp
+            set_effects(player, effects, self.session)
+            order.place(player, slot)
+        self.round = changes['round']
+        current = changes['current']
+        order.current = tuple(current) if current else None
+        order.tiebreak = changes['tiebreak']
+        if 'effects' in changes:
+            self.load_effects(changes['effects'])
+        self.emit('restore', changes)
+
+    def remove_monster(self, mon):
+        "Takes a monster out of the encounter entirely"
+        self.monsters.remove(mon)
+        self.initiative_order.remove(mon)
+        self.monster_index.remove(mon.name, mon)
+        self.effect_index.forget(mon, mon.effects)
+        self.effect_queue.forget(mon)
+        self.table.remove(mon)
+        self.emit('remove', mon.row)
+
+    def add_monsters(self, amount, monster_type, init_mod, hp,
+                     defenses=None):
         '''Add multiple monsters of the same type'''
         if amount == 1:  # special case, ignore auto-lettering
-            self.add_monster(Monster(monster_type, init_mod, hp))
+            self.add_monster(self.table.append(monster_type, init_mod, hp,
+                                               defenses=defenses))
             return
-        for designation in map(letterer, xrange(amount)):
-            self.add_monster(
-                Monster(monster_type + " " + designation, init_mod, hp))
+        for designation in map(letterer, xrange(1, amount + 1)):
+            self.add_monster(self.table.append(
+                monster_type + " " + designation, init_mod, hp,
+                defenses=defenses))
 
-    def __repr__(self):
-        title_bar = "-[{0.name}]-".format(self).center(80)
-        init_template = '{init} -> "{name}" {status}'
-        initiative = "\n".join(init_template.format(
-            init=init,
-            name=character.name,
-            status=character.life_status(),
-            ) for (init, character) in self.initiative_order)
-        return "{title_bar}\n{initiative}\n".format(
-            title_bar=title_bar, initiative=initiative)
-
-
-def init_comparer((total_initA, A), (total_initB, B)):
-    "Compares two (init, PlayerCharacter) tuples for precedence"
-    if total_initA > total_initB:
-        return -1
-    elif total_initA < total_initB:
-        return 1
-    else:  # absolute inits are the same, get the highest mod
-        if A.init_mod > B.init_mod:
-            return -1
-        elif A.init_mod < B.init_mod:
-            return 1
-        else:
-            if id(A) > id(B):
-                return -1
-            elif id(A) < id(B):
-                return 1
+    def select_monsters(self, patterns):
+        '''Living monsters matching any of the patterns: exact names,
+        globs like "Goblin *", "bloodied" or "all"'''
+        chosen = set()
+        for pattern in patterns:
+            if pattern == 'all':
+                chosen.update(self.monster_index)
+            elif pattern == 'bloodied':
+                chosen.update(self.bloodied_monsters())
             else:
-                return 0
+                chosen.update(self.monster_index.matching(pattern))
+        return sorted(chosen, key=lambda mon: mon.row)
+
+    def area_attack(self, targets, bonus, defense, damage, half=False):
+        '''Attacks every target with one roll phase: an attack roll per
+        target, a single damage roll shared by everyone hit, max damage on a
+        crit and optionally half damage on a miss. Returns AreaResults'''
+        table, rng = self.table, self.rng
+        plan = compile_dice(damage)
+        rows = [mon.row for mon in targets]
+        naturals = rng.dice(20, len(rows))
+        outcomes = table.attack(rows, naturals, bonus, defense)
+        rolled = plan.roll(rng)
+        amounts = {'crit': plan.maximum, 'hit': rolled,
+                   'miss': rolled // 2 if half else 0}
+        dealt = [amounts[outcome] for outcome in outcomes]
+        self.damage_each(targets, dealt)
+        return [AreaResult(mon, natural, natural + bonus, outcome, amount)
+                for mon, natural, outcome, amount
+                in zip(targets, naturals, outcomes, dealt)]
+
+    def iter_lines(self):
+        "The lines of the initiative board, one at a time"
+        yield "-[{0.name}]-".format(self).center(80)
+        init_template = '{} -> "{}" {}'.format
+        for init, character in self.initiative_order:
+            yield init_template(init, character.name,
+                                character.life_status())
+
+    def __repr__(self):
+        return "\n".join(self.iter_lines()) + "\n"
+
+
+def restore_effects(character, state, resolve):
+    "Puts effects from EffectSet.state() back on a character"
+    for effect, applications in state:
+        for source, duration in applications:
+            character.affect(effect, resolve(source), duration)
+
+
+def set_effects(character, state, session):
+    "Makes a character's effects match EffectSet.state(), if they don't"
+    if frozen(character.effects.state(session.ref)) == frozen(state):
+        return
+    for effect in list(character.effects):
+        for _ in xrange(character.effects.count(effect)):
+            character.defect(effect)
+    restore_effects(character, state, session.resolve)
+
+
+# Replaying journal records. Each takes the session and the record's
+# arguments, and repeats the change through the same method that made it.
+
+def _replay_monster(session, number, name, init_mod, max_hp, hp, defenses,
+                    effects, total):
+    enc = session.encounters[number]
+    mon = enc.table.append(name, init_mod, max_hp, hp, defenses)
+    for effect in effects:
+        mon.affect(effect)
+    enc.enter(mon, total)
+
+
+def _replay_saved(session, number, target, name):
+    enc = session.encounters[number]
+    for effect in enc.effect_queue.save_ends(session.resolve(target)):
+        if effect.name == name:
+            return enc.saved(effect)
+
+
+def _rows(func):
+    return lambda session, number, rows, *args: func(
+        session.encounters[number],
+        session.encounters[number].table.views(rows), *args)
+
+
+def _refs(func):
+    return lambda session, number, ref, *args: func(
+        session.encounters[number], session.resolve(ref), *args)
+
+
+REPLAY = {
+    'name': Session.rename,
+    'player': lambda session, name, init_mod, max_hp, playername:
+        session.add_player(PlayerCharacter(name, init_mod, max_hp,
+                                           playername=playername)),
+    'encounter': Session.add_encounter,
+    'initiative': lambda session, number, totals:
+        session.encounters[number].set_initiative(
+            [(session.resolve(ref), total) for ref, total in totals]),
+    'monster': _replay_monster,
+    'damage': _rows(Encounter.damage_monsters),
+    'damage_each': _rows(Encounter.damage_each),
+    'remove': lambda session, number, row:
+        session.encounters[number].remove_monster(
+            session.encounters[number].table.rows[row]),
+    'next': lambda session, number: session.encounters[number].next_turn(),
+    'affect': lambda session, number, target, effect, source, duration:
+        session.encounters[number].affect(
+            session.resolve(target), effect, session.resolve(source),
+            duration),
+    'defect': _refs(Encounter.defect),
+    'effect': lambda session, number, target, name, duration, source, rounds:
+        session.encounters[number].add_effect(
+            session.resolve(target), name, duration, session.resolve(source),
+            rounds),
+    'saved': _replay_saved,
+    'delay': _refs(Encounter.delay),
+    'ready': _refs(Encounter.ready),
+    'resume': _refs(Encounter.resume),
+    'restore': lambda session, number, changes:
+        session.encounters[number].restore(changes),
+    'rng': Session.set_rng_states,
+}
+
+
+def replay(session, kind, args):
+    "Applies one journal record to the session"
+    REPLAY[kind](session, *args)
 
 
 def print_wrap(func):
@@ -264,27 +737,169 @@ def requires_encounter(func):
     return encounter_wrap
 
 
+def argument_position(line, endidx):
+    '''Which argument of a command line the cursor is in (the command
+    itself is 0)'''
+    start = argument_start(line, endidx)
+    try:
+        return len(shlex.split(line[:start].rstrip('"\'')))
+    except ValueError:
+        return 0
+
+
+def complete_subcommand(subcommands, line, begidx, endidx):
+    '''Completes the first argument from a list of subcommands'''
+    if argument_position(line, endidx) != 1:
+        return []
+    return complete_argument([subcommands], line, begidx, endidx)
+
+
+def with_combatant(func):
+    '''Looks up the combatant named in the command's argument'''
+    @functools.wraps(func)
+    @requires_encounter
+    def combatant_wrap(self, args):
+        name = ' '.join(shlex.split(args))
+        try:
+            combatant = self.session.encounter.combatant(name)
+        except KeyError:
+            return fprint('No combatant named "{}"', name)
+        try:
+            return func(self, combatant)
+        except (KeyError, ValueError) as e:
+            fprint("Can't do that: {}", e)
+    return combatant_wrap
+
+
 class BattleCmd(cmd.Cmd):
     '''The command line class'''
 
     prompt = 'BT> '
 
-    def __init__(self):
-        self.session = Session()
-        self.session.add_encounter()
-        self.encounters = self.session.encounters
-        self.players = self.session.players
+    def __init__(self, journal_path=JOURNAL_PATH, history_budget=16 << 20,
+                 fresh=False):
         cmd.Cmd.__init__(self)
+        self.journal = None
+        self.database = None
+        self.history_budget = history_budget
+        self._history = None
+        if journal_path is not None and not fresh and \
+                journal_exists(journal_path):
+            self.session, self.journal = recover(
+                journal_path, Session.from_state, replay)
+            fprint('Recovered {} ({} encounters, {} players)',
+                   self.session.name, len(self.encounters),
+                   len(self.players))
+        else:
+            if journal_path is not None:
+                self.journal = Journal(journal_path)
+            self.start_session(Session())
+
+    @property
+    def encounters(self):
+        return self.session.encounters
+
+    @property
+    def players(self):
+        return self.session.players
+
+    def start_session(self, session):
+        "Makes `session` current, starting a fresh journal for it"
+        self.session = session
+        if self.journal is not None:
+            self.journal.start(session)
+        if self.database is not None:
+            self.database.close()
+            self.database = BackgroundWriter(self.database.engine, session)
+        session.add_encounter()
+
+    @property
+    def history(self):
+        "Undo history of the current encounter"
+        encounter = self.session.encounter
+        if self._history is None or self._history.encounter is not encounter:
+            if self._history is not None:
+                self._history.close()
+            self._history = History(encounter, self.history_budget)
+        return self._history
+
+    def postcmd(self, stop, line):
+        self.history.commit()
+        if self.journal is not None:
+            self.journal.commit(self.session)
+        if self.database is not None:
+            self.database.flush()
+        return stop
 
     def cmdloop(self):
-        '''Override command loop to abort on Ctrl+C'''
-        while True:
-            try:
-                return cmd.Cmd.cmdloop(self)
-            except KeyboardInterrupt:
-                continue
+        '''Override command loop to abort on Ctrl+C. However the loop ends,
+        the database writer finishes its writes before the thread goes'''
+        try:
+            while True:
+                try:
+                    return cmd.Cmd.cmdloop(self)
+                except KeyboardInterrupt:
+                    continue
+        finally:
+            if self.database is not None:
+                self.database.close()
+                self.database = None
+
+    def do_undo(self, args):
+        '''Undo the last change to the encounter
+
+        BT> undo
+        '''
+        if not self.history.undo():
+            fprint('Nothing to undo')
+
+    def do_redo(self, args):
+        '''Redo what was just undone
+
+        BT> redo
+        '''
+        if not self.history.redo():
+            fprint('Nothing to redo')
+
+    @shlexify
+    def do_fork(self, name):
+        '''Try something out on a new branch of the encounter, leaving the
+        current one as it is
+
+        BT> fork <BRANCH>
+        Go back with:
+        BT> branch main
+        '''
+        try:
+            self.history.fork(name)
+        except ValueError as e:
+            return fprint('{}', e)
+        fprint('Now on branch {}', name)
+
+    @shlexify
+    def do_branch(self, name=None):
+        '''List the encounter's branches, or switch to one
+
+        BT> branch [<BRANCH>]
+        '''
+        history = self.history
+        if name is None:
+            for branch in sorted(set(history.branches) | {history.branch}):
+                fprint('{} {}', '*' if branch == history.branch else ' ',
+                       branch)
+            return
+        try:
+            history.checkout(name)
+        except ValueError as e:
+            return fprint('{}', e)
+        fprint('Now on branch {}', name)
 
     def do_EOF(self, args):
+        if self.database is not None:
+            self.database.close()
+            self.database = None
+        if self.journal is not None:
+            self.journal.discard()
         return True
 
     def do_session(self, args):
@@ -300,9 +915,9 @@ class BattleCmd(cmd.Cmd):
             return print(self.session)
         subcommand = arglist.pop(0)
         if subcommand == 'new':
-            self.session = Session(name=args[0] if args else None)
-        elif subcommand == 'name':
-            self.session.name = Session(name=args[0])
+            self.start_session(Session(name=arglist[0] if arglist else None))
+        elif subcommand == 'name' and arglist:
+            self.session.rename(arglist[0])
         else:
             fprint('Command `{}` not recognized', subcommand)
 
@@ -316,7 +931,7 @@ class BattleCmd(cmd.Cmd):
         Walk through adding new players:
         BT> players new
         Add a single player
-        BT> players add <PLAYER_NAME>
+        BT> players add <PLAYER_NAME> [<INIT_MOD> [<MAX_HP>]]
         '''
         args = list(args)
         if not args:
@@ -330,7 +945,11 @@ class BattleCmd(cmd.Cmd):
             return self.interactive_player_creation()
         elif subcommand == 'add':
             name = args.pop(0)
-            self.players.append(PlayerCharacter(name, ))
+            try:
+                numbers = [int(arg) for arg in args[:2]]
+            except ValueError as e:
+                return fprint('{}', e)
+            self.session.add_player(PlayerCharacter(name, *numbers))
 
     def interactive_player_creation(self):
         '''Walks through creating players'''
@@ -338,7 +957,8 @@ class BattleCmd(cmd.Cmd):
         for i in xrange(num_players):
             name = raw_input("%s player's name: " % ordinal(i+1)).strip()
             init = keep_asking("{}'s initiative modifier: ".format(name), int)
-            self.players.append(PlayerCharacter(name, init))
+            max_hp = keep_asking("{}'s max hp: ".format(name), int)
+            self.session.add_player(PlayerCharacter(name, init, max_hp))
 
     def new_monsters(self):
         "Creates new monsters from the command line"
@@ -348,11 +968,14 @@ class BattleCmd(cmd.Cmd):
             mon_num = keep_asking("Number of {}(s): ".format(mon_name), int)
             mon_init = keep_asking(mon_name + " initiative modifier: ", int)
             mon_hp = keep_asking(mon_name + " hp: ", int)
-            self.encounter.add_monsters(mon_num, mon_name, mon_init, mon_hp)
+            mon_defs = keep_asking(mon_name + " AC Fort Ref Will "
+                                   "(blank to skip): ", parse_defenses)
+            self.session.encounter.add_monsters(mon_num, mon_name, mon_init,
+                                                mon_hp, mon_defs)
             with Completer(["yes", "no"]):
                 more = raw_input("More monster types?[yN] ").strip().lower()
-            if more.startswith("n"):
-                print(self.monsters)
+            if not more.startswith("y"):
+                print(self.session.encounter.monsters)
                 break
 
     @requires_players
@@ -360,11 +983,384 @@ class BattleCmd(cmd.Cmd):
         '''Operate on the encounter'''
         self.new_monsters()
 
+    @requires_encounter
+    @shlexify
+    def do_initiative(self, *args):
+        '''Show or reroll the initiative order
+
+        Show the order:
+        BT> initiative
+        Roll it again for everyone:
+        BT> initiative roll
+        '''
+        if args and args[0] == 'roll':
+            self.session.encounter.roll_initiative()
+        for line in self.session.encounter.iter_lines():
+            print(line)
+
+    @requires_encounter
+    def do_next(self, args):
+        '''Move on to the next combatant's turn'''
+        encounter = self.session.encounter
+        turn = encounter.next_turn()
+        for effect in turn.saves:
+            if effect.target not in encounter.players:
+                natural = d20(encounter.rng)
+                if natural >= 10:
+                    encounter.saved(effect)
+                fprint('{} saves against {}: {} ({})', effect.target.name,
+                       effect.name, natural,
+                       'ends' if natural >= 10 else 'still affected')
+            else:
+                fprint('{} should save against {}; `save` them if they '
+                       'make it', effect.target.name, effect.name)
+        for effect in turn.expired:
+            fprint('{} is no longer {}', effect.target.name, effect.name)
+        if turn.combatant is None:
+            return fprint('Nobody is in the initiative order')
+        fprint("Round {}: {}'s turn ({})", turn.round, turn.combatant.name,
+               encounter.initiative_order.total(turn.combatant))
+
+    @requires_encounter
+    @shlexify
+    def do_affect(self, name=None, effect=None, duration='save', source=None):
+        '''Put a timed effect on a combatant
+
+        BT> affect <NAME> <EFFECT> [<DURATION> [<SOURCE>]]
+        DURATION is one of save (save ends, the default), eot (end of the
+        source's turn), eont (end of the source's next turn), sont (start of
+        the source's next turn) or a number of rounds. SOURCE defaults to
+        whoever is acting.
+        '''
+        if name is None or effect is None:
+            return fprint('Usage: affect <NAME> <EFFECT> [<DURATION> '
+                          '[<SOURCE>]]')
+        encounter = self.session.encounter
+        try:
+            target = encounter.combatant(name)
+            source = encounter.combatant(source) if source else None
+            duration, rounds = parse_duration(duration)
+        except KeyError as e:
+            return fprint('No combatant named {}', e)
+        except ValueError as e:
+            return fprint('{}', e)
+        encounter.add_effect(target, effect, duration, source, rounds)
+
+    @requires_encounter
+    @shlexify
+    def do_save(self, name=None, effect=None):
+        '''A combatant made their saving throw, ending a save-ends effect
+
+        BT> save <NAME> <EFFECT>
+        '''
+        if name is None or effect is None:
+            return fprint('Usage: save <NAME> <EFFECT>')
+        encounter = self.session.encounter
+        try:
+            target = encounter.combatant(name)
+        except KeyError as e:
+            return fprint('No combatant named {}', e)
+        try:
+            saved = encounter.save_ends(target, effect)
+        except KeyError as e:
+            return fprint('{}', e.args[0])
+        encounter.saved(saved)
+        fprint('{} is no longer {}', target.name, saved.name)
+
+    @requires_encounter
+    def do_monstatus(self, args):
+        '''Show the status of every monster
+
+        BT> monstatus
+        Only monsters that changed since the status was last shown:
+        BT> monstatus changed
+        '''
+        self.session.print_mon_status(changed_only=args.strip() == 'changed')
+
+    @requires_encounter
+    def do_affected(self, args):
+        '''List everyone with an effect
+
+        BT> affected <EFFECT>
+        '''
+        effect = ' '.join(shlex.split(args))
+        if not effect:
+            return fprint('Usage: affected <EFFECT>')
+        affected = self.session.encounter.affected(effect)
+        if not affected:
+            return fprint('Nobody is {}', effect)
+        for character in sorted(affected, key=lambda c: c.name):
+            print(character.status())
+
+    @with_combatant
+    def do_delay(self, combatant):
+        '''Delay a combatant's turn until they `resume`
+
+        BT> delay <NAME>
+        '''
+        self.session.encounter.delay(combatant)
+
+    @with_combatant
+    def do_ready(self, combatant):
+        '''Ready an action; `resume` the combatant when it triggers
+
+        BT> ready <NAME>
+        '''
+        self.session.encounter.ready(combatant)
+
+    @with_combatant
+    def do_resume(self, combatant):
+        '''A delayed or readied combatant acts now, right after whoever is
+        acting
+
+        BT> resume <NAME>
+        '''
+        encounter = self.session.encounter
+        encounter.resume(combatant)
+        fprint("{}'s turn ({})", combatant.name,
+               encounter.initiative_order.total(combatant))
+
+    @requires_encounter
+    @shlexify
+    def do_area(self, *args):
+        '''Resolve an area attack against many monsters at once
+
+        BT> area <BONUS> <DEFENSE> <DAMAGE> <TARGET>... [half]
+        DEFENSE is ac, fort, ref or will. TARGETs are names, globs like
+        "Goblin *", "bloodied" or "all". Add "half" for half damage on a miss.
+        e.g. BT> area +6 ref 3d6+4 "Goblin *" bloodied half
+        '''
+        args = list(args)
+        half = 'half' in args
+        if half:
+            args.remove('half')
+        if len(args) < 4:
+            return fprint('Usage: area <BONUS> <DEFENSE> <DAMAGE> '
+                          '<TARGET>... [half]')
+        bonus, defense, damage, patterns = args[0], args[1], args[2], args[3:]
+        encounter = self.session.encounter
+        try:
+            bonus = int(bonus)
+            if defense.lower() not in DEFENSE_NAMES:
+                raise ValueError('Unknown defense "{}"'.format(defense))
+            compile_dice(damage)
+        except ValueError as e:
+            return fprint('{}', e)
+        targets = encounter.select_monsters(patterns)
+        if not targets:
+            return fprint('No living monsters match {}', ' '.join(patterns))
+        defense = DEFENSE_NAMES[defense.lower()]
+        results = encounter.area_attack(targets, bonus, defense, damage, half)
+        for result in results:
+            mon = result.monster
+            fprint('{:<20} {:>2}{:+} = {:>2} vs {} {:>2}: {:<4} {:>3} dmg  {}',
+                   mon.name, result.natural, bonus, result.total, defense,
+                   mon.defenses[defense], result.outcome, result.damage,
+                   mon.status())
+        fprint('{} hit, {} missed, {} dropped', sum(
+            1 for r in results if r.outcome != 'miss'), sum(
+            1 for r in results if r.outcome == 'miss'), sum(
+            1 for r in results if r.monster.dead))
+
+    @requires_encounter
+    @shlexify
+    def do_simulate(self, runs='10000', processes=None, seed=None):
+        '''Simulate the current encounter many times to estimate the odds
+
+        BT> simulate
+        BT> simulate <RUNS> [<PROCESSES> [<SEED>]]
+        Without a SEED the run gets the next stream split off the session's
+        RNG, so it replays with the session.
+        '''
+        try:
+            seed = int(seed) if seed else self.session.rng.split().seed_value
+            result = simulate(self.session.encounter, int(runs),
+                              processes=int(processes) if processes else None,
+                              seed=seed)
+        except ValueError as e:
+            return fprint("Can't simulate: {}", e)
+        print(result)
+        fprint('Seed {}', seed)
+
+    @requires_session
+    @shlexify
+    def do_database(self, filename=None):
+        '''Keep the session written to a database in the background
+
+        BT> database <FILENAME>
+        Wait until every change so far is in the database:
+        BT> database sync
+        Show how far behind the writer is and how long writes take:
+        BT> database stats
+        '''
+        if filename in ('sync', 'flush', 'stats'):
+            if self.database is None:
+                return fprint('No database open')
+            if filename != 'stats':
+                try:
+                    self.database.sync()
+                except Exception as e:
+                    fprint('Database write failed: {}', e)
+            return self.print_database_stats()
+        if filename is None:
+            return fprint('Usage: database <FILENAME>|sync|stats')
+        if self.database is not None:
+            self.database.close()
+        self.database = BackgroundWriter(setup_db(filename), self.session)
+        self.database.flush()
+        fprint('Writing {} to {}', self.session.name, filename)
+
+    def print_database_stats(self):
+        stats = self.database.metrics()
+        fprint('{queued} batches queued (at most {max_queued}), '
+               '{batches} batches in {transactions} transactions', **stats)
+        fprint('{rows_queued} rows queued, {rows_written} written after '
+               'merging', **stats)
+        if stats['transactions']:
+            fprint('Flushes took {:.1f} ms on average, {:.1f} ms at most',
+                   stats['mean_flush_seconds'] * 1000,
+                   stats['max_flush_seconds'] * 1000)
+        if stats['backpressure_waits']:
+            fprint('Waited on the writer {backpressure_waits} times, '
+                   '{backpressure_seconds:.2f} s in all', **stats)
+
+    @requires_session
+    @shlexify
+    def do_archive(self, filename=None):
+        '''Write the session to a compact binary archive
+
+        BT> archive [<FILENAME>]
+        '''
+        filename = filename or \
+            self.session.name.title().replace(' ', '') + '.4es'
+        archive.write(self.session, filename)
+        fprint('Session archived to {}', filename)
+
+    @shlexify
+    def do_roll(self, expression='d20', times='1'):
+        '''Roll a dice expression
+
+        Roll a d20:
+        BT> roll
+        Roll an expression:
+        BT> roll 3d6+2
+        Roll an expression several times:
+        BT> roll 4d6dl1 6
+        '''
+        try:
+            rolls = roll_many(expression, int(times), self.session.rng)
+        except ValueError as e:
+            return fprint('Bad roll: {}', e)
+        print(', '.join(str(total) for total in rolls))
+
+    @shlexify
+    def do_odds(self, expression, target=None):
+        '''Exact odds for a dice expression
+
+        Print the average and spread of an expression:
+        BT> odds 2d8+5
+        Chance of rolling at least a target:
+        BT> odds 2d8+5 15
+        '''
+        try:
+            dist = distribution(expression)
+        except ValueError as e:
+            return fprint('Bad expression: {}', e)
+        fprint('{}: {}..{}, mean {:.2f}, std dev {:.2f}, median {}',
+               expression, dist.minimum, dist.maximum, float(dist.mean),
+               float(dist.variance) ** 0.5, dist.median())
+        if target is not None:
+            fprint('P(>= {}) = {:.2%}', target,
+                   float(dist.at_least(int(target))))
+
+    # Tab completion
+
+    def combatant_indexes(self):
+        '''Indexes of every nameable combatant in the current encounter'''
+        encounter = self.session.encounter
+        if encounter is None:
+            return []
+        return [encounter.monster_index, [p.name for p in self.players]]
+
+    def complete_session(self, text, line, begidx, endidx):
+        return complete_subcommand(['new', 'name'], line, begidx, endidx)
+
+    def complete_players(self, text, line, begidx, endidx):
+        return complete_subcommand(['new', 'add'], line, begidx, endidx)
+
+    def complete_initiative(self, text, line, begidx, endidx):
+        return complete_subcommand(['roll'], line, begidx, endidx)
+
+    def complete_monstatus(self, text, line, begidx, endidx):
+        return complete_subcommand(['changed'], line, begidx, endidx)
+
+    def complete_branch(self, text, line, begidx, endidx):
+        return complete_subcommand(sorted(self.history.branches), line,
+                                   begidx, endidx)
+
+    def complete_delay(self, text, line, begidx, endidx):
+        return complete_argument(self.combatant_indexes(), line, begidx,
+                                 endidx, start=line.index(' ') + 1)
+
+    complete_ready = complete_delay
+
+    def complete_affected(self, text, line, begidx, endidx):
+        encounter = self.session.encounter
+        effects = encounter.effect_index.by_effect if encounter else ()
+        return complete_argument([effects], line, begidx, endidx,
+                                 start=line.index(' ') + 1)
+
+    def complete_resume(self, text, line, begidx, endidx):
+        encounter = self.session.encounter
+        waiting = [c.name for c in encounter.initiative_order.waiting] \
+            if encounter else []
+        return complete_argument([waiting], line, begidx, endidx,
+                                 start=line.index(' ') + 1)
+
+    def complete_affect(self, text, line, begidx, endidx):
+        position = argument_position(line, endidx)
+        if position in (1, 4):
+            return complete_argument(self.combatant_indexes(), line, begidx,
+                                     endidx, quote=True)
+        if position == 3:
+            return complete_argument([DURATIONS.keys()], line, begidx, endidx)
+        return []
+
+    def complete_save(self, text, line, begidx, endidx):
+        position = argument_position(line, endidx)
+        if position == 1:
+            return complete_argument(self.combatant_indexes(), line, begidx,
+                                     endidx, quote=True)
+        if position == 2 and self.session.encounter:
+            effects = self.session.encounter.effect_queue.pending()
+            return complete_argument(
+                [set(e.name for e in effects if e.due is None)], line,
+                begidx, endidx, quote=True)
+        return []
+
+    def complete_area(self, text, line, begidx, endidx):
+        position = argument_position(line, endidx)
+        if position == 2:
+            return complete_argument([DEFENSE_NAMES.keys()], line, begidx,
+                                     endidx)
+        if position >= 4 and self.session.encounter:
+            return complete_argument(
+                [self.session.encounter.monster_index,
+                 ['all', 'bloodied', 'half']], line, begidx, endidx,
+                quote=True)
+        return []
+
 
 
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Battle Tracker')
+    parser.add_argument('--fresh', action='store_true',
+                        help="start a new session instead of recovering one "
+                        "that didn't exit cleanly")
+    args = parser.parse_args()
     print("-- Battle Tracker --".center(80))
-    bt = BattleCmd()
+    bt = BattleCmd(fresh=args.fresh)
     bt.cmdloop()
     # session = Session()
     # command_dict = {'next': session.next_encounter,
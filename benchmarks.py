@@ -0,0 +1,439 @@
+'''Rough timings for the hot paths.
+
+Run everything with `python benchmarks.py`, or pick benchmarks by name:
+`python benchmarks.py combatants`
+'''
+from __future__ import print_function
+import json
+import os
+import sys
+import tempfile
+import time
+
+import archive
+import codec
+from dm_common import (Monster, PlayerCharacter, Completer, NameIndex,
+                       letterer)
+from combatants import CombatantTable, StatusBoard
+
+
+def best_of(func, repeat=5):
+    '''Best wall clock time of several calls to func'''
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def report(label, seconds, count=None):
+    if count:
+        print('  {:<40} {:9.3f} ms {:>12,.0f}/s'.format(
+            label, seconds * 1000, count / seconds))
+    else:
+        print('  {:<40} {:9.3f} ms'.format(label, seconds * 1000))
+
+
+def bench_combatants(count=10000, hit=300):
+    '''Monster objects against the column-backed CombatantTable'''
+    print('{:,} monsters, damaging {} at a time'.format(count, hit))
+    names = ['Minion {}'.format(i) for i in xrange(count)]
+    objects = [Monster(name, 2, 20 + i % 7) for i, name in enumerate(names)]
+    table = CombatantTable()
+    for i, name in enumerate(names):
+        table.append(name, 2, 20 + i % 7)
+    targets = range(0, count, count // hit)[:hit]
+
+    object_bytes = sum(sys.getsizeof(m) + sys.getsizeof(m.__dict__) +
+                       sys.getsizeof(m.effects) for m in objects)
+    table_bytes = (sum(sys.getsizeof(col) for col in (
+        table.names, table.init_mod, table.max_hp, table.hp, table.flags,
+        table.effects, table.rows)) +
+        sum(sys.getsizeof(view) for view in table.rows))
+    print('  memory (excluding names): objects {:,} bytes, table {:,} '
+          'bytes ({:.1f}x smaller)'.format(object_bytes, table_bytes,
+                                           object_bytes / float(table_bytes)))
+
+    def object_damage():
+        for i in targets:
+            objects[i].damage(10)
+            objects[i].damage(-10)
+
+    def table_damage():
+        table.damage(targets, 10)
+        table.damage(targets, -10)
+
+    report('objects: damage', best_of(object_damage), hit * 2)
+    report('table: damage', best_of(table_damage), hit * 2)
+    report('objects: all bloodied',
+           best_of(lambda: [m for m in objects if m.bloodied]), count)
+    report('table: all bloodied', best_of(table.bloodied), count)
+    report('objects: status of everyone',
+           best_of(lambda: [m.status() for m in objects]), count)
+    report('table: status of everyone', best_of(table.status_lines), count)
+
+    board = StatusBoard(table)
+    board.refresh()
+
+    def redraw_after_damage():
+        table.damage(targets, 1)
+        return list(board.iter_lines())
+
+    report('board: redraw everyone, {} changed'.format(hit),
+           best_of(redraw_after_damage), count)
+    report('board: redraw changed only',
+           best_of(lambda: (table.damage(targets, -1),
+                            list(board.iter_lines(changed_only=True)))), hit)
+
+
+def bench_completion(count=50000):
+    '''Tab completion over a monster-compendium sized option list'''
+    print('{:,} completion options'.format(count))
+    options = ['{} {}'.format(kind, letterer(i + 1))
+               for kind in ('Goblin', 'Kobold', 'Orc', 'Zombie', 'Dragon')
+               for i in xrange(count // 5)]
+
+    def linear(text):
+        return [s for s in sorted(options) if s.startswith(text)]
+
+    def first_tab(text):
+        Completer._indexes.clear()
+        return Completer(options).complete(text, 0)
+
+    completer = Completer(options)
+    report('old: sort + startswith scan', best_of(lambda: linear('Orc AB')))
+    report('first completer for the option set',
+           best_of(lambda: first_tab('Orc AB')))
+    report('cached completer for the option set',
+           best_of(lambda: Completer(options)))
+    report('complete "Orc AB" (narrow)',
+           best_of(lambda: completer.complete('Orc AB', 0)))
+    report('complete "Orc A" (~700 matches)',
+           best_of(lambda: completer.complete('Orc A', 0)))
+    index = NameIndex()
+    index.update((name, name) for name in options)
+    report('complete from a live NameIndex',
+           best_of(lambda: Completer(index).complete('Orc AB', 0)))
+
+
+def big_session(count):
+    '''A session with four players and one encounter of `count` monsters'''
+    from battle_tracker import Session
+    session = Session(seed=1)
+    for name in ('Ann', 'Bob', 'Cat', 'Dan'):
+        session.add_player(PlayerCharacter(name, 2, 40))
+    encounter = session.add_encounter()
+    encounter.add_monsters(count, 'Kobold', 1, 30, {
+        'ac': 16, 'fortitude': 13, 'reflex': 15, 'will': 12})
+    for i, mon in enumerate(encounter.monsters):
+        if i % 7 == 0:
+            encounter.add_effect(mon, 'dazed')
+        if i % 3 == 0:
+            mon.damage(i % 25)
+    return session
+
+
+def bench_snapshots(count=10000):
+    '''JSON snapshots against binary archives read through mmap'''
+    print('{:,} monster encounter'.format(count))
+    state = big_session(count).state()
+    directory = tempfile.mkdtemp()
+    json_path = os.path.join(directory, 'session.json')
+    binary_path = os.path.join(directory, 'session.bin')
+    try:
+        with open(json_path, 'wb') as f:
+            json.dump(state, f, separators=(',', ':'))
+        with open(binary_path, 'wb') as f:
+            f.write(archive.dumps(state))
+        json_size = os.path.getsize(json_path)
+        binary_size = os.path.getsize(binary_path)
+        print('  size: json {:,} bytes, archive {:,} bytes ({:.1f}x '
+              'smaller)'.format(json_size, binary_size,
+                                json_size / float(binary_size)))
+
+        def load_json():
+            with open(json_path, 'rb') as f:
+                return json.load(f)
+
+        def list_encounters():
+            with archive.Archive(binary_path) as a:
+                return a.encounters()
+
+        def one_combatant():
+            with archive.Archive(binary_path) as a:
+                return a.combatant(0, count // 2)
+
+        def dazed():
+            with archive.Archive(binary_path) as a:
+                return a.with_condition(0, 'dazed')
+
+        report('json: load everything', best_of(load_json))
+        report('archive: load everything',
+               best_of(lambda: archive.read(binary_path)))
+        report('archive: list encounters', best_of(list_encounters))
+        report('archive: read one monster', best_of(one_combatant))
+        report('archive: find dazed monsters', best_of(dazed))
+        report('archive: write', best_of(lambda: archive.dumps(state)))
+    finally:
+        for path in (json_path, binary_path):
+            if os.path.exists(path):
+                os.remove(path)
+        os.rmdir(directory)
+
+
+def bench_codec(count=10000):
+    '''Compiled character serializers against building dicts by hand'''
+    print('{:,} monsters'.format(count))
+    monsters = [Monster('Kobold {}'.format(i), 1, 30) for i in xrange(count)]
+    for mon in monsters[::7]:
+        mon.affect('dazed')
+
+    def by_hand():
+        return [{'name': m.name, 'init_mod': m.init_mod, 'max_hp': m.max_hp,
+                 'hp': m.hp, 'effects': m.effects.state(codec.source_name)}
+                for m in monsters]
+
+    data = codec.dumps(monsters)
+    text = json.dumps([m.json for m in monsters])
+    print('  size: json {:,} bytes, binary {:,} bytes'.format(len(text),
+                                                             len(data)))
+    report('by hand: dicts', best_of(by_hand), count)
+    report('codec: dicts', best_of(lambda: [m.json for m in monsters]), count)
+    report('codec: rows', best_of(lambda: map(codec.to_row, monsters)), count)
+    report('codec: binary', best_of(lambda: codec.dumps(monsters)), count)
+    report('codec: load dicts', best_of(lambda: [
+        Monster.from_json(d) for d in json.loads(text)]), count)
+    report('codec: load binary', best_of(lambda: codec.loads(data)), count)
+
+
+def reference_session():
+    '''An in-memory database holding the reference tables'''
+    from sqlalchemy.orm import sessionmaker
+    import create_db
+    engine = create_db.setup_db(':memory:')
+    session = sessionmaker(bind=engine)()
+    create_db.initialize_database(session)
+    session.commit()
+    return session
+
+
+def bench_export(repeat=20):
+    '''models.Base.json: per-class plans against reflecting on every call'''
+    from collections import Sized, Iterable
+    from sqlalchemy import inspect
+    import models as M
+
+    def reflected(obj):  # Base.json as it was
+        jsonify = lambda o: reflected(o) if hasattr(o, 'json') else o
+        out = {}
+        for attr, prop in inspect(obj.__class__).all_orm_descriptors.items():
+            if hasattr(prop, 'info') and prop.info.get('jsonify'):
+                value = getattr(obj, attr)
+                if obj.__json_null__ or value is False or value:
+                    if isinstance(value, (Sized, Iterable)) \
+                            and not isinstance(value, basestring):
+                        out[attr] = [jsonify(p) for p in value]
+                    else:
+                        out[attr] = jsonify(value)
+        return out
+
+    session = reference_session()
+    objects = (session.query(M.Race).all() + session.query(M.Class).all() +
+               session.query(M.Effect).all())
+    print('{} races, classes and effects, exported {} times'.format(
+        len(objects), repeat))
+    assert [o.json() for o in objects] == map(reflected, objects)
+
+    def export(func):
+        return lambda: [map(func, objects) for _ in xrange(repeat)]
+
+    def planned(obj):
+        return M._json_from_plan(obj, M.json_plan(obj.__class__),
+                                 obj.__json_null__)
+
+    report('reflection on every call', best_of(export(reflected)))
+    report('cached plan', best_of(export(planned)))
+    report('generated json functions', best_of(export(M.Base.json)))
+
+
+def bench_effects(repeat=20):
+    '''Effect.__str__: render plans against reflecting on every call'''
+    from sqlalchemy import inspect
+    import models as M
+
+    def reflected(effect):  # Effect.__str__ as it was
+        columns = inspect(effect.__class__).columns
+        mods = ['{0:+} {1}'.format(getattr(effect, attr), M.pretty(attr))
+                for attr, col in columns.items()
+                if attr != 'name'
+                and isinstance(M.pytype(col), int)
+                and getattr(effect, attr) is not None]
+        mods.extend('{} {}'.format(getattr(effect, attr), attr.title())
+                    for attr, col in columns.items()
+                    if attr != 'name'
+                    and isinstance(M.pytype(col), str)
+                    and getattr(effect, attr) is not None)
+        mods.extend(str(stat) for stat in effect.stats)
+        return '{0.name}:\n  {1}'.format(effect, '\n  '.join(mods))
+
+    session = reference_session()
+    effects = ([race.effect for race in session.query(M.Race)] +
+               [e for cls in session.query(M.Class) for e in cls.effects])
+    print('{} racial and class effects, rendered {} times'.format(
+        len(effects), repeat))
+    assert map(str, effects) == map(reflected, effects)
+
+    def render(func):
+        return lambda: [map(func, effects) for _ in xrange(repeat)]
+
+    report('reflection on every call', best_of(render(reflected)))
+    report('render plans', best_of(render(str)))
+
+
+def bench_stacking(count=200):
+    '''Character stats worked out on every lookup against the cache'''
+    import models as M
+    import stacking
+
+    session = reference_session()
+    races = [r.name for r in session.query(M.Race)]
+    classes = [c.name for c in session.query(M.Class)]
+    armors = [a.name for a in session.query(M.Armor)]
+    party = [M.Player('Hero {}'.format(i), racename=races[i % len(races)],
+                      classname=classes[i % len(classes)],
+                      armorname=armors[i % len(armors)], level=1 + i % 30)
+             for i in xrange(count)]
+    session.add_all(party)
+    session.flush()
+    skills = session.query(M.Skill).all()
+    print('{} characters'.format(count))
+
+    def uncached():
+        for character in party:
+            stacking.compute(character, skills)
+
+    def cached():
+        for character in party:
+            stacking.character_stats(character)
+
+    report('summing effects on every lookup', best_of(uncached), count)
+    report('cached stats', best_of(cached), count)
+    effect = session.query(M.Effect).get('Fighter Class Benefits')
+    effect.healing_surges += 1
+    report('after changing a class effect', best_of(cached, 1), count)
+
+
+def bench_derived(count=500):
+    '''Reports from the character_stats table against working stats out'''
+    import models as M
+    import derived
+    import stacking
+
+    session = reference_session()
+    races = [r.name for r in session.query(M.Race)]
+    classes = [c.name for c in session.query(M.Class)]
+    session.add_all(
+        M.Player('Hero {}'.format(i), racename=races[i % len(races)],
+                 classname=classes[i % len(classes)], level=1 + i % 30,
+                 dexterity=8 + i % 11) for i in xrange(count))
+    session.commit()
+    print('{} characters'.format(count))
+    report('populate', best_of(lambda: derived.populate(session), 1), count)
+    derived.track(session)
+    reflex = M.character_stats.c.reflex
+
+    def in_python():
+        return sorted(c.name for c in session.query(M.Character)
+                      if stacking.compute(c)[0].defenses['reflex'] >= 20)
+
+    def in_sql():
+        return derived.characters_with(session, reflex >= 20)
+
+    assert in_python() == in_sql()
+    report('Reflex >= 20, stats worked out', best_of(in_python))
+    report('Reflex >= 20, indexed query', best_of(in_sql))
+    effect = session.query(M.Effect).get('Elf Racial Benefits')
+
+    def change():
+        effect.reflex = (effect.reflex or 0) + 1
+        session.flush()
+
+    report('flush changing a racial effect', best_of(change))
+
+
+def bench_loading(sizes=(1, 10, 100)):
+    '''A session with many encounters: lazy loading against load_session'''
+    from sqlalchemy import event
+    import models as M
+    import loaders
+
+    def fill(session, encounters):
+        heroes = ['Hero {}'.format(k) for k in xrange(4)]
+        session.execute(M.Session.__table__.insert(), [{'name': 'Session'}])
+        session.execute(M.Character.__table__.insert(), [
+            {'name': name, 'is_player': True} for name in heroes])
+        for i in xrange(encounters):
+            name = 'Encounter {}'.format(i)
+            goblins = ['Goblin {}-{}'.format(i, k) for k in xrange(6)]
+            session.execute(M.Encounter.__table__.insert(), [
+                {'name': name, 'sessionname': 'Session'}])
+            session.execute(M.Character.__table__.insert(), [
+                {'name': goblin, 'is_player': False} for goblin in goblins])
+            session.execute(M.CharacterEncounter.__table__.insert(), [
+                {'charactername': character, 'encounter_id': name,
+                 'init_score': 20 - j, 'position': j}
+                for j, character in enumerate(heroes + goblins)])
+        session.commit()
+
+    def walk(db):
+        return sum(len(enc.players) + len(enc.monsters) +
+                   len(enc.initiative) for enc in db.encounters)
+
+    counts = {}
+    for size in sizes:
+        session = reference_session()
+        fill(session, size)
+        statements = []
+        event.listen(session.bind, 'before_cursor_execute',
+                     lambda *args: statements.append(args[2]))
+
+        def lazy():
+            session.expunge_all()
+            return walk(session.query(M.Session).get('Session'))
+
+        def eager():
+            session.expunge_all()
+            return walk(loaders.load_session(session, 'Session'))
+
+        del statements[:]
+        loaded = lazy()
+        lazy_queries = len(statements)
+        del statements[:]
+        assert eager() == loaded == size * 20
+        counts[size] = len(statements)
+        print('{} encounters: {} queries lazily, {} with load_session'.format(
+            size, lazy_queries, counts[size]))
+        report('lazy loading', best_of(lazy))
+        report('load_session', best_of(eager))
+    assert len(set(counts.values())) == 1, \
+        'load_session query count grows with encounters: {}'.format(counts)
+
+
+BENCHMARKS = {
+    'codec': bench_codec,
+    'combatants': bench_combatants,
+    'completion': bench_completion,
+    'derived': bench_derived,
+    'effects': bench_effects,
+    'export': bench_export,
+    'loading': bench_loading,
+    'snapshots': bench_snapshots,
+    'stacking': bench_stacking,
+}
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
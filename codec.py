@@ -0,0 +1,293 @@
+'''Serializers for tracker characters, compiled from a schema per class.
+
+SCHEMAS lists the fields of Character, PlayerCharacter and Monster once.
+When the module loads, each schema is turned into Python source for that
+class alone (straight attribute reads and writes, no loops over field names)
+and compiled. Every class gets three forms:
+
+* a dict, for JSON (`to_dict`/`from_dict`, and `Character.json`)
+* a row list in field order, which is what session snapshots hold
+* a binary record: a fixed struct with the numbers and string lengths,
+  followed by the UTF-8 strings (`dumps`/`loads` for many at once)
+
+Effects are written as EffectSet.state(), with sources named by a `ref`
+function and looked up again with `resolve`. Without them, sources are
+written by name and read back as names.
+
+This is how players are written everywhere: `Character.json`, the player
+rows of `Session.state()` and so journal snapshots, and the archive, which
+is built from that state. Encounter monsters are not. They live in a
+CombatantTable, and `Encounter.state()` snapshots it column by column, which
+the archive then packs into fixed-width records it can read through mmap.
+Going through one row per monster would give up both.
+
+Strings in a binary record are at most 65534 bytes: the length is an
+unsigned short, and 0xFFFF is kept for None.
+'''
+import json
+import struct
+
+from dm_common import Character, PlayerCharacter, Monster, EffectSet
+
+MAGIC = 'DMC1'
+HEADER = struct.Struct('<4sI')  # magic, record count
+NONE = 0xFFFF  # string length that stands for None; longer is an error
+
+SCHEMAS = [  # tags are the list positions, so only ever append
+    (Character, (('name', 'str'), ('init_mod', 'int'), ('max_hp', 'int'),
+                 ('hp', 'int'), ('effects', 'effects')), {}),
+    (PlayerCharacter, (('name', 'str'), ('init_mod', 'int'),
+                       ('max_hp', 'int'), ('hp', 'int'),
+                       ('playername', 'optstr'), ('effects', 'effects')), {}),
+    (Monster, (('name', 'str'), ('init_mod', 'int'), ('max_hp', 'int'),
+               ('hp', 'int'), ('effects', 'effects')), {'encounter': None}),
+]
+
+_dumps = json.JSONEncoder(separators=(',', ':')).encode
+_loads = json.loads
+
+
+def source_name(source):
+    '''The default `ref` for effect sources: their name'''
+    return getattr(source, 'name', source)
+
+
+def _set_effects(obj, state, resolve):
+    effects = obj.effects = EffectSet(obj)
+    for effect, applications in state:
+        for source, duration in applications:
+            effects.add(effect, resolve(source), duration)
+
+
+def _encode(text):
+    return text if type(text) is str else text.encode('utf-8')
+
+
+def _decode(raw):
+    try:
+        raw.decode('ascii')
+        return raw
+    except UnicodeDecodeError:
+        return raw.decode('utf-8')
+
+
+def _identity(value):
+    return value
+
+
+def _too_long(lengths):
+    raise ValueError('Strings in a binary record must be under {} bytes, '
+                     'not {}'.format(NONE, max(lengths)))
+
+
+_TEMPLATE = '''
+def to_dict(obj, ref=source_name):
+    return {{{dict_items}}}
+
+def to_row(obj, ref=source_name):
+    return [{row_items}]
+
+def from_dict(data, resolve=_identity):
+    obj = new(cls)
+{dict_assign}
+    return obj
+
+def from_row(row, resolve=_identity):
+    {row_names}, = row
+    obj = new(cls)
+{row_assign}
+    return obj
+
+def to_bytes(obj, ref=source_name):
+{bytes_prepare}
+    if {too_long}:
+        too_long([{text_lengths}])
+    return head_pack({head_args}) + {payload}
+
+def from_bytes(data, offset, resolve=_identity):
+    {head_names}, = head_unpack_from(data, offset)
+    offset += head_size
+{bytes_assign}
+    return obj, offset
+'''
+
+
+class Codec(object):
+    '''Compiled serializers for one class'''
+
+    def __init__(self, tag, cls, fields, defaults):
+        self.tag = tag
+        self.cls = cls
+        self.fields = fields
+        self.defaults = defaults
+        ints = [name for name, kind in fields if kind == 'int']
+        texts = [name for name, kind in fields if kind != 'int']
+        self.head = struct.Struct('<B{}i{}H'.format(len(ints), len(texts)))
+        self.source = self._source(ints, texts)
+        namespace = {
+            'cls': cls, 'new': object.__new__, 'source_name': source_name,
+            '_identity': _identity, 'set_effects': _set_effects,
+            'EffectSet': EffectSet, 'dumps': _dumps, 'loads': _loads,
+            'encode': _encode, 'decode': _decode, 'NONE': NONE,
+            'too_long': _too_long,
+            'head_pack': self.head.pack,
+            'head_unpack_from': self.head.unpack_from,
+            'head_size': self.head.size,
+        }
+        exec compile(self.source, '<codec {}>'.format(cls.__name__),
+                     'exec') in namespace
+        for name in ('to_dict', 'to_row', 'from_dict', 'from_row',
+                     'to_bytes', 'from_bytes'):
+            setattr(self, name, namespace[name])
+
+    def _source(self, ints, texts):
+        fields, defaults = self.fields, self.defaults
+
+        def read(name, kind):
+            if kind == 'effects':
+                return 'obj.effects.state(ref)'
+            return 'obj.' + name
+
+        def assign(name, kind, value):
+            if kind == 'effects':
+                return '    set_effects(obj, {}, resolve)'.format(value)
+            return '    obj.{} = {}'.format(name, value)
+
+        extra = ['    obj.{} = {!r}'.format(name, value)
+                 for name, value in sorted(defaults.items())]
+        prepare, lengths, payload = [], [], []
+        for name, kind in fields:
+            if kind == 'int':
+                continue
+            if kind == 'effects':
+                prepare.append('    e = obj.effects\n'
+                               '    {0} = dumps(e.state(ref)) if e else ""'
+                               .format(name))
+                lengths.append('len({})'.format(name))
+            elif kind == 'optstr':
+                prepare.append('    {0} = obj.{0}\n'
+                               '    {0}_length = NONE\n'
+                               '    if {0} is None:\n'
+                               '        {0} = ""\n'
+                               '    else:\n'
+                               '        {0} = encode({0})\n'
+                               '        {0}_length = len({0})'.format(name))
+                lengths.append('{}_length'.format(name))
+            else:
+                prepare.append('    {0} = encode(obj.{0})'.format(name))
+                lengths.append('len({})'.format(name))
+            payload.append(name)
+        bytes_assign = ['    obj = new(cls)']
+        for name, kind in fields:
+            if kind == 'int':
+                bytes_assign.append('    obj.{0} = {0}'.format(name))
+                continue
+            length = '{}_length'.format(name)
+            if kind == 'optstr':
+                bytes_assign.append(
+                    '    if {1} == NONE:\n'
+                    '        obj.{0} = None\n'
+                    '    else:\n'
+                    '        obj.{0} = decode(data[offset:offset + {1}])\n'
+                    '        offset += {1}'.format(name, length))
+            elif kind == 'effects':
+                bytes_assign.append(
+                    '    if {0}:\n'
+                    '        set_effects(obj,'
+                    ' loads(data[offset:offset + {0}]), resolve)\n'
+                    '        offset += {0}\n'
+                    '    else:\n'
+                    '        obj.effects = EffectSet(obj)'.format(length))
+            else:
+                bytes_assign.append(
+                    '    obj.{0} = decode(data[offset:offset + {1}])\n'
+                    '    offset += {1}'.format(name, length))
+        bytes_assign.extend(extra)
+        return _TEMPLATE.format(
+            dict_items=', '.join('{!r}: {}'.format(name, read(name, kind))
+                                 for name, kind in fields),
+            row_items=', '.join(read(name, kind) for name, kind in fields),
+            dict_assign='\n'.join(
+                [assign(name, kind, 'data[{!r}]'.format(name))
+                 for name, kind in fields] + extra),
+            row_names=', '.join(name + '_' for name, _ in fields),
+            row_assign='\n'.join(
+                [assign(name, kind, name + '_') for name, kind in fields] +
+                extra),
+            bytes_prepare='\n'.join(prepare),
+            head_args=', '.join([str(self.tag)] +
+                                ['obj.' + name for name in ints] + lengths),
+            payload=' + '.join(payload),
+            too_long=' or '.join('len({}) >= NONE'.format(name)
+                                 for name in payload),
+            text_lengths=', '.join('len({})'.format(name)
+                                   for name in payload),
+            head_names=', '.join(['_'] + ints +
+                                 [name + '_length' for name in texts]),
+            bytes_assign='\n'.join(bytes_assign),
+        )
+
+
+_codecs = {}
+_by_tag = []
+_dict_encoders = {}  # class -> its codec's to_dict, for Character.json
+
+
+def codec_for(cls):
+    '''The compiled Codec for a class, or for the nearest class it inherits
+    from that has a schema'''
+    codec = _codecs.get(cls)
+    if codec is None:
+        for klass in cls.__mro__:
+            if klass in _codecs:
+                codec = _codecs[cls] = _codecs[klass]
+                break
+        else:
+            raise TypeError("Can't serialize {}".format(cls.__name__))
+    return codec
+
+
+def to_dict(obj, ref=source_name):
+    try:
+        encode = _dict_encoders[type(obj)]
+    except KeyError:
+        encode = _dict_encoders[type(obj)] = codec_for(type(obj)).to_dict
+    return encode(obj, ref)
+
+
+def from_dict(cls, data, resolve=_identity):
+    return codec_for(cls).from_dict(data, resolve)
+
+
+def to_row(obj, ref=source_name):
+    return codec_for(type(obj)).to_row(obj, ref)
+
+
+def from_row(cls, row, resolve=_identity):
+    return codec_for(cls).from_row(row, resolve)
+
+
+def dumps(objs, ref=source_name):
+    '''Many characters as one binary string'''
+    objs = list(objs)
+    parts = [HEADER.pack(MAGIC, len(objs))]
+    parts.extend(codec_for(type(obj)).to_bytes(obj, ref) for obj in objs)
+    return ''.join(parts)
+
+
+def loads(data, resolve=_identity):
+    '''The characters in a string from `dumps`'''
+    magic, count = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError('Not a character dump')
+    offset, objs = HEADER.size, []
+    append, decoders = objs.append, [c.from_bytes for c in _by_tag]
+    for _ in xrange(count):
+        obj, offset = decoders[ord(data[offset])](data, offset, resolve)
+        append(obj)
+    return objs
+
+
+for _tag, (_cls, _fields, _defaults) in enumerate(SCHEMAS):
+    _codecs[_cls] = Codec(_tag, _cls, _fields, _defaults)
+    _by_tag.append(_codecs[_cls])
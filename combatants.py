@@ -0,0 +1,292 @@
+'''Column storage for large numbers of monsters.
+
+An encounter's monsters live in a CombatantTable: one array per stat rather
+than one object with a __dict__ per monster. `MonsterRow` objects are thin
+views into a row of the table, so everything that works with a `Monster`
+keeps working. Bulk operations (who is bloodied, damage these 300, render
+the status of everybody) run over the columns directly. Effects are only
+stored for the rows that have any, with their condition bits mirrored into
+a column.
+
+Every change to a row marks it dirty, so a StatusBoard only re-renders the
+status lines of monsters that changed since it last drew, and a History only
+records the rows that changed since its last version.
+'''
+import sys
+from array import array
+
+from dm_common import Monster, EffectSet, CONDITION_BITS
+
+REMOVED = 1
+
+DEFENSES = ('ac', 'fortitude', 'reflex', 'will')
+DEFENSE_NAMES = {
+    'ac': 'ac', 'armor': 'ac', 'armor_class': 'ac',
+    'fort': 'fortitude', 'fortitude': 'fortitude',
+    'ref': 'reflex', 'reflex': 'reflex',
+    'will': 'will',
+}
+DEFAULT_DEFENSE = 10
+
+
+class NoEffects(EffectSet):
+    '''The effects of a row that has none. One is shared by every such row,
+    so it refuses changes: use MonsterRow.affect, which gives the row an
+    EffectSet of its own'''
+
+    def add(self, effect, source=None, duration=None):
+        raise TypeError('No effects to add to; use affect()')
+
+    def watch(self, watcher, owner):
+        raise TypeError('No effects to watch')
+
+
+_NO_EFFECTS = NoEffects()
+
+
+class MonsterRow(Monster):
+    '''A Monster whose stats are stored in a CombatantTable'''
+    __slots__ = ('table', 'row')
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    @property
+    def name(self):
+        return self.table.names[self.row]
+
+    @name.setter
+    def name(self, value):
+        self.table.names[self.row] = value
+        self.table.touch(self.row)
+
+    @property
+    def init_mod(self):
+        return self.table.init_mod[self.row]
+
+    @init_mod.setter
+    def init_mod(self, value):
+        self.table.init_mod[self.row] = value
+
+    @property
+    def max_hp(self):
+        return self.table.max_hp[self.row]
+
+    @max_hp.setter
+    def max_hp(self, value):
+        self.table.max_hp[self.row] = value
+        self.table.touch(self.row)
+
+    @property
+    def hp(self):
+        return self.table.hp[self.row]
+
+    @hp.setter
+    def hp(self, value):
+        self.table.hp[self.row] = value
+        self.table.touch(self.row)
+
+    @property
+    def effects(self):
+        return self.table.effects.get(self.row, _NO_EFFECTS)
+
+    @property
+    def defenses(self):
+        table, row = self.table, self.row
+        return dict((name, table.defenses[name][row]) for name in DEFENSES)
+
+    @property
+    def encounter(self):
+        return self.table.encounter
+
+    def affect(self, effect, source=None, duration=None):
+        "Adds a status effect string"
+        table, row = self.table, self.row
+        effects = table.effects.get(row)
+        if effects is None:
+            effects = table.effects[row] = EffectSet(self, table.watcher)
+        effects.add(effect, source, duration)
+        table.conditions[row] = effects.conditions
+        table.touch(row)
+
+    def defect(self, effect):
+        "Removes a status effect string"
+        table, row = self.table, self.row
+        effects = table.effects.get(row, _NO_EFFECTS)
+        effects.remove(effect)
+        table.conditions[row] = effects.conditions
+        table.touch(row)
+        if not effects:
+            del table.effects[row]
+
+
+class CombatantTable(object):
+    '''Monsters stored column by column'''
+
+    def __init__(self, encounter=None):
+        self.encounter = encounter
+        self.names = []
+        self.init_mod = array('l')
+        self.max_hp = array('l')
+        self.hp = array('l')
+        self.flags = array('B')
+        self.conditions = array('L')
+        self.defenses = dict((name, array('l')) for name in DEFENSES)
+        self.effects = {}
+        self.rows = []
+        self.dirty = set()  # rows changed since the StatusBoard last drew
+        self.changed = set()  # rows changed since the History last recorded
+
+    def __len__(self):
+        return len(self.rows)
+
+    def touch(self, row):
+        '''Marks a row as changed'''
+        self.dirty.add(row)
+        self.changed.add(row)
+
+    def touch_all(self, rows):
+        self.dirty.update(rows)
+        self.changed.update(rows)
+
+    def append(self, name, init_mod=0, max_hp=0, hp=None, defenses=None):
+        '''Adds a row, returning its MonsterRow view. `defenses` maps
+        ac/fortitude/reflex/will to values'''
+        self.names.append(name)
+        self.init_mod.append(init_mod)
+        self.max_hp.append(max_hp)
+        self.hp.append(max_hp if hp is None else hp)
+        self.flags.append(0)
+        self.conditions.append(0)
+        defenses = defenses or {}
+        for defense in DEFENSES:
+            self.defenses[defense].append(
+                defenses.get(defense, DEFAULT_DEFENSE))
+        view = MonsterRow(self, len(self.rows))
+        self.touch(view.row)
+        self.rows.append(view)
+        return view
+
+    def adopt(self, monster):
+        '''Copies an ordinary Monster into the table, returning its view'''
+        view = self.append(monster.name, monster.init_mod, monster.max_hp,
+                           monster.hp, getattr(monster, 'defenses', None))
+        effects = monster.effects
+        for effect in effects:
+            for source, duration in effects.details[effect]:
+                view.affect(effect, source, duration)
+        return view
+
+    @property
+    def watcher(self):
+        '''The EffectIndex row effects are reported to, if any'''
+        return getattr(self.encounter, 'effect_index', None)
+
+    def remove(self, view):
+        '''Marks a row as no longer in play. Rows are never reused, so
+        other views stay valid'''
+        self.flags[view.row] |= REMOVED
+        self.touch(view.row)
+
+    def active(self):
+        '''Row numbers still in play'''
+        flags = self.flags
+        return [i for i in xrange(len(flags)) if not flags[i] & REMOVED]
+
+    def bloodied(self, rows=None):
+        '''Row numbers of living monsters at or below half hp'''
+        hp, max_hp = self.hp, self.max_hp
+        rows = self.active() if rows is None else rows
+        return [i for i in rows if 0 < hp[i] <= max_hp[i] // 2]
+
+    def dead(self, rows=None):
+        '''Row numbers of dead monsters'''
+        hp = self.hp
+        rows = self.active() if rows is None else rows
+        return [i for i in rows if hp[i] <= 0]
+
+    def with_condition(self, condition, rows=None):
+        '''Row numbers with one of the standard CONDITIONS'''
+        bit, conditions = CONDITION_BITS[condition], self.conditions
+        rows = self.active() if rows is None else rows
+        return [i for i in rows if conditions[i] & bit]
+
+    def damage(self, rows, amount):
+        '''Applies the same damage to every row in `rows`'''
+        hp = self.hp
+        for i in rows:
+            hp[i] -= amount
+        self.touch_all(rows)
+
+    def damage_each(self, rows, amounts):
+        '''Applies amounts[n] damage to rows[n]'''
+        hp = self.hp
+        for i, amount in zip(rows, amounts):
+            hp[i] -= amount
+        self.touch_all(rows)
+
+    def attack(self, rows, naturals, bonus, defense):
+        """Resolves one attack roll per row against `defense`. Returns a
+        list of outcomes: 'crit' on a natural 20, 'miss' on a natural 1 or
+        a total below the defense, otherwise 'hit'"""
+        column = self.defenses[DEFENSE_NAMES[defense]]
+        return ['crit' if natural == 20 else
+                'hit' if natural != 1 and natural + bonus >= column[i] else
+                'miss'
+                for i, natural in zip(rows, naturals)]
+
+    def views(self, rows):
+        return [self.rows[i] for i in rows]
+
+    def status_line(self, i):
+        '''The status string of row i, as Monster.status() would give'''
+        hp, max_hp = self.hp[i], self.max_hp[i]
+        return '{}: ({}/{})hp {}{}'.format(
+            self.names[i], hp, max_hp,
+            '(bloodied)' if max_hp // 2 >= hp else '',
+            self.effects.get(i, ''))
+
+    def status_lines(self, rows=None):
+        '''Status strings for `rows` (or every active row)'''
+        rows = self.active() if rows is None else rows
+        return map(self.status_line, rows)
+
+
+class StatusBoard(object):
+    '''Rendered status lines for a CombatantTable, redrawing only the rows
+    that changed'''
+
+    def __init__(self, table):
+        self.table = table
+        self.lines = []
+
+    def refresh(self):
+        '''Re-renders the rows changed since the last refresh and returns
+        their row numbers'''
+        table, lines = self.table, self.lines
+        if len(lines) < len(table):
+            lines.extend([None] * (len(table) - len(lines)))
+        changed = sorted(table.dirty)
+        table.dirty.clear()
+        render = table.status_line
+        for i in changed:
+            lines[i] = render(i)
+        return changed
+
+    def iter_lines(self, changed_only=False):
+        '''Status lines of active rows, or just of those that changed since
+        the last refresh'''
+        changed = self.refresh()
+        rows = changed if changed_only else xrange(len(self.lines))
+        flags, lines = self.table.flags, self.lines
+        for i in rows:
+            if not flags[i] & REMOVED:
+                yield lines[i]
+
+    def draw(self, out=None, changed_only=False):
+        '''Writes status lines to `out` one at a time'''
+        out = out or sys.stdout
+        for line in self.iter_lines(changed_only):
+            out.write(line)
+            out.write('\n')
@@ -4,9 +4,6 @@ import models as M
 
 import logging
 
-logging.getLogger('sqlalchemy.engine').setLevel(logging.INFO)
-logging.basicConfig()
-
 
 def setup_db(db_filename):
     '''Creates and populates the sqlite database. Nothing will be done if it
@@ -629,8 +626,11 @@ def initialize_database(session):
 
 def get_session(db_name):
     '''Easily obtains a session'''
+    import derived
     engine = setup_db(db_name)
-    return sessionmaker(bind=engine)()
+    session = sessionmaker(bind=engine)()
+    derived.track(session)
+    return session
 
 
 def main(filename):
@@ -640,4 +640,6 @@ def main(filename):
 
 
 if __name__ == '__main__':
+    logging.basicConfig()
+    logging.getLogger('sqlalchemy.engine').setLevel(logging.INFO)
     main('test1.db')
@@ -0,0 +1,216 @@
+'''Keeps each character's final numbers in the database for reports.
+
+The character_stats table holds the abilities, defenses, speed, initiative
+and healing surges that stacking works out for every character. The
+character_skill_stats table holds their skill totals. Both are indexed, so
+a report like "every character with Reflex 20 or better" is one SQL query
+that never builds a Character:
+
+    characters_with(session, M.character_stats.c.reflex >= 20)
+
+`populate` fills both tables in one go. After that, a session passed to
+`track` keeps them current as part of every flush. The flush's changes to
+characters, races, classes (and so class_effect), armor, effects and stats
+are used to find the characters affected, and only their rows are
+rewritten. Writes that go around the ORM aren't seen, so run `populate`
+again after those.
+
+    python derived.py DATABASE
+'''
+from __future__ import print_function
+import sys
+from itertools import chain
+
+from sqlalchemy import and_, bindparam, event, inspect, or_, select
+from sqlalchemy.orm import joinedload, selectinload, sessionmaker
+
+import models as M
+import stacking
+from create_db import setup_db
+
+CHUNK_SIZE = 500  # names per IN (...), well under SQLite's variable limit
+
+character_table = M.Character.__table__
+character_stats = M.character_stats
+character_skill_stats = M.character_skill_stats
+
+_insert_stats = character_stats.insert()
+_insert_skills = character_skill_stats.insert()
+_delete_stats = character_stats.delete().where(
+    character_stats.c.charactername == bindparam('b_name'))
+_delete_skills = character_skill_stats.delete().where(
+    character_skill_stats.c.charactername == bindparam('b_name'))
+
+# everything stacking reads, loaded with the characters
+_LOAD = [
+    joinedload(M.Character.race).joinedload(M.Race.effect)
+    .selectinload(M.Effect.skill_stats),
+    joinedload(M.Character.class_).selectinload(M.Class.effects)
+    .selectinload(M.Effect.skill_stats),
+    joinedload(M.Character.armor).selectinload(M.Armor.effect)
+    .selectinload(M.Effect.skill_stats),
+    joinedload(M.Character.armor).joinedload(M.Armor.type),
+]
+
+
+def stat_rows(character, stats):
+    '''The character_stats row and character_skill_stats rows for one
+    character's Stats'''
+    row = {'charactername': character.name, 'speed': stats.speed,
+           'initiative': stats.initiative,
+           'healing_surges': stats.healing_surges}
+    row.update(stats.abilities)
+    row.update(stats.defenses)
+    skills = [{'charactername': character.name, 'skillname': skill,
+               'total': total} for skill, total in stats.skills.iteritems()]
+    return row, skills
+
+
+def _write(session, characters, stale=()):
+    '''Replaces the rows of `characters`, and deletes those of the names in
+    `stale`'''
+    names = [{'b_name': name} for name in
+             set(stale).union(c.name for c in characters)]
+    if names:
+        session.execute(_delete_stats, names)
+        session.execute(_delete_skills, names)
+    rows, skill_rows = [], []
+    skills = session.query(M.Skill).all() if characters else ()
+    for character in characters:
+        stats = stacking.character_stats(character, skills)
+        row, totals = stat_rows(character, stats)
+        rows.append(row)
+        skill_rows.extend(totals)
+    if rows:
+        session.execute(_insert_stats, rows)
+    if skill_rows:
+        session.execute(_insert_skills, skill_rows)
+
+
+def populate(session):
+    '''Rebuilds both tables for every character. Returns how many there
+    were'''
+    session.flush()
+    characters = session.query(M.Character).options(*_LOAD).all()
+    session.execute(character_skill_stats.delete())
+    session.execute(character_stats.delete())
+    _write(session, characters)
+    return len(characters)
+
+
+def _chunks(items):
+    items = sorted(items)
+    for i in xrange(0, len(items), CHUNK_SIZE):
+        yield items[i:i + CHUNK_SIZE]
+
+
+def affected(session):
+    '''What the pending changes in `session` touch: (names of characters
+    whose stats may change, names of characters being deleted)'''
+    names, deleted = set(), set()
+    effects, races, classes, armors, armor_types = (set(), set(), set(),
+                                                    set(), set())
+    everyone = False
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, M.Character):
+            (deleted if obj in session.deleted else names).add(obj.name)
+        elif isinstance(obj, M.Effect):
+            effects.add(obj.name)
+        elif isinstance(obj, M.Stat):
+            history = inspect(obj).attrs.effectname.history
+            effects.update(history.sum())
+        elif isinstance(obj, M.Race):
+            races.add(obj.name)
+        elif isinstance(obj, M.Class):
+            classes.add(obj.name)
+        elif isinstance(obj, M.Armor):
+            armors.add(obj.name)
+        elif isinstance(obj, M.ArmorType):
+            armor_types.add(obj.name)
+        elif isinstance(obj, M.Skill):
+            everyone = True
+    effects.discard(None)
+    c = character_table.c
+    clauses = []
+    if everyone:
+        clauses.append(c.name.isnot(None))
+    if races:
+        clauses.append(c.racename.in_(races))
+    if classes:
+        clauses.append(c.classname.in_(classes))
+    if armors:
+        clauses.append(c.armorname.in_(armors))
+    if armor_types:
+        armor = M.Armor.__table__
+        clauses.append(c.armorname.in_(
+            select([armor.c.name]).where(armor.c.typename.in_(armor_types))))
+    if effects:
+        race, armor_effect = M.Race.__table__, M.armor_effect
+        clauses.extend([
+            c.racename.in_(select([race.c.name]).where(
+                race.c.effectname.in_(effects))),
+            c.classname.in_(select([M.class_effect.c.classname]).where(
+                M.class_effect.c.effectname.in_(effects))),
+            c.armorname.in_(select([armor_effect.c.armorname]).where(
+                armor_effect.c.effectname.in_(effects))),
+        ])
+    if clauses:
+        names.update(name for name, in session.execute(
+            select([c.name]).where(or_(*clauses))))
+    return names - deleted, deleted
+
+
+def refresh(session, names, deleted=()):
+    '''Rewrites the rows of the characters called `names`, and deletes the
+    rows of those in `deleted`'''
+    characters = []
+    for chunk in _chunks(names):
+        characters.extend(session.query(M.Character).options(*_LOAD)
+                          .filter(M.Character.name.in_(chunk)))
+    _write(session, characters, deleted)
+
+
+_FOREIGN_KEYS = (('racename', 'race'), ('classname', 'class_'),
+                 ('armorname', 'armor'))
+
+
+def _after_flush(session, context):
+    for obj in session.dirty:
+        if isinstance(obj, M.Character):
+            # a changed foreign key leaves the relationship it names stale
+            attrs = inspect(obj).attrs
+            stale = [relation for column, relation in _FOREIGN_KEYS
+                     if attrs[column].history.has_changes()]
+            if stale:
+                session.expire(obj, stale)
+    names, deleted = affected(session)
+    if names or deleted:
+        refresh(session, names, deleted)
+
+
+def track(target):
+    '''Keeps the tables current on every flush of a session, or of every
+    session a sessionmaker (or Session class) makes'''
+    if not event.contains(target, 'after_flush', _after_flush):
+        event.listen(target, 'after_flush', _after_flush)
+
+
+def characters_with(session, *conditions):
+    '''Names of the characters whose stored stats meet every condition,
+    in name order'''
+    query = select([character_stats.c.charactername]).where(
+        and_(*conditions))
+    # sorted here: ORDER BY would lead SQLite to walk the primary key
+    return sorted(name for name, in session.execute(query))
+
+
+def main(db_filename):
+    session = sessionmaker(bind=setup_db(db_filename))()
+    print('{} characters'.format(populate(session)))
+    session.commit()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        sys.exit('Usage: derived.py DATABASE')
+    main(sys.argv[1])
@@ -0,0 +1,231 @@
+'''Dice expressions like "3d6+2", "2d20kh1" or "4d6dl1".
+
+Expressions are compiled once into a DicePlan and cached, so rolling the same
+expression repeatedly (or thousands of times at once with `roll_many`) only
+pays for the random draws.
+'''
+import random as r
+import re
+import operator
+import hashlib
+import os
+from array import array
+
+_TERM_RE = re.compile(r'''
+    (?P<sign>[+-])?
+    (?:
+        (?P<count>\d*)d(?P<sides>\d+)
+        (?:(?P<mode>kh|kl|dh|dl)(?P<amount>\d+))?
+      |
+        (?P<constant>\d+)
+    )''', re.VERBOSE)
+
+_MAX_CACHED_PLANS = 1024
+_plans = {}
+
+
+class RNG(r.Random):
+    '''A seedable random stream that can be split into independent child
+    streams. Give one to each Session, Encounter or worker process so their
+    rolls don't interfere and a run can be replayed from its seed.'''
+
+    def __init__(self, seed=None):
+        if seed is None:
+            seed = int(os.urandom(8).encode('hex'), 16)
+        self.seed_value = seed
+        self.children = 0
+        super(RNG, self).__init__(seed)
+
+    def __repr__(self):
+        return 'RNG({!r})'.format(self.seed_value)
+
+    def __reduce__(self):
+        return (self.__class__, (self.seed_value,),
+                (self.getstate(), self.children))
+
+    def __setstate__(self, state):
+        random_state, self.children = state
+        self.setstate(random_state)
+
+    def state(self):
+        '''The seed, child count and generator state as plain lists'''
+        version, internal, gauss = self.getstate()
+        return [self.seed_value, self.children,
+                [version, list(internal), gauss]]
+
+    @classmethod
+    def from_state(cls, state):
+        '''Rebuilds a stream from `state()`'''
+        seed, children, (version, internal, gauss) = state
+        rng = cls(seed)
+        rng.children = children
+        rng.setstate((version, tuple(internal), gauss))
+        return rng
+
+    def split(self):
+        '''Creates the next child stream. Children depend only on the
+        parent's seed and how many children came before, not on how many
+        numbers the parent has drawn.'''
+        key = '{!r}:{}'.format(self.seed_value, self.children)
+        self.children += 1
+        return RNG(int(hashlib.sha256(key).hexdigest()[:16], 16))
+
+    def die(self, sides):
+        '''Rolls one die'''
+        return int(self.random() * sides) + 1
+
+    def dice(self, sides, times):
+        '''Rolls `times` dice at once, returning an array'''
+        rand = self.random
+        return array('l', [int(rand() * sides) + 1 for _ in xrange(times)])
+
+
+default_rng = RNG()
+
+
+class DiceTerm(object):
+    '''A group of identical dice, optionally keeping or dropping some'''
+
+    def __init__(self, count, sides, mode=None, amount=None, sign=1):
+        if count < 1:
+            raise ValueError('Must roll at least one die')
+        if sides < 1:
+            raise ValueError('Dice must have at least one side')
+        self.count = count
+        self.sides = sides
+        self.mode = mode
+        self.amount = amount
+        self.sign = sign
+        self.kept = self._kept_slice()
+
+    def _kept_slice(self):
+        '''Slice of the sorted dice that count towards the total'''
+        if self.mode is None:
+            return None
+        count, amount = self.count, self.amount
+        if not 0 < amount <= count or \
+                (self.mode in ('dh', 'dl') and amount == count):
+            raise ValueError('Cannot {} {} of {} dice'.format(
+                self.mode, amount, count))
+        return {
+            'kh': slice(count - amount, None),
+            'kl': slice(0, amount),
+            'dh': slice(0, count - amount),
+            'dl': slice(amount, None),
+        }[self.mode]
+
+    @property
+    def kept_count(self):
+        '''How many dice count towards the total'''
+        if self.mode in ('kh', 'kl'):
+            return self.amount
+        return self.count - (self.amount or 0)
+
+    def __repr__(self):
+        tail = '{}{}'.format(self.mode, self.amount) if self.mode else ''
+        return '{}{}d{}{}'.format('-' if self.sign < 0 else '+',
+                                  self.count, self.sides, tail)
+
+    def total(self, rng):
+        '''Rolls this term once'''
+        rand, sides = rng.random, self.sides
+        draws = [int(rand() * sides) + 1 for _ in xrange(self.count)]
+        if self.kept is not None:
+            draws = sorted(draws)[self.kept]
+        return self.sign * sum(draws)
+
+    def totals(self, times, rng):
+        '''Rolls this term `times` times, returning a list of totals'''
+        rand, sides, count = rng.random, self.sides, self.count
+        draws = [int(rand() * sides) + 1 for _ in xrange(count * times)]
+        if count == 1:
+            return draws
+        if self.kept is None:
+            return [sum(draws[i:i + count])
+                    for i in xrange(0, len(draws), count)]
+        kept = self.kept
+        return [sum(sorted(draws[i:i + count])[kept])
+                for i in xrange(0, len(draws), count)]
+
+
+class DicePlan(object):
+    '''A compiled dice expression'''
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.terms = []
+        self.constant = 0
+        self._parse(expression.replace(' ', '').lower())
+
+    def _parse(self, text):
+        pos = 0
+        while pos < len(text):
+            match = _TERM_RE.match(text, pos)
+            if match is None or match.end() == pos or \
+                    (pos > 0 and match.group('sign') is None):
+                raise ValueError('Invalid dice expression: {!r}'.format(
+                    self.expression))
+            pos = match.end()
+            sign = -1 if match.group('sign') == '-' else 1
+            if match.group('constant') is not None:
+                self.constant += sign * int(match.group('constant'))
+            else:
+                self.terms.append(DiceTerm(
+                    int(match.group('count') or 1),
+                    int(match.group('sides')),
+                    match.group('mode'),
+                    int(match.group('amount') or 0) or None,
+                    sign))
+        if not text:
+            raise ValueError('Empty dice expression')
+
+    def __repr__(self):
+        return 'DicePlan({!r})'.format(self.expression)
+
+    @property
+    def minimum(self):
+        return self.constant + sum(
+            t.kept_count * (1 if t.sign > 0 else -t.sides)
+            for t in self.terms)
+
+    @property
+    def maximum(self):
+        return self.constant + sum(
+            t.kept_count * (t.sides if t.sign > 0 else -1)
+            for t in self.terms)
+
+    def roll(self, rng=None):
+        '''Rolls the expression once'''
+        rng = rng or default_rng
+        return self.constant + sum(term.total(rng) for term in self.terms)
+
+    def roll_many(self, times, rng=None):
+        '''Rolls the expression `times` times in one pass, returning an
+        array of totals'''
+        rng = rng or default_rng
+        totals = [self.constant] * times
+        for term in self.terms:
+            combine = operator.add if term.sign > 0 else operator.sub
+            totals = map(combine, totals, term.totals(times, rng))
+        return array('l', totals)
+
+
+def compile_dice(expression):
+    '''Gets the cached DicePlan for an expression'''
+    try:
+        return _plans[expression]
+    except KeyError:
+        if len(_plans) >= _MAX_CACHED_PLANS:
+            _plans.clear()
+        plan = _plans[expression] = DicePlan(expression)
+        return plan
+
+
+def roll(expression, rng=None):
+    '''Rolls a dice expression once'''
+    return compile_dice(expression).roll(rng)
+
+
+def roll_many(expression, times, rng=None):
+    '''Rolls a dice expression `times` times, returning an array'''
+    return compile_dice(expression).roll_many(times, rng)
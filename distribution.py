@@ -0,0 +1,207 @@
+'''Exact probability distributions for dice expressions.
+
+Distributions are stored as integer counts of the ways each total can come
+up, so convolution is exact and probabilities are returned as Fractions.
+Per-die, per-group and per-expression distributions are memoized, so asking
+the same question twice costs a lookup.
+'''
+from bisect import bisect_left
+from fractions import Fraction
+from itertools import combinations_with_replacement
+from math import factorial
+
+from dice import compile_dice
+
+_MAX_KEEP_OUTCOMES = 2000000
+
+_dice = {}
+_kept = {}
+_expressions = {}
+
+
+class Distribution(object):
+    '''Exact distribution of an integer total'''
+
+    def __init__(self, minimum, ways):
+        self.minimum = minimum
+        self.ways = tuple(ways)
+        self.outcomes = sum(self.ways)
+        self._cumulative = None
+
+    @property
+    def maximum(self):
+        return self.minimum + len(self.ways) - 1
+
+    def __repr__(self):
+        return 'Distribution({}..{}, mean={:.3f})'.format(
+            self.minimum, self.maximum, float(self.mean))
+
+    def __add__(self, other):
+        if isinstance(other, (int, long)):
+            return Distribution(self.minimum + other, self.ways)
+        ways = [0] * (len(self.ways) + len(other.ways) - 1)
+        for i, a in enumerate(self.ways):
+            if a:
+                for j, b in enumerate(other.ways):
+                    ways[i + j] += a * b
+        return Distribution(self.minimum + other.minimum, ways)
+
+    __radd__ = __add__
+
+    def __neg__(self):
+        return Distribution(-self.maximum, reversed(self.ways))
+
+    def __sub__(self, other):
+        return self + -other
+
+    @property
+    def cumulative(self):
+        '''Running totals of `ways`, built on first use'''
+        if self._cumulative is None:
+            running, cumulative = 0, []
+            for count in self.ways:
+                running += count
+                cumulative.append(running)
+            self._cumulative = cumulative
+        return self._cumulative
+
+    def pmf(self, total):
+        '''P(X == total)'''
+        if not self.minimum <= total <= self.maximum:
+            return Fraction(0)
+        return Fraction(self.ways[total - self.minimum], self.outcomes)
+
+    def cdf(self, total):
+        '''P(X <= total)'''
+        if total < self.minimum:
+            return Fraction(0)
+        if total >= self.maximum:
+            return Fraction(1)
+        return Fraction(self.cumulative[total - self.minimum], self.outcomes)
+
+    def at_least(self, total):
+        '''P(X >= total)'''
+        return 1 - self.cdf(total - 1)
+
+    def quantile(self, q):
+        '''Smallest total t such that P(X <= t) >= q'''
+        if not 0 <= q <= 1:
+            raise ValueError('Quantile must be between 0 and 1')
+        target = Fraction(q) * self.outcomes
+        index = bisect_left(self.cumulative, target)
+        return self.minimum + min(index, len(self.ways) - 1)
+
+    def expectation(self, func=None):
+        '''E[func(X)], or E[X] if no function is given'''
+        func = func or (lambda total: total)
+        return sum((Fraction(count) * func(self.minimum + i)
+                    for i, count in enumerate(self.ways) if count),
+                   Fraction(0)) / self.outcomes
+
+    @property
+    def mean(self):
+        return self.expectation()
+
+    @property
+    def variance(self):
+        mean = self.mean
+        return self.expectation(lambda total: (total - mean) ** 2)
+
+    def median(self):
+        return self.quantile(Fraction(1, 2))
+
+
+def die(sides):
+    '''Distribution of a single die'''
+    return dice(1, sides)
+
+
+def dice(count, sides):
+    '''Distribution of the sum of `count` dice with `sides` sides'''
+    key = (count, sides)
+    try:
+        return _dice[key]
+    except KeyError:
+        pass
+    if count < 1 or sides < 1:
+        raise ValueError('Need at least one die with at least one side')
+    if count == 1:
+        result = Distribution(1, [1] * sides)
+    else:
+        half = count // 2
+        result = dice(half, sides) + dice(count - half, sides)
+    _dice[key] = result
+    return result
+
+
+def kept_dice(count, sides, mode, amount):
+    '''Distribution of `count` dice keeping/dropping `amount` of them (kh,
+    kl, dh or dl)'''
+    key = (count, sides, mode, amount)
+    try:
+        return _kept[key]
+    except KeyError:
+        pass
+    term = compile_dice('{}d{}{}{}'.format(count, sides, mode, amount))
+    kept = term.terms[0].kept
+    faces = range(1, sides + 1)
+    if _multisets(count, sides) > _MAX_KEEP_OUTCOMES:
+        raise ValueError('Too many outcomes to enumerate {}d{}{}{}'.format(
+            count, sides, mode, amount))
+    counts = {}
+    for roll in combinations_with_replacement(faces, count):
+        total = sum(roll[kept])
+        counts[total] = counts.get(total, 0) + _arrangements(roll)
+    low = min(counts)
+    result = Distribution(
+        low, [counts.get(t, 0) for t in xrange(low, max(counts) + 1)])
+    _kept[key] = result
+    return result
+
+
+def _multisets(count, sides):
+    '''Number of sorted rolls of `count` dice'''
+    return factorial(count + sides - 1) // (
+        factorial(count) * factorial(sides - 1))
+
+
+def _arrangements(roll):
+    '''Number of ordered rolls that sort to `roll`'''
+    result = factorial(len(roll))
+    run = 1
+    for previous, face in zip(roll, roll[1:]):
+        if face == previous:
+            run += 1
+            result //= run
+        else:
+            run = 1
+    return result
+
+
+def distribution(expression):
+    '''Exact distribution of a dice expression such as "2d8+5"'''
+    try:
+        return _expressions[expression]
+    except KeyError:
+        pass
+    plan = compile_dice(expression)
+    result = Distribution(plan.constant, [1])
+    for term in plan.terms:
+        if term.mode is None:
+            part = dice(term.count, term.sides)
+        else:
+            part = kept_dice(term.count, term.sides, term.mode, term.amount)
+        result = result + part if term.sign > 0 else result - part
+    _expressions[expression] = result
+    return result
+
+
+def for_dice(dice_row, count=1):
+    '''Distribution of `count` of a `models.Dice` row'''
+    return dice(count, dice_row.sides)
+
+
+def weapon_damage(weapon, bonus=0):
+    '''Distribution of a `models.Weapon`'s damage roll (dmg_mult dice of its
+    die type) plus a flat bonus'''
+    return for_dice(weapon.dice, weapon.dmg_mult or 1) + bonus
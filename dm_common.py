@@ -1,24 +1,157 @@
-import random as r
+import re
 import readline
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from fnmatch import fnmatchcase
+
+from dice import compile_dice, default_rng
+
+_GLOB_CHARS = re.compile(r'[*?\[]')
+
+# 4e conditions, each with a bit in EffectSet.conditions
+CONDITIONS = ('blinded', 'dazed', 'deafened', 'dominated', 'dying',
+              'grabbed', 'helpless', 'immobilized', 'marked', 'petrified',
+              'prone', 'removed from play', 'restrained', 'slowed',
+              'stunned', 'surprised', 'unconscious', 'weakened')
+CONDITION_BITS = dict((name, 1 << i) for i, name in enumerate(CONDITIONS))
+
+_NO_COUNTS = OrderedDict()  # shared until the first effect is added
+
+
+class EffectSet(object):
+    "Counted effects on one character, with where they came from"
+    def __init__(self, owner=None, watcher=None):
+        self.counts = _NO_COUNTS  # effect -> how many times it applies
+        self.details = {}  # effect -> [(source, duration)] per application
+        self.conditions = 0
+        self.owner = owner
+        self.watcher = watcher
+
+    def __len__(self):
+        return sum(self.counts.itervalues())
+
+    def __nonzero__(self):
+        return bool(self.counts)
+
+    def __contains__(self, effect):
+        return effect in self.counts
+
+    def __iter__(self):
+        "Each distinct effect once, oldest first"
+        return iter(self.counts)
+
+    def count(self, effect):
+        return self.counts.get(effect, 0)
+
+    def add(self, effect, source=None, duration=None):
+        "Applies an effect once more"
+        if type(effect) is str:
+            effect = intern(effect)
+        if self.counts is _NO_COUNTS:
+            self.counts = OrderedDict()
+        count = self.counts.get(effect, 0)
+        self.counts[effect] = count + 1
+        self.details.setdefault(effect, []).append((source, duration))
+        if not count:
+            self.conditions |= CONDITION_BITS.get(effect.lower(), 0)
+            if self.watcher is not None:
+                self.watcher.add(effect, self.owner)
+
+    def remove(self, effect):
+        "Takes away one application of an effect, the newest first"
+        count = self.counts.get(effect)
+        if not count:
+            raise ValueError('Not affected by {}'.format(effect))
+        self.details[effect].pop()
+        if count > 1:
+            self.counts[effect] = count - 1
+            return
+        del self.counts[effect]
+        del self.details[effect]
+        self.conditions &= ~CONDITION_BITS.get(effect.lower(), 0)
+        if self.watcher is not None:
+            self.watcher.remove(effect, self.owner)
+
+    def has_condition(self, condition):
+        "Bit test for one of the standard CONDITIONS"
+        return bool(self.conditions & CONDITION_BITS[condition])
+
+    def watch(self, watcher, owner):
+        "Reports this character's effects to an EffectIndex from now on"
+        if self.watcher is not None and self.watcher is not watcher:
+            self.watcher.forget(self.owner, self.counts)
+        self.watcher, self.owner = watcher, owner
+        for effect in self.counts:
+            watcher.add(effect, owner)
+
+    def state(self, ref):
+        "Plain data for the effects, naming sources with ref(source)"
+        return [[effect, [[ref(source), duration]
+                          for source, duration in self.details[effect]]]
+                for effect in self.counts]
+
+    def labels(self):
+        "Effect names for display, with a count where one stacks"
+        return [effect if count == 1 else '{} x{}'.format(effect, count)
+                for effect, count in self.counts.iteritems()]
+
+    def __str__(self):
+        return '[' + ']['.join(self.labels()) + ']' if self.counts else ''
+
+
+class EffectIndex(object):
+    """Which characters currently have each effect. Effect names are
+    matched ignoring case, like the condition bits, so "Dazed" and "dazed"
+    are one entry"""
+    def __init__(self):
+        self.by_effect = {}  # lowercased effect -> characters
+        self.spellings = {}  # (lowercased effect, character) -> count
+
+    def __getitem__(self, effect):
+        return self.by_effect.get(effect.lower(), frozenset())
+
+    def add(self, effect, character):
+        key = effect.lower()
+        self.by_effect.setdefault(key, set()).add(character)
+        self.spellings[key, character] = \
+            self.spellings.get((key, character), 0) + 1
+
+    def remove(self, effect, character):
+        key = effect.lower()
+        count = self.spellings.pop((key, character), 0)
+        if count > 1:  # still has the effect spelled another way
+            self.spellings[key, character] = count - 1
+            return
+        characters = self.by_effect.get(key)
+        if characters is None:
+            return
+        characters.discard(character)
+        if not characters:
+            del self.by_effect[key]
+
+    def forget(self, character, effects):
+        "Drops a character from every effect it is listed under"
+        for effect in list(effects):
+            self.remove(effect, character)
 
 
 class Character(object):
     def __init__(self, name, init_mod=0, max_hp=0):
         self.name = name
         self.init_mod = init_mod
-        self.effects = []
+        self.effects = EffectSet(self)
         self.max_hp = max_hp
         self.hp = max_hp
 
     @property
     def json(self):
-        output = {
-            'name': self.name,
-            'init_mod': self.init_mod,
-            'effects': [e.json for e in self.effects],
-            'max_hp': self.max_hp,
-            'hp': self.hp,
-        }
+        "The character as a JSON-ready dict (see codec)"
+        return codec.to_dict(self)
+
+    @classmethod
+    def from_json(cls, data):
+        "Rebuilds a character from its `json`"
+        return codec.from_dict(cls, data)
 
     def damage(self, dmg):
         "Simulates damage to monster"
@@ -55,41 +188,39 @@ class Character(object):
 
     def status(self):
         "Returns a string of the current status"
-        return self.name + ": (" + str(self.hp) + "/"\
-            + str(self.max_hp) + ")hp "\
-            + ('(' + self.life_status() + ')' if self.life_status() else "")\
-            + ("[" + "][".join(self.effects) + "]" if self.effects else "")
+        life_status = self.life_status()
+        return "{}: ({}/{})hp {}{}".format(
+            self.name, self.hp, self.max_hp,
+            "(" + life_status + ")" if life_status else "", self.effects)
 
     def __repr__(self):
         return self.name
 
-    def affect(self, effect):
+    def affect(self, effect, source=None, duration=None):
         "Adds a status effect string"
-        self.effects.append(effect)
-    
+        self.effects.add(effect, source, duration)
+
     def defect(self, effect):
         "Removes a status effect string"
         self.effects.remove(effect)
-    
+
+    def has_condition(self, condition):
+        "Whether one of the standard CONDITIONS applies"
+        return self.effects.has_condition(condition)
+
 
 class PlayerCharacter(Character):
     def __init__(self, *args, **kwargs):
         self.playername = kwargs.pop('playername', None)
         super(PlayerCharacter, self).__init__(*args, **kwargs)
 
-    @property
-    def json(self):
-        parent = super(PlayerCharacter, self).json
-        parent['playername'] = self.playername
-        return parent
-
 
 class Monster(Character):
     '''A Monster'''
 
     def __init__(self, *args, **kwargs):
         self.encounter = kwargs.pop('encounter', None)
-        super(Monster, self).__init__()
+        super(Monster, self).__init__(*args, **kwargs)
 
     @property
     def dying(self):
@@ -103,43 +234,183 @@ class Monster(Character):
     def dead(self):
         return self.hp <= 0
 
+
+class NameIndex(object):
+    "Looks things up by exact name, name prefix or glob"
+    def __init__(self):
+        self.by_name = {}
+        self.names = []  # kept sorted, may repeat
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.by_name
+
+    def __iter__(self):
+        for name in self.unique(self.names):
+            for item in self.by_name[name]:
+                yield item
+
+    def add(self, name, item):
+        "Indexes an item under a name"
+        self.by_name.setdefault(name, []).append(item)
+        insort(self.names, name)
+
+    def update(self, pairs):
+        "Indexes many (name, item) pairs, sorting once"
+        for name, item in pairs:
+            self.by_name.setdefault(name, []).append(item)
+            self.names.append(name)
+        self.names.sort()
+
+    def remove(self, name, item):
+        "Removes an item from the index"
+        items = self.by_name.get(name, [])
+        if item not in items:
+            return
+        items.remove(item)
+        if not items:
+            del self.by_name[name]
+        del self.names[bisect_left(self.names, name)]
+
+    def get(self, name):
+        "The first item with exactly this name"
+        return self.by_name[name][0]
+
+    def prefixed(self, prefix):
+        "Sorted names starting with prefix"
+        names = self.names
+        if not prefix:
+            return names[:]
+        start = end = bisect_left(names, prefix)
+        while end < len(names) and names[end].startswith(prefix):
+            end += 1
+        return names[start:end]
+
+    def matching(self, pattern):
+        "Items whose names match a glob pattern like 'Goblin *'"
+        if pattern in self.by_name:
+            return self.by_name[pattern][:]
+        literal = _GLOB_CHARS.split(pattern, 1)[0]
+        if literal == pattern:
+            return []
+        return [item
+                for name in self.unique(self.prefixed(literal))
+                if fnmatchcase(name, pattern)
+                for item in self.by_name[name]]
+
+    @staticmethod
+    def unique(names):
+        "Drops repeats from a sorted list of names"
+        last = None
+        for name in names:
+            if name != last:
+                yield name
+                last = name
+
+
 class Completer(object):
     "This keeps a list of the possible keywords for autocompletion"
+    _indexes = {}  # option set -> NameIndex, so unchanged sets aren't rebuilt
+    _max_cached = 64
+
     def __init__(self, options):
-        self.options = sorted(options)
+        if isinstance(options, NameIndex):
+            self.index = options
+        else:
+            self.index = self.index_for(options)
         self.matches = []
 
+    @classmethod
+    def index_for(cls, options):
+        "The cached NameIndex for a set of options"
+        key = frozenset(options)
+        try:
+            return cls._indexes[key]
+        except KeyError:
+            if len(cls._indexes) >= cls._max_cached:
+                cls._indexes.clear()
+            index = cls._indexes[key] = NameIndex()
+            index.update((option, option) for option in key if option)
+            return index
+
+    @property
+    def options(self):
+        return list(NameIndex.unique(self.index.names))
+
     def __enter__(self):
         self.old_completer = readline.get_completer()
+        self.old_delims = readline.get_completer_delims()
         readline.parse_and_bind("tab: complete")
+        # complete against the whole line so multi-word names work
+        readline.set_completer_delims('')
         readline.set_completer(self.complete)
 
     def __exit__(self, *args, **kwargs):
         readline.set_completer(self.old_completer)
-        
+        readline.set_completer_delims(self.old_delims)
+
     def complete(self, text, state):
         "This is called by the readline module"
         response = None
         if state == 0:
-            if text:
-                self.matches = [s
-                                for s in self.options
-                                if s and s.startswith(text)]
-            else:
-                self.matches = self.options[:]
+            self.matches = list(NameIndex.unique(self.index.prefixed(text)))
         try:
             response = self.matches[state]
         except IndexError:
             response = None
-        return response  
+        return response
+
+
+def argument_start(line, endidx):
+    "Where the argument being completed begins, allowing for an open quote"
+    quote, start = None, 0
+    for i, char in enumerate(line[:endidx]):
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in '"\'':
+            quote, start = char, i + 1
+        elif char.isspace():
+            start = i + 1
+    return start
+
+
+def complete_argument(indexes, line, begidx, endidx, start=None,
+                      quote=False):
+    """Completions for a possibly multi-word or quoted argument, for use in
+    cmd.Cmd complete_* methods. The argument runs from `start` (by default
+    the last space or open quote) to endidx. readline only replaces the text
+    from begidx, so matches are trimmed to start there. With `quote`,
+    unquoted matches containing spaces are quoted for shlex"""
+    if start is None:
+        start = argument_start(line, endidx)
+    prefix = line[start:endidx]
+    offset = begidx - start
+    if offset < 0:
+        return []
+    matches = set()
+    for index in indexes:
+        if not isinstance(index, NameIndex):
+            index = Completer.index_for(index)
+        matches.update(index.prefixed(prefix))
+    quoted = start > 0 and line[start - 1] in '"\''
+    if quote and not quoted:
+        return sorted('"{}"'.format(name) if ' ' in name else name
+                      for name in matches)
+    return sorted(name[offset:] for name in matches)
+
 
 class Commandline(object):
     "A command line useful for different scripts"
     def __init__(self, command_dict):
         self.commands = command_dict
-        
+        self.completer = Completer(self.commands.keys() + ['exit','help'])
+
     def reset_completer(self):
-        Completer(self.commands.keys() + ['exit','help'])
+        readline.parse_and_bind("tab: complete")
+        readline.set_completer(self.completer.complete)
 
     def loop(self):
         "Call this to start the command loop"
@@ -211,37 +482,39 @@ def letterer(num):
         
 # Dice rolls
 
-def d20():
+def d20(rng=None):
     "Simulates a d20 roll"
-    return r.randint(1,20)
+    return int((rng or default_rng).random() * 20) + 1
 
-def d12():
+def d12(rng=None):
     "Simulates a d12 roll"
-    return r.randint(1,12)
+    return int((rng or default_rng).random() * 12) + 1
 
-def d10():
+def d10(rng=None):
     "Simulates a d10 roll"
-    return r.randint(1,10)
+    return int((rng or default_rng).random() * 10) + 1
 
-def d8():
+def d8(rng=None):
     "Simulates a d8 roll"
-    return r.randint(1,8)
+    return int((rng or default_rng).random() * 8) + 1
 
-def d6():
+def d6(rng=None):
     "Simulates a d6 roll"
-    return r.randint(1,6)
+    return int((rng or default_rng).random() * 6) + 1
 
-def d4():
+def d4(rng=None):
     "Simulates a d4 roll"
-    return r.randint(1,4)
+    return int((rng or default_rng).random() * 4) + 1
 
-def d2():
+def d2(rng=None):
     "Simulates a d2 roll"
-    return r.randint(1,2)
+    return int((rng or default_rng).random() * 2) + 1
 
-def ability_rolls():
-    rolls = [sum(sorted(r.randint(1, 6)
-                        for _ in xrange(4))[1:])
-                        for _x in xrange(6)]
+def ability_rolls(rng=None):
+    rolls = list(compile_dice('4d6dl1').roll_many(6, rng))
     avg = sum(rolls) / float(len(rolls))
     return rolls, avg
+
+
+# last, as codec compiles its serializers from the classes above
+import codec
@@ -0,0 +1,150 @@
+'''Timed status effects and the queue that expires them.
+
+Expiry times are keyed on (round, initiative slot, start/end of turn), which
+sorts the same way the encounter plays out. Advancing the turn only pops the
+entries at the front of the heap that are due, however many effects are
+still running.
+
+Each timed entry remembers the combatant whose slot it is anchored to, so
+when the initiative order is rerolled or someone resumes into a new slot,
+`rekey` moves the expiry along with them.
+'''
+from collections import namedtuple
+from heapq import heapify, heappush, heappop
+from itertools import count
+
+START, END = 0, 1
+
+SAVE_ENDS = 'save ends'
+END_OF_TURN = 'end of turn'
+END_OF_NEXT_TURN = 'end of next turn'
+START_OF_NEXT_TURN = 'start of next turn'
+ROUNDS = 'rounds'
+
+# shorthand accepted on the command line
+DURATIONS = {
+    'save': SAVE_ENDS,
+    'se': SAVE_ENDS,
+    'eot': END_OF_TURN,
+    'eont': END_OF_NEXT_TURN,
+    'sont': START_OF_NEXT_TURN,
+}
+
+TimedEffect = namedtuple('TimedEffect', 'name target source duration due')
+
+
+class EffectQueue(object):
+    '''Running effects, ordered by when they expire'''
+
+    def __init__(self):
+        self._heap = []
+        self._sequence = count()
+        self._save_ends = {}
+
+    def __len__(self):
+        return len(self._heap) + sum(len(v) for v in self._save_ends.values())
+
+    def add(self, effect, anchor=None):
+        '''Starts tracking an effect. Effects without a due time last until
+        the target saves. `anchor` is the combatant in the due time's slot'''
+        if effect.due is None:
+            self._save_ends.setdefault(effect.target, []).append(effect)
+        else:
+            heappush(self._heap,
+                     (effect.due, next(self._sequence), effect, anchor))
+
+    def pop_due(self, round, slot, phase):
+        '''Removes and returns every effect due by this point in the
+        encounter'''
+        now = (round, slot, phase)
+        heap, due = self._heap, []
+        while heap and heap[0][0] <= now:
+            due.append(heappop(heap)[2])
+        return due
+
+    def rekey(self, key_of):
+        '''Moves timed effects to their anchor's current slot, as given by
+        key_of(anchor). Anchors it gives None for keep their old slot'''
+        entries = []
+        for due, sequence, effect, anchor in self._heap:
+            key = key_of(anchor) if anchor is not None else None
+            if key is not None and key != due[1]:
+                due = (due[0], key, due[2])
+                effect = effect._replace(due=due)
+            entries.append((due, sequence, effect, anchor))
+        heapify(entries)
+        self._heap = entries
+
+    def forget(self, target):
+        '''Stops tracking every effect on `target`, e.g. because it died
+        or left the encounter'''
+        self._save_ends.pop(target, None)
+        heap = [entry for entry in self._heap if entry[2].target is not target]
+        if len(heap) != len(self._heap):
+            heapify(heap)
+            self._heap = heap
+
+    def save_ends(self, target):
+        '''Effects on `target` that end on a successful saving throw'''
+        return list(self._save_ends.get(target, ()))
+
+    def saved(self, effect):
+        '''Stops tracking a save-ends effect'''
+        effects = self._save_ends.get(effect.target, [])
+        if effect in effects:
+            effects.remove(effect)
+        if not effects:
+            self._save_ends.pop(effect.target, None)
+
+    def pending(self):
+        '''Every effect still running, timed ones in the order they expire'''
+        effects = [entry[2] for entry in sorted(self._heap)]
+        for target_effects in self._save_ends.itervalues():
+            effects.extend(target_effects)
+        return effects
+
+    def clear(self):
+        del self._heap[:]
+        self._save_ends.clear()
+
+
+def due_time(duration, round, current_slot, anchor_slot, rounds=None):
+    '''When an effect with `duration` expires, as a (round, slot, phase)
+    key. `anchor_slot` is the initiative slot of the combatant whose turn
+    the duration is measured in (usually whoever created the effect).
+    Returns None for save-ends effects.'''
+    if duration == SAVE_ENDS:
+        return None
+    round = max(round, 1)
+    if duration == ROUNDS:
+        if not rounds or rounds < 1:
+            raise ValueError('Need a positive number of rounds')
+        return (round + rounds, current_slot or anchor_slot, START)
+    if current_slot is None:
+        turn_round = round
+        next_round = round
+    else:
+        # anchor's turn still to come this round, or already started
+        turn_round = round if anchor_slot >= current_slot else round + 1
+        next_round = round if anchor_slot > current_slot else round + 1
+    if duration == END_OF_TURN:
+        return (turn_round, anchor_slot, END)
+    if duration == END_OF_NEXT_TURN:
+        return (next_round, anchor_slot, END)
+    if duration == START_OF_NEXT_TURN:
+        return (next_round, anchor_slot, START)
+    raise ValueError('Unknown duration: {}'.format(duration))
+
+
+def parse_duration(text):
+    '''Turns command line shorthand into (duration, rounds). A bare number
+    means that many rounds'''
+    text = text.strip().lower()
+    if text.isdigit():
+        return ROUNDS, int(text)
+    if text in DURATIONS:
+        return DURATIONS[text], None
+    if text in DURATIONS.values():
+        return text, None
+    raise ValueError('Unknown duration "{}". Use save, eot, eont, sont or a '
+                     'number of rounds'.format(text))
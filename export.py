@@ -0,0 +1,139 @@
+'''Exports a models database as JSON lines, one table at a time.
+
+Every row is written as `{"table": ..., "row": Base.json()}` on its own
+line. Before a table is read, the relationships its json will touch are
+worked out from the json plans in models (jsonrelationship and
+jsonassociation_proxy attributes, followed into the classes they lead to).
+Each of them is eager loaded, so a batch of rows costs the same handful of
+queries however many rows it has. Many-to-one relationships are joined,
+collections are loaded with SELECT ... IN. Rows are read in batches and
+written out as they arrive, and the session is cleared after every table,
+so memory stays flat on large databases.
+
+    python export.py DATABASE [OUTPUT]
+'''
+import json
+import sys
+
+from sqlalchemy import inspect
+from sqlalchemy.orm import joinedload, selectinload, sessionmaker
+
+import models as M
+from create_db import setup_db
+
+BATCH_SIZE = 500
+
+_dumps = json.JSONEncoder(separators=(',', ':')).encode
+
+
+def _strategy(relationship):
+    return 'selectinload' if relationship.uselist else 'joinedload'
+
+
+def load_paths(cls, seen=()):
+    '''Every chain of relationships Base.json follows from `cls`, as lists
+    of (class, attribute, strategy)'''
+    seen = seen + (cls,)
+    mapper = inspect(cls)
+    paths = []
+    for attr, kind in M.json_plan(cls):
+        steps, nested = [], True
+        if kind in ('object', 'list'):
+            relationship = mapper.relationships[attr]
+            steps.append((cls, attr, _strategy(relationship)))
+        elif kind == 'any':
+            proxy = mapper.all_orm_descriptors[attr]
+            if not hasattr(proxy, 'target_collection'):
+                continue
+            relationship = mapper.relationships[proxy.target_collection]
+            steps.append((cls, proxy.target_collection,
+                          _strategy(relationship)))
+            target = relationship.mapper
+            nested = proxy.value_attr in target.relationships
+            if nested:  # proxied values are objects with json of their own
+                relationship = target.relationships[proxy.value_attr]
+                steps.append((target.class_, proxy.value_attr,
+                              _strategy(relationship)))
+        else:
+            continue
+        target = relationship.mapper.class_
+        subpaths = load_paths(target, seen) \
+            if nested and target not in seen else []
+        paths.extend(steps + subpath for subpath in subpaths)
+        if not subpaths:
+            paths.append(steps)
+    return paths
+
+
+def load_options(cls):
+    '''Loader options that eager load everything cls.json() reads'''
+    options = []
+    for path in load_paths(cls):
+        option = None
+        for owner, attr, strategy in path:
+            attribute = getattr(owner, attr)
+            if option is None:
+                option = globals()[strategy](attribute)
+            else:
+                option = getattr(option, strategy)(attribute)
+        options.append(option)
+    return options
+
+
+def exported_classes():
+    '''Mapped classes with a table of their own, in table dependency
+    order. Subclasses sharing a table come out through their base'''
+    by_table = {}
+    pending = [M.Base]
+    while pending:
+        cls = pending.pop()
+        pending.extend(cls.__subclasses__())
+        mapper = getattr(cls, '__mapper__', None)
+        if mapper is not None and mapper.inherits is None:
+            by_table[mapper.local_table] = cls
+    return [by_table[table] for table in M.Base.metadata.sorted_tables
+            if table in by_table]
+
+
+def export_table(session, cls, out, batch_size=BATCH_SIZE):
+    '''Writes every row of one mapped class as JSON lines. Returns the
+    number of rows written'''
+    mapper = inspect(cls)
+    table = mapper.local_table.name
+    query = session.query(cls)
+    if mapper.polymorphic_map:  # load every subclass's columns up front
+        query = query.with_polymorphic('*')
+    query = (query.options(*load_options(cls))
+             .order_by(*mapper.primary_key).yield_per(batch_size))
+    count = 0
+    for obj in query:
+        out.write(_dumps({'table': table, 'row': obj.json()}))
+        out.write('\n')
+        count += 1
+    session.expunge_all()
+    return count
+
+
+def export(session, out, classes=None, batch_size=BATCH_SIZE):
+    '''Streams the whole database (or just `classes`) to `out`. Returns
+    {table name: rows written}'''
+    counts = {}
+    for cls in classes or exported_classes():
+        counts[inspect(cls).local_table.name] = export_table(
+            session, cls, out, batch_size)
+    return counts
+
+
+def main(db_filename, output=None):
+    session = sessionmaker(bind=setup_db(db_filename))()
+    if output is None:
+        export(session, sys.stdout)
+    else:
+        with open(output, 'w') as out:
+            export(session, out)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3):
+        sys.exit('Usage: export.py DATABASE [OUTPUT]')
+    main(*sys.argv[1:])
@@ -0,0 +1,297 @@
+'''Undo, redo and what-if branches for an encounter.
+
+A History records versions of an encounter: one frozen state per table row
+(hp, flags, whether it is in the name index, effects and initiative slot)
+plus the turn, the running effects and the players (hp, effects and
+initiative slot or place in the waiting list). Rows are kept in a
+persistent vector, a 32-way trie of tuples where recording a version copies
+only the paths to the rows that changed, so every version shares nearly all
+of its storage with the one before. Moving between versions compares the two
+tries, skipping any node they share, and writes back just the rows that
+differ.
+
+Versions are kept until they no longer fit in a memory budget, oldest first.
+'''
+import sys
+from collections import OrderedDict, namedtuple
+from itertools import count, groupby
+
+from combatants import REMOVED
+
+BITS = 5
+WIDTH = 1 << BITS
+MASK = WIDTH - 1
+
+_MISSING = object()
+
+
+class PVector(object):
+    '''An immutable sequence where `updated` returns a new vector sharing
+    every node the changes do not touch'''
+    __slots__ = ('count', 'shift', 'root')
+
+    def __init__(self, count=0, shift=0, root=()):
+        self.count = count
+        self.shift = shift
+        self.root = root
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        node = self.root
+        for shift in xrange(self.shift, 0, -BITS):
+            node = node[(i >> shift) & MASK]
+        return node[i & MASK]
+
+    def __iter__(self):
+        for i in xrange(self.count):
+            yield self[i]
+
+    def updated(self, changes, created=None):
+        '''A vector with changes[n] = (index, value) applied. Indexes may run
+        on past the end to append, as long as none are skipped. New nodes
+        are appended to `created` if given'''
+        changes = sorted(changes)
+        if not changes:
+            return self
+        size = max(self.count, changes[-1][0] + 1)
+        shift, root = self.shift, self.root
+        while size > WIDTH << shift:
+            root, shift = (root,), shift + BITS
+        root = _update(root, shift, changes, created)
+        return PVector(size, shift, root)
+
+    def diff(self, other):
+        '''Yields (index, value in self, value in other) wherever the two
+        differ, with _MISSING past the end of the shorter one'''
+        a, b = self.root, other.root
+        shift = max(self.shift, other.shift)
+        for _ in xrange(self.shift, shift, BITS):
+            a = (a,)
+        for _ in xrange(other.shift, shift, BITS):
+            b = (b,)
+        return _diff(a, b, shift, 0)
+
+
+def _update(node, shift, changes, created):
+    items = list(node)
+    if shift == 0:
+        for i, value in changes:
+            j = i & MASK
+            if j == len(items):
+                items.append(value)
+            else:
+                items[j] = value
+    else:
+        for j, group in groupby(changes, lambda c: (c[0] >> shift) & MASK):
+            child = node[j] if j < len(node) else ()
+            child = _update(child, shift - BITS, list(group), created)
+            if j == len(items):
+                items.append(child)
+            else:
+                items[j] = child
+    items = tuple(items)
+    if created is not None:
+        created.append(items)
+    return items
+
+
+def _diff(a, b, shift, base):
+    if a is b:
+        return
+    if shift == 0:
+        for j in xrange(max(len(a), len(b))):
+            x = a[j] if j < len(a) else _MISSING
+            y = b[j] if j < len(b) else _MISSING
+            if x is not y and x != y:
+                yield base + j, x, y
+        return
+    for j in xrange(max(len(a), len(b))):
+        for change in _diff(a[j] if j < len(a) else (),
+                            b[j] if j < len(b) else (),
+                            shift - BITS, base + (j << shift)):
+            yield change
+
+
+def frozen(value):
+    '''Lists turned into tuples all the way down'''
+    if isinstance(value, list):
+        return tuple(frozen(item) for item in value)
+    return value
+
+
+# turn: (round, current, tiebreak, running effects, players), players being
+# (hp, effects, initiative slot) for each
+Version = namedtuple('Version', 'seq parent rows turn size')
+
+
+class History(object):
+    '''Versions of one encounter, recorded with `commit` after each command'''
+
+    def __init__(self, encounter, budget=16 << 20):
+        self.encounter = encounter
+        self.budget = budget
+        self.versions = OrderedDict()  # seq -> Version, oldest first
+        self.size = 0
+        self.redo_stack = []
+        self.branch = 'main'
+        self.branches = {}  # tips of the branches not checked out
+        self.all_rows = False
+        self._seq = count()
+        table = encounter.table
+        table.changed.clear()
+        self.current = None
+        self.current = self._record(PVector(), xrange(len(table)))
+        encounter.session.listeners.append(self)
+
+    def append(self, kind, args):
+        '''Notes initiative changes, which don't touch the table (called
+        through Session.emit)'''
+        if not args or args[0] != self.encounter.number:
+            return
+        if kind == 'initiative':
+            self.all_rows = True
+        elif kind in ('delay', 'ready', 'resume'):
+            ref = args[1]
+            if ref[0] == 'm':
+                self.encounter.table.changed.add(ref[2])
+            # a player's slot is part of turn_state, so the next commit
+            # sees that it moved
+
+    def close(self):
+        listeners = self.encounter.session.listeners
+        if self in listeners:
+            listeners.remove(self)
+
+    def row_state(self, row):
+        enc = self.encounter
+        mon = enc.table.rows[row]
+        return (mon.hp, enc.table.flags[row],
+                mon in enc.monster_index.by_name.get(mon.name, ()),
+                frozen(mon.effects.state(enc.session.ref)),
+                enc.initiative_order.slot(mon))
+
+    def turn_state(self):
+        enc = self.encounter
+        ref = enc.session.ref
+        order = enc.initiative_order
+        return (enc.round, order.current, order.tiebreak,
+                tuple(enc.effect_queue.pending()),
+                tuple((p.hp, frozen(p.effects.state(ref)), order.slot(p))
+                      for p in enc.players))
+
+    def commit(self):
+        '''Records a version if anything changed since the last one'''
+        table = self.encounter.table
+        if self.all_rows:
+            rows = xrange(len(table))
+        else:
+            rows = set(table.changed)
+            end = len(self.current.rows)
+            if rows and max(rows) >= end:  # new rows, appended in order
+                rows.update(xrange(end, max(rows)))
+        version = self._record(self.current.rows, rows)
+        if version is not self.current:
+            self.current = version
+            self.redo_stack = []
+
+    def _record(self, previous, rows):
+        turn = self.turn_state()
+        self.encounter.table.changed.clear()
+        self.all_rows = False
+        if not rows and self.current is not None and \
+                turn == self.current.turn:
+            return self.current
+        created = []
+        states = [(row, self.row_state(row)) for row in rows]
+        vector = previous.updated(states, created)
+        size = (sum(sys.getsizeof(node) for node in created) +
+                sum(sys.getsizeof(state) for _, state in states) +
+                sys.getsizeof(turn) + sys.getsizeof(turn[3]))
+        version = Version(next(self._seq),
+                          self.current.seq if self.current else None,
+                          vector, turn, size)
+        self.versions[version.seq] = version
+        self.size += size
+        while self.size > self.budget and len(self.versions) > 1:
+            oldest = next(iter(self.versions.itervalues()))
+            if oldest is version:
+                break
+            del self.versions[oldest.seq]
+            self.size -= oldest.size
+        return version
+
+    def undo(self):
+        '''Goes back a version. Returns False if there is none left'''
+        self.commit()
+        parent = self.versions.get(self.current.parent)
+        if parent is None:
+            return False
+        redo = self.redo_stack + [self.current]
+        self.checkout_version(parent)
+        self.redo_stack = redo
+        return True
+
+    def redo(self):
+        '''Goes forward again after an undo. Returns False if there is
+        nothing to redo'''
+        self.commit()
+        if not self.redo_stack:
+            return False
+        redo = self.redo_stack[:-1]
+        self.checkout_version(self.redo_stack[-1])
+        self.redo_stack = redo
+        return True
+
+    def fork(self, name):
+        '''Starts a new branch from the current version. The branch that was
+        checked out stays where it is until `checkout` returns to it'''
+        if name == self.branch or name in self.branches:
+            raise ValueError('There is already a branch called {}'.format(
+                name))
+        self.commit()
+        self.branches[self.branch] = self.current
+        self.branch = name
+        self.redo_stack = []
+
+    def checkout(self, name):
+        '''Switches to another branch, leaving this one where it is'''
+        if name not in self.branches:
+            raise ValueError('No branch called {}'.format(name))
+        self.commit()
+        version = self.branches.pop(name)
+        self.branches[self.branch] = self.current
+        self.branch = name
+        self.checkout_version(version)
+        self.redo_stack = []
+
+    def checkout_version(self, version):
+        '''Makes the encounter look the way it did at `version`'''
+        self.encounter.restore(self.changes(self.current, version))
+        self.encounter.table.changed.clear()
+        self.all_rows = False
+        self.current = version
+
+    def changes(self, old, new):
+        '''What Encounter.restore needs to get from version `old` to `new`,
+        as plain data'''
+        rows = []
+        for row, state, previous in new.rows.diff(old.rows):
+            if state is _MISSING:  # added after `new`
+                state = (previous[0], previous[1] | REMOVED, False, (), None)
+            rows.append([row] + list(state))
+        round, current, tiebreak, effects, players = new.turn
+        changes = {'rows': rows, 'round': round, 'current': current,
+                   'tiebreak': tiebreak}
+        if effects != old.turn[3]:
+            ref = self.encounter.session.ref
+            changes['effects'] = [
+                [effect.name, ref(effect.target), ref(effect.source),
+                 effect.duration, effect.due] for effect in effects]
+        changes['players'] = [
+            [i] + list(player) for i, (player, previous)
+            in enumerate(zip(players, old.turn[4])) if player != previous]
+        return changes
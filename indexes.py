@@ -0,0 +1,211 @@
+'''Checks that the queries the scripts run are served by indexes.
+
+Each workload below does something the scripts do (lazy loading an
+encounter's players, load_session, working out which characters an effect
+change reaches...) against a small sample database. Every SELECT, UPDATE and
+DELETE it runs is captured and put through SQLite's EXPLAIN QUERY PLAN, and
+any step that scans a whole table instead of searching an index is flagged.
+
+    python indexes.py
+
+prints each query with its plan and exits with status 1 if any query scans
+a table its workload doesn't allow, so a dropped or unusable index shows up
+as a failure.
+'''
+from __future__ import print_function
+import re
+import sys
+from collections import OrderedDict
+
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+
+import models as M
+import create_db
+import derived
+import loaders
+
+SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)')
+
+WORKLOADS = OrderedDict()
+
+
+def workload(*allowed):
+    '''Registers a workload, allowing it to scan the tables named'''
+    def register(func):
+        WORKLOADS[func.__name__] = (func, frozenset(allowed))
+        return func
+    return register
+
+
+def sample_database():
+    '''A session on an in-memory database with the reference tables and a
+    play session of two encounters'''
+    engine = create_db.setup_db(':memory:')
+    session = sessionmaker(bind=engine)()
+    create_db.initialize_database(session)
+    session.add_all([
+        M.Player('Aria', racename='Elf', classname='Rogue',
+                 armorname='Leather Armor'),
+        M.Player('Brom', racename='Dwarf', classname='Fighter',
+                 armorname='Hide Armor'),
+        M.Session('Session 1'),
+    ])
+    session.flush()
+    for i in xrange(2):
+        name = 'Encounter {}'.format(i)
+        session.add(M.Encounter(name, sessionname='Session 1'))
+        session.add(M.NPC('Goblin {}'.format(i)))
+        session.flush()
+        session.execute(M.CharacterEncounter.__table__.insert(), [
+            {'charactername': character, 'encounter_id': name,
+             'init_score': 10 + j, 'position': j}
+            for j, character in enumerate(
+                ['Aria', 'Brom', 'Goblin {}'.format(i)])])
+    derived.populate(session)
+    session.commit()
+    derived.track(session)
+    return session
+
+
+@workload()
+def encounter_members(session):
+    '''Lazy loading an encounter's players, monsters and init order'''
+    enc = session.query(M.Encounter).get('Encounter 0')
+    return enc.players, enc.monsters, enc.init_order
+
+
+@workload()
+def encounters_of_character(session):
+    '''Every encounter a character is in'''
+    return (session.query(M.CharacterEncounter)
+            .filter_by(charactername='Aria').all())
+
+
+@workload()
+def clear_initiative(session):
+    '''persistence.DatabaseWriter replacing an encounter's initiative'''
+    session.execute(M.CharacterEncounter.__table__.delete().where(
+        M.CharacterEncounter.encounter_id == 'Encounter 1'))
+
+
+@workload()
+def load_session(session):
+    '''loaders.load_session at full depth'''
+    return loaders.load_session(session, 'Session 1')
+
+
+@workload()
+def race_details(session):
+    '''A race's patron deity and effect'''
+    race = session.query(M.Race).get('Dwarf')
+    return race.patron_deity, race.effect.stats
+
+
+@workload()
+def stats_by_kind(session):
+    '''Effects granting a skill, language, resistance or proficiency'''
+    return [session.query(M.SkillStat).filter_by(skillname='Stealth').all(),
+            session.query(M.LanguageStat).filter_by(language='Elven').all(),
+            session.query(M.DamageStat)
+            .filter_by(damagetype_name='Fire').all(),
+            session.query(M.ProficiencyStat)
+            .filter_by(weaponcategory_name='Simple Melee').all(),
+            session.query(M.ProficiencyStat)
+            .filter_by(armortype_name='Light').all()]
+
+
+@workload()
+def characters_of(session):
+    '''The characters of a race, class or armor'''
+    return [session.query(M.Character).filter_by(racename='Elf').all(),
+            session.query(M.Character).filter_by(classname='Rogue').all(),
+            session.query(M.Character)
+            .filter_by(armorname='Hide Armor').all()]
+
+
+@workload('skill')
+def effect_change(session):
+    '''derived finding the characters a change to an effect reaches'''
+    for name in ('Elf Racial Benefits', 'Rogue Class Benefits',
+                 "Hide Armor's Effect"):
+        session.query(M.Effect).get(name).speed = 1
+    session.flush()
+
+
+@workload()
+def stat_reports(session):
+    '''Reports on the character_stats tables'''
+    return [derived.characters_with(session,
+                                    M.character_stats.c.reflex >= 20),
+            derived.characters_with(session,
+                                    M.character_stats.c.will < 12),
+            session.execute(M.character_skill_stats.select().where(
+                (M.character_skill_stats.c.skillname == 'Stealth') &
+                (M.character_skill_stats.c.total >= 5))).fetchall()]
+
+
+def capture(session, func):
+    '''The statements func(session) runs, as (sql, parameters), once each'''
+    statements = OrderedDict()
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if executemany:
+            parameters = parameters[0]
+        if statement.lstrip().split(None, 1)[0].upper() in (
+                'SELECT', 'UPDATE', 'DELETE'):
+            statements.setdefault(statement, tuple(parameters))
+
+    event.listen(session.bind, 'before_cursor_execute', record)
+    try:
+        func(session)
+    finally:
+        event.remove(session.bind, 'before_cursor_execute', record)
+    return statements.items()
+
+
+def query_plan(session, statement, parameters):
+    '''EXPLAIN QUERY PLAN's steps for a statement'''
+    cursor = session.connection().connection.cursor()
+    try:
+        cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+        return [row[-1] for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+
+def scans(plan):
+    '''The tables a query plan reads from end to end'''
+    return [match.group(1) for match in map(SCAN.match, plan) if match]
+
+
+def advise(session=None, workloads=None):
+    '''Runs the workloads, returning (workload, statement, plan, scanned
+    tables that aren't allowed) for each query'''
+    session = session or sample_database()
+    results = []
+    for name in workloads or WORKLOADS:
+        func, allowed = WORKLOADS[name]
+        for statement, parameters in capture(session, func):
+            plan = query_plan(session, statement, parameters)
+            bad = [table for table in scans(plan) if table not in allowed]
+            results.append((name, statement, plan, bad))
+        session.rollback()
+    return results
+
+
+def main(argv):
+    results = advise(workloads=argv or None)
+    failures = 0
+    for name, statement, plan, bad in results:
+        print('{}{}: {}'.format('SCAN ' if bad else '', name,
+                                ' '.join(statement.split())))
+        for step in plan:
+            print('    ' + step)
+        failures += bool(bad)
+    print('{} queries, {} with table scans'.format(len(results), failures))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,202 @@
+'''Initiative order kept sorted as combatants come and go.
+
+Each combatant gets a sort key of (-total, -init_mod, tiebreak) in a list
+maintained with bisect. That makes adding, removing or moving one combatant
+a binary search plus a list insert, with no re-sort. Tiebreaks come from a
+counter, so equal initiatives stay in the order they were added.
+
+The search is O(log n) comparisons but the insert or delete shifts the rest
+of the list, so those are O(n). That is on purpose: the shift is one memmove
+of pointers, and for orders of a few thousand combatants it costs less than
+the Python-level node juggling of a skip list or balanced tree would, while
+turn order stays a plain walk over a list.
+'''
+from bisect import bisect_left, bisect_right, insort
+from itertools import count
+
+DELAYED = 'delayed'
+READIED = 'readied'
+
+
+class InitiativeOrder(object):
+    '''Combatants in initiative order, highest first, with a pointer to whose
+    turn it is'''
+
+    def __init__(self):
+        self._keys = []
+        self._combatants = {}
+        self._key_of = {}
+        self._tiebreaks = count()
+        self.current = None
+        self.waiting = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, combatant):
+        return combatant in self._key_of
+
+    def __iter__(self):
+        '''Yields (total, combatant) pairs in turn order'''
+        combatants = self._combatants
+        for key in self._keys:
+            yield -key[0], combatants[key]
+
+    def clear(self):
+        del self._keys[:]
+        self._combatants.clear()
+        self._key_of.clear()
+        self.waiting.clear()
+        self.current = None
+        self._tiebreaks = count()
+
+    def _insert(self, key, combatant):
+        insort(self._keys, key)
+        self._combatants[key] = combatant
+        self._key_of[combatant] = key
+
+    def add(self, combatant, total):
+        '''Adds a combatant with the given initiative total'''
+        if combatant in self._key_of:
+            self.remove(combatant)
+        key = (-total, -combatant.init_mod, next(self._tiebreaks))
+        self._insert(key, combatant)
+
+    def remove(self, combatant):
+        '''Takes a combatant out of the order (e.g. because it died)'''
+        self.waiting.pop(combatant, None)
+        key = self._key_of.pop(combatant, None)
+        if key is None:
+            return
+        del self._keys[bisect_left(self._keys, key)]
+        del self._combatants[key]
+
+    @property
+    def tiebreak(self):
+        '''The tiebreak the next combatant added will get'''
+        tiebreak = next(self._tiebreaks)
+        self._tiebreaks = count(tiebreak)
+        return tiebreak
+
+    @tiebreak.setter
+    def tiebreak(self, value):
+        self._tiebreaks = count(value)
+
+    def state(self, ref):
+        '''The order as plain data, naming combatants with ref(combatant)'''
+        combatants = self._combatants
+        return {
+            'keys': [[list(key), ref(combatants[key])] for key in self._keys],
+            'current': list(self.current) if self.current else None,
+            'waiting': [[ref(combatant), why, total]
+                        for combatant, (why, total)
+                        in self.waiting.iteritems()],
+            'tiebreak': self.tiebreak,
+        }
+
+    def load(self, state, resolve):
+        '''Replaces the order with one from `state()`'''
+        self.clear()
+        for key, ref in state['keys']:
+            self._insert(tuple(key), resolve(ref))
+        current = state['current']
+        self.current = tuple(current) if current else None
+        for ref, why, total in state['waiting']:
+            self.waiting[resolve(ref)] = (why, total)
+        self._tiebreaks = count(state['tiebreak'])
+
+    def slot(self, combatant):
+        '''Where a combatant stands: its sort key while in the order, (why,
+        total) while it waits to act, otherwise None'''
+        key = self._key_of.get(combatant)
+        if key is not None:
+            return key
+        return self.waiting.get(combatant)
+
+    def place(self, combatant, slot):
+        '''Puts a combatant back where `slot()` said it was'''
+        self.remove(combatant)
+        if slot is None:
+            return
+        if len(slot) == 3:
+            self._insert(tuple(slot), combatant)
+        else:
+            self.waiting[combatant] = tuple(slot)
+
+    def total(self, combatant):
+        '''Initiative total the combatant currently acts on'''
+        return -self._key_of[combatant][0]
+
+    def key(self, combatant):
+        '''Sort key of the combatant's slot in the order'''
+        return self._key_of[combatant]
+
+    def key_of(self, combatant):
+        '''Sort key of the combatant's slot, or None while it is out of the
+        order'''
+        return self._key_of.get(combatant)
+
+    def at(self, key):
+        '''The combatant in the slot with sort key `key`, if any'''
+        return self._combatants.get(key)
+
+    @property
+    def acting(self):
+        '''The combatant whose turn it is, if any'''
+        return self._combatants.get(self.current)
+
+    def next_turn(self):
+        '''Moves to the next combatant. Returns (combatant, wrapped) where
+        `wrapped` is True when the order started over from the top'''
+        if not self._keys:
+            self.current = None
+            return None, False
+        wrapped = False
+        index = 0
+        if self.current is not None:
+            index = bisect_right(self._keys, self.current)
+            if index == len(self._keys):
+                index, wrapped = 0, True
+        self.current = self._keys[index]
+        return self._combatants[self.current], wrapped
+
+    def delay(self, combatant):
+        '''Pulls a combatant out of the order until it `resume`s'''
+        self._park(combatant, DELAYED)
+
+    def ready(self, combatant):
+        '''Pulls a combatant out of the order until its readied action is
+        triggered with `resume`'''
+        self._park(combatant, READIED)
+
+    def _park(self, combatant, why):
+        if combatant not in self._key_of:
+            raise ValueError('{} is not in the initiative order'.format(
+                combatant))
+        total = self.total(combatant)
+        self.remove(combatant)
+        self.waiting[combatant] = (why, total)
+
+    def resume(self, combatant):
+        '''Puts a delayed or readied combatant back, directly after whoever
+        is acting, and makes it their turn'''
+        if combatant not in self.waiting:
+            raise ValueError('{} is not waiting to act'.format(combatant))
+        del self.waiting[combatant]
+        key = self._key_after(self.current, combatant)
+        self._insert(key, combatant)
+        self.current = key
+
+    def _key_after(self, key, combatant):
+        '''A new key that sorts immediately after `key`, keeping the same
+        initiative total'''
+        keys = self._keys
+        if key is None:
+            if not keys:
+                return (0, -combatant.init_mod, next(self._tiebreaks))
+            first = keys[0]
+            return first[:2] + (first[2] - 1,)
+        index = bisect_right(keys, key)
+        if index < len(keys) and keys[index][:2] == key[:2]:
+            return key[:2] + ((key[2] + keys[index][2]) / 2.0,)
+        return key[:2] + (key[2] + 1,)
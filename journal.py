@@ -0,0 +1,173 @@
+'''Append-only journal of session changes, with periodic snapshots.
+
+Every change to a session is appended to the journal as one compact JSON
+line, `[seq, kind, args...]`. Appends are buffered writes; the file is handed
+to the OS after every command and only fsynced in batches, so recording adds
+next to nothing to the prompt. Every so often the whole session is written to
+a snapshot file and the journal starts over, so recovering after a crash
+means loading the snapshot and replaying a short tail. A clean exit deletes
+both, so only a session that crashed is recovered.
+
+Replaying a record doesn't roll dice again (records carry the totals and
+damage that were rolled), so the dice streams would drift from where the
+live session left them. After any command that drew from a stream, its
+state is journaled as an 'rng' record.
+'''
+import json
+import os
+import time
+
+JOURNAL_PATH = 'battle_tracker.journal'
+SNAPSHOT_VERSION = 1
+
+_dumps = json.JSONEncoder(separators=(',', ':')).encode
+
+
+def snapshot_path(path):
+    return path + '.snapshot'
+
+
+def journal_exists(path):
+    '''Whether there is a journal at `path` to recover from'''
+    return os.path.exists(snapshot_path(path))
+
+
+class Journal(object):
+    '''Records changes to one session at a time'''
+
+    def __init__(self, path, sync_every=100, sync_interval=1.0,
+                 snapshot_every=1000):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.snapshot_every = snapshot_every
+        self.file = None
+        self.seq = 0
+        self.unsynced = 0
+        self.since_snapshot = 0
+        self.last_sync = time.time()
+        self.rng_states = []  # as of the last 'rng' record or snapshot
+
+    def start(self, session):
+        '''Starts journaling `session`, replacing whatever was recorded'''
+        session.listeners.append(self)
+        self.snapshot(session)
+
+    def append(self, kind, args):
+        '''Records one change'''
+        self.seq += 1
+        self.file.write(_dumps([self.seq, kind] + list(args)))
+        self.file.write('\n')
+        self.unsynced += 1
+        self.since_snapshot += 1
+        if self.unsynced >= self.sync_every:
+            self.sync()
+
+    def commit(self, session):
+        '''Called between commands: passes the writes on to the OS, and
+        fsyncs or snapshots if one is due'''
+        if self.file is None:
+            return
+        if self.since_snapshot >= self.snapshot_every:
+            return self.snapshot(session)
+        self.record_rngs(session)
+        self.file.flush()
+        if self.unsynced and \
+                time.time() - self.last_sync >= self.sync_interval:
+            self.sync()
+
+    def record_rngs(self, session):
+        '''Appends an 'rng' record of the dice streams that moved since the
+        last one'''
+        states, old = session.rng_states(), self.rng_states
+        changed = [[i, state] for i, state in enumerate(states)
+                   if i >= len(old) or state != old[i]]
+        self.rng_states = states
+        if changed:
+            self.append('rng', [changed])
+
+    def sync(self):
+        '''Makes everything appended so far durable'''
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def snapshot(self, session):
+        '''Writes the whole session out and starts an empty journal'''
+        path = snapshot_path(self.path)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(_dumps({'version': SNAPSHOT_VERSION, 'seq': self.seq,
+                            'session': session.state()}))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + '.tmp', path)
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.path, 'wb')
+        self.unsynced = 0
+        self.since_snapshot = 0
+        self.last_sync = time.time()
+        self.rng_states = session.rng_states()
+
+    def close(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
+
+    def discard(self):
+        '''Closes the journal and deletes it and its snapshot, once the
+        session has ended cleanly and there is nothing to recover'''
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        for path in (snapshot_path(self.path), self.path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def read(path):
+    '''The last snapshot at `path` and the journal records after it. A
+    record cut short by a crash ends the journal and is dropped'''
+    with open(snapshot_path(path), 'rb') as f:
+        snapshot = json.load(f)
+    if snapshot.get('version') != SNAPSHOT_VERSION:
+        raise ValueError('Unknown snapshot version {}'.format(
+            snapshot.get('version')))
+    records, good = [], 0
+    if os.path.exists(path):
+        loads = json.loads
+        with open(path, 'rb') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break
+                try:
+                    record = loads(line)
+                except ValueError:
+                    break
+                good += len(line)
+                if record[0] > snapshot['seq']:
+                    records.append(record)
+        if good != os.path.getsize(path):
+            with open(path, 'r+b') as f:
+                f.truncate(good)
+    return snapshot, records
+
+
+def recover(path, restore, replay, **options):
+    '''Rebuilds a session from the journal at `path`. `restore(state)` turns
+    the snapshot into a session and `replay(session, kind, args)` applies
+    one record. Returns (session, journal), with the journal reopened to
+    carry on recording'''
+    snapshot, records = read(path)
+    session = restore(snapshot['session'])
+    for record in records:
+        replay(session, record[1], record[2:])
+    journal = Journal(path, **options)
+    journal.seq = records[-1][0] if records else snapshot['seq']
+    journal.since_snapshot = len(records)
+    journal.rng_states = session.rng_states()
+    journal.file = open(path, 'ab')
+    session.listeners.append(journal)
+    return session, journal
@@ -0,0 +1,47 @@
+'''Loads play sessions from the models database in a fixed number of queries.
+
+Encounter.players and Encounter.monsters load lazily, so walking a session's
+encounters costs two queries per encounter. load_session asks for everything
+up front instead: each level below the session is one SELECT ... IN over the
+level above it, however many encounters there are.
+
+    depth       queries  loads
+    SESSION     1        the session
+    ENCOUNTERS  2        + its encounters
+    INITIATIVE  3        + their init orders and the characters in them
+    CHARACTERS  5        + their players and monsters
+'''
+from sqlalchemy.orm import selectinload
+
+import models as M
+
+SESSION, ENCOUNTERS, INITIATIVE, CHARACTERS = range(4)
+
+
+def session_options(depth=CHARACTERS):
+    '''Loader options for a models.Session query that load `depth` levels
+    below the session'''
+    if depth < ENCOUNTERS:
+        return []
+    encounters = selectinload(M.Session.encounters)
+    options = [encounters]
+    if depth >= INITIATIVE:
+        # CharacterEncounter.character is joined into the same query
+        options.append(encounters.selectinload(M.Encounter.init_order))
+    if depth >= CHARACTERS:
+        options.append(encounters.selectinload(M.Encounter.players))
+        options.append(encounters.selectinload(M.Encounter.monsters))
+    return options
+
+
+def load_session(db_session, name, depth=CHARACTERS):
+    '''The models.Session called `name` with `depth` levels loaded, or None
+    if there isn't one'''
+    return (db_session.query(M.Session).options(*session_options(depth))
+            .filter(M.Session.name == name).one_or_none())
+
+
+def load_sessions(db_session, depth=CHARACTERS):
+    '''Every models.Session, by name, with `depth` levels loaded'''
+    return (db_session.query(M.Session).options(*session_options(depth))
+            .order_by(M.Session.name).all())
@@ -1,7 +1,8 @@
 from collections import Sized, Iterable
 from sqlalchemy import (Column, Integer, String, Float, ForeignKey, Boolean,
-                        Enum, Date, Table, Index, inspect)
-from sqlalchemy.orm import relationship
+                        Enum, Date, Table, Index, inspect, event)
+from sqlalchemy.orm import (relationship, configure_mappers, ColumnProperty,
+                            RelationshipProperty)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext import associationproxy
 from sqlalchemy.ext.orderinglist import ordering_list
@@ -53,6 +54,89 @@ def association_proxy(*args, **kwargs):
     return ap
 
 
+COMPILE_JSON = True  # generate a json function per class, else walk the plan
+
+_json_plans = {}
+_json_writers = {}
+
+
+def jsonify(value):
+    '''Serializes a value of unknown kind the way Base.json always has'''
+    if isinstance(value, (Sized, Iterable)) \
+            and not isinstance(value, basestring):
+        return [p.json() if hasattr(p, 'json') else p for p in value]
+    return value.json() if hasattr(value, 'json') else value
+
+
+def json_plan(cls):
+    '''The attributes Base.json writes for a class, as (attribute, kind)
+    pairs. kind is 'value' for a column, 'object' or 'list' for a
+    relationship and 'any' for anything else. Worked out once per class'''
+    plan = _json_plans.get(cls)
+    if plan is None:
+        configure_mappers()
+        plan = []
+        for attr, prop in inspect(cls).all_orm_descriptors.items():
+            if not (hasattr(prop, 'info') and prop.info.get('jsonify')):
+                continue
+            prop = getattr(prop, 'property', None)
+            if isinstance(prop, ColumnProperty):
+                kind = 'value'
+            elif isinstance(prop, RelationshipProperty):
+                kind = 'list' if prop.uselist else 'object'
+            else:
+                kind = 'any'
+            plan.append((attr, kind))
+        plan = _json_plans[cls] = tuple(plan)
+    return plan
+
+
+_JSON_EXPRESSIONS = {
+    'value': 'value',
+    'object': 'None if value is None else value.json()',
+    'list': '[p.json() for p in value]',
+    'any': 'jsonify(value)',
+}
+
+
+def json_writer(cls, compiled=None):
+    '''A function serializing instances of `cls`, generated from its plan
+    unless `compiled` (default COMPILE_JSON) is false'''
+    plan, null = json_plan(cls), cls.__json_null__
+    if not (COMPILE_JSON if compiled is None else compiled):
+        return lambda obj: _json_from_plan(obj, plan, null)
+    lines = ['def json(self):', '    out = {}']
+    for attr, kind in plan:
+        lines.append('    value = self.{}'.format(attr))
+        assign = 'out[{!r}] = {}'.format(attr, _JSON_EXPRESSIONS[kind])
+        if null:
+            lines.append('    ' + assign)
+        else:
+            lines.append('    if value is False or value:')
+            lines.append('        ' + assign)
+    lines.append('    return out')
+    namespace = {'jsonify': jsonify}
+    exec compile('\n'.join(lines), '<json {}>'.format(cls.__name__),
+                 'exec') in namespace
+    return namespace['json']
+
+
+def _json_from_plan(obj, plan, null):
+    jsonout = {}
+    for attr, kind in plan:
+        value = getattr(obj, attr)
+        if null or value is False or value:
+            if kind == 'value':
+                jsonout[attr] = value
+            elif kind == 'object':
+                jsonout[attr] = None if value is None else value.json()
+            elif kind == 'list':
+                jsonout[attr] = [p.json() for p in value]
+            else:
+                jsonout[attr] = jsonify(value)
+    return jsonout
+
+
 class Base(DeclBase):
     '''Common functionality'''
     __abstract__ = True
@@ -68,20 +152,11 @@ class Base(DeclBase):
             setattr(self, attr, value)
 
     def json(self):
-        jsonify = lambda obj: obj.json() if hasattr(obj, 'json') else obj
-
-        jsonout = {}
-
-        for attr, prop in inspect(self.__class__).all_orm_descriptors.items():
-            if hasattr(prop, 'info') and prop.info.get('jsonify'):
-                value = getattr(self, attr)
-                if self.__json_null__ or value is False or value:
-                    if isinstance(value, (Sized, Iterable)) \
-                        and not isinstance(value, basestring):
-                        jsonout[attr] = [jsonify(p) for p in value]
-                    else:
-                        jsonout[attr] = jsonify(value)
-        return jsonout
+        cls = self.__class__
+        writer = _json_writers.get(cls)
+        if writer is None:
+            writer = _json_writers[cls] = json_writer(cls)
+        return writer(self)
 
 
 class Size(Base):
@@ -187,6 +262,7 @@ class Weapon(Base):
                             default='One-Handed',
                             doc='How many hands this weapon takes to wield')
 
+    dice = relationship(Dice)
     properties = jsonrelationship(WeaponProperty,
                                   secondary=weapon_weaponproperty,
                                   backref='weapons')
@@ -208,6 +284,7 @@ armor_effect = Table(
     Base.metadata,
     Column('armorname', String, ForeignKey('armor.name'), primary_key=True),
     Column('effectname', String, ForeignKey('effect.name'), primary_key=True),
+    Index('armor_effect_effectname_idx', 'effectname'),
 )
 
 
@@ -225,13 +302,14 @@ class Armor(Base):
     type = relationship(ArmorType, backref='armors')
 
     check = jsonassociation_proxy('effect', 'armor_check')
-    ac_bonus = jsonassociation_proxy('effect', 'ac')
+    ac_bonus = jsonassociation_proxy('effect', 'armor_class')
     speed = jsonassociation_proxy('effect', 'speed')
 
     def __init__(self, name, **kwargs):
         effect_attrs = {'check', 'ac_bonus', 'speed'}
         if effect_attrs & kwargs.viewkeys() and 'effect' not in kwargs:
-            self.effect = Effect(name=name + "'s Effect")
+            self.effect = Effect(name=name + "'s Effect",
+                                 bonustype_name='Armor')
         super(Armor, self).__init__(name, **kwargs)
 
 
@@ -275,6 +353,7 @@ class Race(Base):
                       doc="Race's size")
     effectname = Column(String, ForeignKey('effect.name'),
                         doc='Effect of being this race')
+    __table_args__ = (Index('race_effectname_idx', effectname),)
 
     size = jsonrelationship(Size)
     patron_deity = jsonrelationship('Deity',
@@ -308,6 +387,7 @@ class_effect = Table(
     Base.metadata,
     Column('classname', String, ForeignKey('class.name'), primary_key=True),
     Column('effectname', String, ForeignKey('effect.name'), primary_key=True),
+    Index('class_effect_effectname_idx', 'effectname'),
 )
 
 
@@ -350,6 +430,7 @@ class Deity(Base):
                            doc='Race this Deity is a patron of')
     season = JSONColumn(Enum('Spring', 'Summer', 'Autumn', 'Winter'),
                         doc="Deity's season (if any)")
+    __table_args__ = (Index('deity_patron_of_idx', patron_of),)
 
     domain_models = relationship(DeityDomain, backref='deity')
     domains = association_proxy('domain_models', 'name')
@@ -378,6 +459,8 @@ class Character(Base):
                            doc="Character's alignment")
     deityname = Column(String, ForeignKey('deity.name'),
                        doc="Character's deity")
+    armorname = Column(String, ForeignKey('armor.name'),
+                       doc="Armor the character is wearing")
     level = Column(Integer, default=1,
                    doc="Character's level")
     max_hp = Column(Integer,
@@ -407,6 +490,12 @@ class Character(Base):
     silver = Column(Integer, default=0, doc='Amount of silver carried')
     copper = Column(Integer, default=0, doc='Amount of copper carried')
 
+    __table_args__ = (
+        Index('character_is_player_idx', is_player),
+        Index('character_racename_idx', racename),
+        Index('character_classname_idx', classname),
+        Index('character_armorname_idx', armorname),
+    )
     __mapper_args__ = {
         'polymorphic_on': is_player,
     }
@@ -416,6 +505,7 @@ class Character(Base):
     class_ = relationship(Class)
     alignment = relationship(Alignment)
     race = relationship(Race)
+    armor = relationship(Armor)
 
 
 class Player(Character):
@@ -500,20 +590,32 @@ class Effect(Base):
         super(Effect, self).__init__(name, **kwargs)
 
     def __str__(self):
-        mods = ['{0:+} {1}'.format(getattr(self, attr), pretty(attr))
-                for attr, col in inspect(self.__class__).columns.items()
-                if attr != 'name'
-                and isinstance(pytype(col), int)
-                and getattr(self, attr) is not None]
-        mods.extend('{} {}'.format(getattr(self, attr), attr.title())
-                    for attr, col in inspect(self.__class__).columns.items()
-                    if attr != 'name'
-                    and isinstance(pytype(col), str)
-                    and getattr(self, attr) is not None)
+        mods = []
+        for attr, label in _render_plans[self.__class__]:
+            value = getattr(self, attr)
+            if value is not None:
+                mods.append(label(value))
         mods.extend(str(stat) for stat in self.stats)
         return '{0.name}:\n  {1}'.format(self, '\n  '.join(mods))
 
 
+_render_plans = {}
+
+
+@event.listens_for(Effect, 'mapper_configured', propagate=True)
+def _plan_render(mapper, cls):
+    '''Works out once what Effect.__str__ shows: the numeric modifiers as
+    "+2 Strength", then the string columns as "Darkvision Vision", each in
+    column order, as (attribute, label formatter) pairs'''
+    columns = [(attr, pytype(col)) for attr, col in mapper.columns.items()
+               if attr != 'name']
+    plan = [(attr, ('{:+} ' + pretty(attr)).format)
+            for attr, kind in columns if isinstance(kind, int)]
+    plan.extend((attr, ('{} ' + attr.title()).format)
+                for attr, kind in columns if isinstance(kind, str))
+    _render_plans[cls] = tuple(plan)
+
+
 class StatType(Base):
     '''Types of stats that can exist'''
     __tablename__ = 'stattype'
@@ -616,6 +718,50 @@ class ProficiencyStat(Stat):
         super(ProficiencyStat, self).__init__(**kwargs)
 
 
+# the subclasses share the stat table, so their indexes are declared here
+Index('stat_language_idx', LanguageStat.__table__.c.language)
+Index('stat_skillname_idx', SkillStat.__table__.c.skillname)
+Index('stat_damagetype_name_idx', DamageStat.__table__.c.damagetype_name)
+Index('stat_weaponcategory_name_idx',
+      ProficiencyStat.__table__.c.weaponcategory_name)
+Index('stat_armortype_name_idx', ProficiencyStat.__table__.c.armortype_name)
+
+
+character_stats = Table(
+    'character_stats',
+    Base.metadata,
+    Column('charactername', String, ForeignKey('character.name'),
+           primary_key=True),
+    Column('strength', Integer),
+    Column('constitution', Integer),
+    Column('dexterity', Integer),
+    Column('intelligence', Integer),
+    Column('wisdom', Integer),
+    Column('charisma', Integer),
+    Column('armor_class', Integer),
+    Column('fortitude', Integer),
+    Column('reflex', Integer),
+    Column('will', Integer),
+    Column('speed', Integer),
+    Column('initiative', Integer),
+    Column('healing_surges', Integer),
+    Index('character_stats_armor_class_idx', 'armor_class'),
+    Index('character_stats_fortitude_idx', 'fortitude'),
+    Index('character_stats_reflex_idx', 'reflex'),
+    Index('character_stats_will_idx', 'will'),
+)
+
+character_skill_stats = Table(
+    'character_skill_stats',
+    Base.metadata,
+    Column('charactername', String, ForeignKey('character.name'),
+           primary_key=True),
+    Column('skillname', String, ForeignKey('skill.name'), primary_key=True),
+    Column('total', Integer),
+    Index('character_skill_stats_skill_idx', 'skillname', 'total'),
+)
+
+
 class CharacterEncounter(Base):
     '''Links a player to an encounter in initiative order'''
     __tablename__ = 'character_encounter'
@@ -632,8 +778,13 @@ class CharacterEncounter(Base):
     second_wind_used = JSONColumn(Boolean, default=False,
                                   doc='Whether the character still has a '
                                   'second wind for this encounter.')
+    __table_args__ = (
+        Index('character_encounter_encounter_id_idx', encounter_id),)
 
-    character = relationship('Character', innerjoin=True, lazy='joined')
+    # unnested, as a join nested in Encounter.init_order's outer join makes
+    # SQLite build the whole join before looking anything up
+    character = relationship('Character', innerjoin='unnested',
+                             lazy='joined')
 
 
 class Encounter(Base):
@@ -643,6 +794,7 @@ class Encounter(Base):
     name = JSONColumn(String, primary_key=True, doc="Name of Encounter")
     sessionname = Column(String, ForeignKey('session.name'),
                          doc='Session this encounter belongs to')
+    __table_args__ = (Index('encounter_sessionname_idx', sessionname),)
 
     session = relationship('Session', backref='encounters')
     init_order = jsonrelationship('CharacterEncounter',
@@ -0,0 +1,362 @@
+'''Writes battle tracker sessions into the models database.
+
+A DatabaseWriter listens to a tracker Session and keeps the session,
+encounter, character and character_encounter tables up to date. Changes are
+only collected as they happen and written at the end of each round (or on
+`flush`), as a handful of executemany statements in one transaction, however
+many combatants are involved.
+
+Players are stored under their own names. Monster names like "Goblin A"
+come up in every encounter, so each monster's character row is named after
+its session, encounter and row as well (see `character_name`).
+
+A BackgroundWriter hands those batches to a thread instead, so the prompt
+never waits on the disk. Batches that pile up while a write is in progress
+are merged, so twenty hits on the same goblin become one UPDATE.
+'''
+import threading
+import time
+from Queue import Queue, Empty
+from datetime import datetime
+
+from sqlalchemy import bindparam
+
+import models as M
+from combatants import MonsterRow
+
+DATE_FORMAT = '%A %B %d, %Y %I:%M %p'  # how battle_tracker.Session dates it
+
+session_table = M.Session.__table__
+encounter_table = M.Encounter.__table__
+character_table = M.Character.__table__
+character_encounter_table = M.CharacterEncounter.__table__
+
+_insert_session = session_table.insert().prefix_with('OR REPLACE')
+_insert_encounter = encounter_table.insert().prefix_with('OR REPLACE')
+_insert_character = character_table.insert().prefix_with('OR IGNORE')
+_update_character = character_table.update().where(
+    character_table.c.name == bindparam('b_name')).values(
+    is_player=bindparam('b_is_player'), playername=bindparam('b_playername'),
+    max_hp=bindparam('b_max_hp'), current_hp=bindparam('b_current_hp'))
+_clear_initiative = character_encounter_table.delete().where(
+    character_encounter_table.c.encounter_id == bindparam('b_encounter'))
+_insert_initiative = character_encounter_table.insert().prefix_with(
+    'OR REPLACE')
+
+# journal record kinds that change what the tables hold. Their first
+# argument is the encounter number ('encounter' records carry the new
+# encounter's name instead, so are handled on their own)
+_ROSTER = frozenset(['initiative', 'monster', 'remove', 'delay', 'ready',
+                     'resume', 'restore'])
+_HP = frozenset(['damage', 'damage_each'])
+
+
+def _key(name):
+    return lambda params: params[name]
+
+
+# statements in the order they are run, with what identifies a row of each
+_STATEMENTS = [
+    (_insert_session, _key('name')),
+    (_insert_encounter, _key('name')),
+    (_insert_character, _key('name')),
+    (_update_character, _key('b_name')),
+    (_clear_initiative, _key('b_encounter')),
+    (_insert_initiative, _key('encounter_id')),
+]
+
+
+def coalesce(batches):
+    '''Merges batches of (statement, params) into one, keeping the latest
+    params for each row. A batch that clears an encounter's initiative
+    replaces its rows as a whole, with whatever rows that batch inserts (or
+    none)'''
+    latest = dict((statement, {}) for statement, _ in _STATEMENTS)
+    keys = dict(_STATEMENTS)
+    for batch in batches:
+        initiative = {}
+        for statement, params in batch:
+            rows, key = latest[statement], keys[statement]
+            if statement is _insert_initiative:
+                for row in params:
+                    initiative.setdefault(key(row), []).append(row)
+            else:
+                for row in params:
+                    rows[key(row)] = row
+                if statement is _clear_initiative:
+                    for row in params:
+                        initiative.setdefault(key(row), [])
+        latest[_insert_initiative].update(initiative)
+    merged = []
+    for statement, _ in _STATEMENTS:
+        rows = latest[statement]
+        if statement is _insert_initiative:
+            rows = [row for encounter in sorted(rows)
+                    for row in rows[encounter]]
+        else:
+            rows = [rows[key] for key in sorted(rows)]
+        if rows:
+            merged.append((statement, rows))
+    return merged
+
+
+def character_name(session, combatant):
+    '''The name of a combatant's row in the character table'''
+    if isinstance(combatant, MonsterRow) and combatant.encounter:
+        return '{}/{}/{}#{}'.format(session.name, combatant.encounter.name,
+                                    combatant.name, combatant.row)
+    return combatant.name
+
+
+def session_date(session):
+    '''The date a tracker session was started on, if it can be read'''
+    try:
+        return datetime.strptime(session.date, DATE_FORMAT).date()
+    except ValueError:
+        return None
+
+
+class DatabaseWriter(object):
+    '''Mirrors a tracker session into the database a round at a time'''
+
+    def __init__(self, engine, session):
+        self.engine = engine
+        self.session = session
+        self.rounds = {}  # encounter number -> round last written
+        self.encounters = set()  # encounter numbers with roster changes
+        self.damaged = {}  # encounter number -> rows with hp changes
+        self.players_changed = False
+        self.session_changed = False
+        self.statements = 0
+        self.mark_all()
+        session.listeners.append(self)
+
+    def mark_all(self):
+        '''Schedules the whole session to be written on the next flush'''
+        self.session_changed = self.players_changed = True
+        self.encounters.update(xrange(len(self.session.encounters)))
+
+    def append(self, kind, args):
+        '''Notes a change to the session (called through Session.emit)'''
+        if kind in _HP:
+            number, rows = args[0], args[1]
+            self.damaged.setdefault(number, set()).update(rows)
+            hp = self.session.encounters[number].table.hp
+            if any(hp[row] <= 0 for row in rows):
+                self.encounters.add(number)  # the dead leave initiative
+        elif kind in _ROSTER:
+            self.encounters.add(args[0])
+        elif kind == 'encounter':
+            # emitted while the encounter is made, before it is listed
+            self.encounters.add(len(self.session.encounters))
+        elif kind == 'player':
+            self.players_changed = True
+        elif kind == 'name':
+            self.mark_all()
+        elif kind == 'next':
+            number = args[0]
+            current = self.session.encounters[number].round
+            if self.rounds.get(number, 0) != current:
+                self.rounds[number] = current
+                self.flush()
+
+    @property
+    def pending(self):
+        return bool(self.session_changed or self.players_changed or
+                    self.encounters or self.damaged)
+
+    def flush(self):
+        '''Writes everything changed since the last flush in one
+        transaction'''
+        self.execute(self.collect())
+
+    def execute(self, batch):
+        '''Runs a batch of (statement, params) in one transaction'''
+        if not batch:
+            return
+        with self.engine.begin() as conn:
+            for statement, params in batch:
+                conn.execute(statement, params)
+        self.statements += len(batch)
+
+    def collect(self):
+        '''The statements that bring the database up to date, as a batch of
+        (statement, params) holding plain values'''
+        if not self.pending:
+            return []
+        session = self.session
+        statements = []
+        if self.session_changed:
+            statements.append((_insert_session, [
+                {'name': session.name, 'date': session_date(session)}]))
+        encounters = [session.encounters[n] for n in sorted(self.encounters)]
+        if encounters:
+            statements.append((_insert_encounter, [
+                {'name': enc.name, 'sessionname': session.name}
+                for enc in encounters]))
+        characters = self._changed_characters(encounters)
+        if characters:
+            rows = [{'name': character_name(session, c),
+                     'is_player': c in session.players,
+                     'max_hp': c.max_hp, 'current_hp': c.hp,
+                     'playername': getattr(c, 'playername', None)}
+                    for c in characters]
+            statements.append((_insert_character, rows))
+            # an existing row may have been written as the other kind
+            statements.append((_update_character, [
+                {'b_name': row['name'], 'b_is_player': row['is_player'],
+                 'b_playername': row['playername'],
+                 'b_max_hp': row['max_hp'], 'b_current_hp': row['current_hp']}
+                for row in rows]))
+        if encounters:
+            statements.append((_clear_initiative, [
+                {'b_encounter': enc.name} for enc in encounters]))
+            rows = [row for enc in encounters
+                    for row in self._initiative_rows(enc)]
+            if rows:
+                statements.append((_insert_initiative, rows))
+        self.session_changed = self.players_changed = False
+        self.encounters.clear()
+        self.damaged.clear()
+        return statements
+
+    def _changed_characters(self, encounters):
+        '''Combatants whose character rows need writing, in a stable
+        order'''
+        session = self.session
+        characters = []
+        if self.players_changed or encounters:
+            characters.extend(session.players)
+        for enc in encounters:
+            characters.extend(enc.monsters)
+        listed = set(enc.number for enc in encounters)
+        for number, rows in sorted(self.damaged.iteritems()):
+            if number not in listed:
+                characters.extend(session.encounters[number].table.views(
+                    sorted(rows)))
+        seen = set()
+        return [c for c in characters if not (c in seen or seen.add(c))]
+
+    def _initiative_rows(self, enc):
+        name = lambda combatant: character_name(self.session, combatant)
+        rows = [{'charactername': name(combatant), 'encounter_id': enc.name,
+                 'init_score': total, 'position': position}
+                for position, (total, combatant)
+                in enumerate(enc.initiative_order)]
+        rows.extend({'charactername': name(combatant),
+                     'encounter_id': enc.name, 'init_score': total,
+                     'position': None}
+                    for combatant, (_, total)
+                    in enc.initiative_order.waiting.iteritems())
+        return rows
+
+    def close(self):
+        self.flush()
+        if self in self.session.listeners:
+            self.session.listeners.remove(self)
+
+
+class BackgroundWriter(DatabaseWriter):
+    '''A DatabaseWriter whose writes happen on a background thread. `flush`
+    only queues the changes; when `max_queued` batches are waiting it blocks
+    until the thread catches up'''
+
+    def __init__(self, engine, session, max_queued=64):
+        self.queue = Queue(max_queued)
+        self.error = None
+        self.batches = 0
+        self.transactions = 0
+        self.rows = 0
+        self.merged_rows = 0
+        self.max_depth = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        # running flush timings, so a long session doesn't keep every one
+        self.last_flush = None
+        self.flush_total = 0.0
+        self.flush_max = None
+        super(BackgroundWriter, self).__init__(engine, session)
+        self.thread = threading.Thread(target=self._run,
+                                       name='database writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def flush(self):
+        '''Queues whatever changed since the last flush'''
+        batch = self.collect()
+        if batch:
+            self._put(batch)
+
+    def _put(self, batch):
+        self.batches += 1
+        self.rows += sum(len(params) for _, params in batch)
+        if self.queue.full():
+            self.waits += 1
+            start = time.time()
+            self.queue.put(batch)
+            self.wait_time += time.time() - start
+        else:
+            self.queue.put(batch)
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def sync(self):
+        '''Queues any changes and waits until everything queued is in the
+        database'''
+        self.flush()
+        self.queue.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _run(self):
+        while True:
+            batches = [self.queue.get()]
+            try:
+                while True:
+                    batches.append(self.queue.get_nowait())
+            except Empty:
+                pass
+            stopping = None in batches
+            try:
+                batch = coalesce(b for b in batches if b is not None)
+                self.merged_rows += sum(len(params) for _, params in batch)
+                start = time.time()
+                self.execute(batch)
+                took = self.last_flush = time.time() - start
+                self.flush_total += took
+                self.flush_max = max(self.flush_max, took)
+                self.transactions += 1
+            except Exception as e:
+                self.error = e
+            for _ in batches:
+                self.queue.task_done()
+            if stopping:
+                return
+
+    def metrics(self):
+        '''Queue depth, flush latency and how much was merged away'''
+        transactions = self.transactions
+        return {
+            'queued': self.queue.qsize(),
+            'max_queued': self.max_depth,
+            'batches': self.batches,
+            'transactions': self.transactions,
+            'rows_queued': self.rows,
+            'rows_written': self.merged_rows,
+            'backpressure_waits': self.waits,
+            'backpressure_seconds': self.wait_time,
+            'last_flush_seconds': self.last_flush,
+            'mean_flush_seconds': self.flush_total / transactions
+                                  if transactions else None,
+            'max_flush_seconds': self.flush_max,
+        }
+
+    def close(self):
+        '''Writes everything still queued and stops the thread'''
+        if not self.thread.is_alive():
+            return
+        self.flush()
+        if self in self.session.listeners:
+            self.session.listeners.remove(self)
+        self.queue.put(None)
+        self.thread.join()
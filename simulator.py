@@ -0,0 +1,198 @@
+'''Headless Monte Carlo simulation of a planned encounter.
+
+The encounter's players and monsters are flattened into a roster of plain
+tuples so it can be shipped to worker processes. Each worker rebuilds fresh
+`PlayerCharacter`/`Monster` objects for every fight, plays it out with its
+own child RNG stream, and returns histograms which are merged at the end.
+'''
+from __future__ import print_function
+from collections import Counter, namedtuple
+from multiprocessing import Pool, cpu_count
+
+from dm_common import PlayerCharacter, Monster
+from dice import RNG, compile_dice
+
+AttackProfile = namedtuple('AttackProfile', 'attack defense damage')
+
+DEFAULT_PLAYER = AttackProfile(attack=7, defense=17, damage='1d8+4')
+DEFAULT_MONSTER = AttackProfile(attack=6, defense=16, damage='1d8+3')
+
+PLAYERS, MONSTERS, STALEMATE = 'players', 'monsters', 'stalemate'
+
+# fights per job; fixed so a seed gives the same answer on any pool size
+_RUNS_PER_CHUNK = 1000
+
+
+class SimulationResult(object):
+    '''Histograms collected over many simulated fights'''
+
+    def __init__(self):
+        self.runs = 0
+        self.winners = Counter()
+        self.rounds = Counter()
+        self.players_down = Counter()
+        self.players_dead = Counter()
+
+    def merge(self, other):
+        '''Adds another result's histograms to this one'''
+        self.runs += other.runs
+        self.winners.update(other.winners)
+        self.rounds.update(other.rounds)
+        self.players_down.update(other.players_down)
+        self.players_dead.update(other.players_dead)
+        return self
+
+    @property
+    def tpk_risk(self):
+        '''Fraction of fights the monsters won'''
+        return self.winners[MONSTERS] / float(self.runs or 1)
+
+    @property
+    def win_rate(self):
+        '''Fraction of fights the players won'''
+        return self.winners[PLAYERS] / float(self.runs or 1)
+
+    @property
+    def mean_rounds(self):
+        total = sum(self.rounds.values())
+        return sum(r * n for r, n in self.rounds.items()) / float(total or 1)
+
+    def __repr__(self):
+        lines = ['{} fights: players won {:.1%}, TPK {:.1%}, '
+                 'stalemate {:.1%}, {:.2f} rounds on average'.format(
+                     self.runs, self.win_rate, self.tpk_risk,
+                     self.winners[STALEMATE] / float(self.runs or 1),
+                     self.mean_rounds)]
+        lines.append('Rounds to finish:')
+        lines.extend(_histogram(self.rounds, self.runs))
+        lines.append('Players down at the end:')
+        lines.extend(_histogram(self.players_down, self.runs))
+        return '\n'.join(lines)
+
+
+def _histogram(counter, runs, width=50):
+    '''Text bars for a Counter keyed by small integers'''
+    peak = max(counter.values() or [1])
+    return ['{:>4} {:6.1%} {}'.format(key, n / float(runs or 1),
+                                      '#' * (n * width // peak))
+            for key, n in sorted(counter.items())]
+
+
+def combatants(encounter):
+    '''The encounter's players then its monsters, in roster order'''
+    return list(encounter.players) + list(encounter.monsters)
+
+
+def roster(encounter):
+    '''Flattens an encounter's combatants into picklable tuples of
+    (name, is_player, init_mod, max_hp, hp, situational init mod)'''
+    players = [(p.name, True, p.init_mod, p.max_hp, p.hp, encounter.p_mod)
+               for p in encounter.players]
+    monsters = [(m.name, False, m.init_mod, m.max_hp, m.hp, encounter.m_mod)
+                for m in encounter.monsters]
+    return players + monsters
+
+
+def fight(fighters, profiles, rng, max_rounds=50):
+    '''Plays out a single fight, returning (winner, rounds, players down,
+    players dead). profiles[n] is the AttackProfile of fighters[n]'''
+    rand = rng.random
+    rolled = []
+    profile_of = {}
+    for (name, is_player, init_mod, max_hp, hp, sit_mod), profile in zip(
+            fighters, profiles):
+        cls = PlayerCharacter if is_player else Monster
+        character = cls(name, init_mod, max_hp)
+        character.hp = hp
+        profile_of[character] = profile
+        init = int(rand() * 20) + 1 + init_mod + sit_mod
+        rolled.append((-init, -init_mod, rand(), character, is_player))
+    rolled.sort()
+    players = [c for _, _, _, c, is_player in rolled if is_player]
+    monsters = [c for _, _, _, c, is_player in rolled if not is_player]
+    order = [(c, profile_of[c], monsters if is_player else players)
+             for _, _, _, c, is_player in rolled]
+
+    for rounds in xrange(1, max_rounds + 1):
+        for actor, profile, foes in order:
+            if actor.hp <= 0:
+                continue
+            targets = [t for t in foes if t.hp > 0]
+            if not targets:
+                break
+            # focus fire on anyone already bloodied
+            targets = [t for t in targets if t.bloodied] or targets
+            target = targets[int(rand() * len(targets))]
+            natural = int(rand() * 20) + 1
+            if natural == 20:
+                target.damage(profile.damage.maximum)
+            elif natural > 1 and \
+                    natural + profile.attack >= profile_of[target].defense:
+                target.damage(profile.damage.roll(rng))
+        if all(m.dead for m in monsters):
+            winner = PLAYERS
+            break
+        if all(p.hp <= 0 for p in players):
+            winner = MONSTERS
+            break
+    else:
+        winner = STALEMATE
+    return (winner, rounds,
+            sum(1 for p in players if p.hp <= 0),
+            sum(1 for p in players if p.dead))
+
+
+def _run_chunk(args):
+    '''Worker entry point: runs `runs` fights with its own RNG stream'''
+    fighters, profiles, runs, rng, max_rounds = args
+    profiles = [AttackProfile(p.attack, p.defense, compile_dice(p.damage))
+                for p in profiles]
+    result = SimulationResult()
+    for _ in xrange(runs):
+        winner, rounds, down, dead = fight(fighters, profiles, rng,
+                                           max_rounds)
+        result.runs += 1
+        result.winners[winner] += 1
+        result.rounds[rounds] += 1
+        result.players_down[down] += 1
+        result.players_dead[dead] += 1
+    return result
+
+
+def simulate(encounter, runs=10000, profiles=None, processes=None,
+             seed=None, max_rounds=50):
+    '''Simulates `runs` fights of `encounter`, spread over a process pool.
+
+    `profiles` maps combatants (the encounter's players and monsters, not
+    their names, which may be shared) to AttackProfiles; anyone missing gets
+    DEFAULT_PLAYER or DEFAULT_MONSTER. Raises ValueError if a side is
+    empty or a player has no hp.
+    '''
+    fighters = roster(encounter)
+    if not [f for f in fighters if f[1]] or not [f for f in fighters
+                                                 if not f[1]]:
+        raise ValueError('Need both players and monsters to simulate')
+    no_hp = [f[0] for f in fighters if f[1] and f[3] <= 0]
+    if no_hp:
+        raise ValueError('No hp for {}'.format(', '.join(no_hp)))
+    given = profiles or {}
+    profiles = [given.get(c, DEFAULT_PLAYER if is_player else DEFAULT_MONSTER)
+                for c, (_, is_player, _, _, _, _) in zip(
+                    combatants(encounter), fighters)]
+
+    processes = processes or cpu_count()
+    chunks = max(1, -(-runs // _RUNS_PER_CHUNK))
+    master = RNG(seed)
+    jobs = [(fighters, profiles, runs // chunks + (i < runs % chunks),
+             master.split(), max_rounds) for i in xrange(chunks)]
+
+    if processes == 1:
+        results = map(_run_chunk, jobs)
+    else:
+        pool = Pool(processes)
+        try:
+            results = pool.map(_run_chunk, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    return reduce(SimulationResult.merge, results, SimulationResult())
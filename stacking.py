@@ -0,0 +1,178 @@
+'''4th edition bonus stacking for models.Character.
+
+A character's numbers come from its own ability scores and level plus the
+effects of its race, its class and the armor it wears. Bonuses of the same
+type (Racial, Armor, Enhancement...) don't stack, so only the highest of each
+type counts. Untyped bonuses, and penalties of any type, all add up.
+
+character_stats() works a character's numbers out once and caches them.
+Everything they were worked out from (the character, its race, class and
+armor, their effects and skill stats, and the skills) is watched with
+attribute events, and changing any of them drops the cached numbers of the
+characters that used it. So does expiring any of them, which the session
+does to everything on commit.
+'''
+import weakref
+from collections import namedtuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+
+import models as M
+
+ABILITIES = ('strength', 'constitution', 'dexterity', 'intelligence',
+             'wisdom', 'charisma')
+DEFENSES = ('armor_class', 'fortitude', 'reflex', 'will')
+MODIFIERS = ABILITIES + DEFENSES + ('speed', 'initiative', 'healing_surges',
+                                    'armor_check')
+UNTYPED = 'Untyped'
+
+# abilities, defenses and skills are dicts keyed by attribute or skill name
+Stats = namedtuple('Stats', 'abilities defenses speed initiative '
+                            'healing_surges skills')
+
+_cache = weakref.WeakKeyDictionary()  # character -> Stats
+_dependents = weakref.WeakKeyDictionary()  # source -> characters using it
+
+
+def stack(bonuses):
+    '''Totals (bonus type, value) pairs: the highest bonus of each type,
+    plus every untyped bonus and every penalty'''
+    total, best = 0, {}
+    for kind, value in bonuses:
+        if kind is None or kind == UNTYPED or value < 0:
+            total += value
+        elif value > best.get(kind, 0):
+            best[kind] = value
+    return total + sum(best.itervalues())
+
+
+def modifier(score):
+    '''Ability modifier for an ability score'''
+    return (score - 10) // 2
+
+
+def effects_of(character):
+    '''The effects that apply to a character: its race's, its class's and
+    its armor's'''
+    effects = []
+    race, class_, armor = character.race, character.class_, character.armor
+    if race is not None and race.effect is not None:
+        effects.append(race.effect)
+    if class_ is not None:
+        effects.extend(class_.effects)
+    if armor is not None and armor.effect is not None:
+        effects.append(armor.effect)
+    return effects
+
+
+def compute(character, skills=()):
+    '''A character's Stats, worked out from scratch. Returns the stats and
+    the objects they were worked out from'''
+    effects = effects_of(character)
+    sources = [character, character.race, character.class_,
+               character.armor] + effects + list(skills)
+    if character.armor is not None:
+        sources.append(character.armor.type)
+    bonuses = dict((attr, []) for attr in MODIFIERS)
+    skill_bonuses = {}
+    for effect in effects:
+        kind = effect.bonustype_name
+        for attr in MODIFIERS:
+            value = getattr(effect, attr)
+            if value is not None:
+                bonuses[attr].append((kind, value))
+        for stat in effect.skill_stats:
+            sources.append(stat)
+            if stat.skill_mod is not None:
+                skill_bonuses.setdefault(stat.skillname, []).append(
+                    (kind, stat.skill_mod))
+    totals = dict((attr, stack(b)) for attr, b in bonuses.iteritems())
+
+    abilities = {}
+    for attr in ABILITIES:
+        score = getattr(character, attr)
+        abilities[attr] = (10 if score is None else score) + totals[attr]
+    mods = dict((attr, modifier(s)) for attr, s in abilities.iteritems())
+    half_level = (character.level or 1) // 2
+    base = 10 + half_level
+    armor_type = character.armor.type if character.armor is not None else None
+    heavy = armor_type is not None and armor_type.weight == 'Heavy'
+    dex_or_int = max(mods['dexterity'], mods['intelligence'])
+    defenses = {
+        'armor_class': (base + (0 if heavy else dex_or_int) +
+                        totals['armor_class']),
+        'fortitude': (base + max(mods['strength'], mods['constitution']) +
+                      totals['fortitude']),
+        'reflex': base + dex_or_int + totals['reflex'],
+        'will': base + max(mods['wisdom'], mods['charisma']) + totals['will'],
+    }
+    skill_totals = {}
+    for skill in skills:
+        total = (half_level + mods[skill.ability.lower()] +
+                 stack(skill_bonuses.get(skill.name, ())))
+        if skill.armor_penalty:
+            total += totals['armor_check']
+        skill_totals[skill.name] = total
+    stats = Stats(abilities, defenses, totals['speed'],
+                  half_level + mods['dexterity'] + totals['initiative'],
+                  totals['healing_surges'] + mods['constitution'],
+                  skill_totals)
+    return stats, [source for source in sources if source is not None]
+
+
+def character_stats(character, skills=None):
+    '''A character's final abilities, defenses, speed, initiative, healing
+    surges and skill totals, cached until something they depend on changes.
+    `skills` saves querying the skill table when doing many characters. The
+    Stats returned are shared, so don't modify them'''
+    stats = _cache.get(character)
+    if stats is None:
+        if skills is None:
+            session = object_session(character)
+            skills = session.query(M.Skill).all() if session else ()
+        stats, sources = compute(character, skills)
+        _cache[character] = stats
+        for source in sources:
+            _dependents.setdefault(source, weakref.WeakSet()).add(character)
+    return stats
+
+
+def invalidate(source):
+    '''Drops the cached stats of every character that used `source`'''
+    for character in list(_dependents.pop(source, ())):
+        _cache.pop(character, None)
+
+
+def _changed(target, *args):
+    if target is not None:  # expiring an object that has been collected
+        invalidate(target)
+
+
+# attributes the stats are worked out from, per class
+_WATCHED = [
+    (M.Character, ('level', 'racename', 'race', 'classname', 'class_',
+                   'armorname', 'armor') + ABILITIES),
+    (M.Race, ('effectname', 'effect')),
+    (M.Armor, ('typename', 'type', 'effect')),
+    (M.ArmorType, ('weight',)),
+    (M.Effect, ('bonustype_name',) + MODIFIERS),
+    (M.SkillStat, ('skillname', 'skill_mod')),
+    (M.Skill, ('ability', 'armor_penalty')),
+]
+_COLLECTIONS = [
+    (M.Class, ('effects',)),
+    (M.Effect, ('stats', 'skill_stats')),
+]
+
+for _cls, _attrs in _WATCHED:
+    for _attr in _attrs:
+        event.listen(getattr(_cls, _attr), 'set', _changed)
+for _cls, _attrs in _COLLECTIONS:
+    for _attr in _attrs:
+        event.listen(getattr(_cls, _attr), 'append', _changed)
+        event.listen(getattr(_cls, _attr), 'remove', _changed)
+for _cls in (M.Character, M.Race, M.Class, M.Armor, M.ArmorType, M.Effect,
+             M.Stat, M.Skill):
+    event.listen(_cls, 'expire', _changed, propagate=True)
+    event.listen(_cls, 'refresh', _changed, propagate=True)
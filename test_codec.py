@@ -0,0 +1,38 @@
+'''Tests for codec: the compiled character serializers'''
+import unittest
+
+import codec
+from dm_common import Monster, PlayerCharacter
+
+
+class CodecTest(unittest.TestCase):
+
+    def test_round_trips(self):
+        player = PlayerCharacter(u'Ar\xeda', 2, 30, playername='Sam')
+        player.affect('dazed', 'Goblin A', 'save ends')
+        monster = Monster('Goblin A', 1, 20)
+        monster.hp = 7
+        for loaded, original in zip(codec.loads(codec.dumps(
+                [player, monster])), [player, monster]):
+            self.assertIs(type(loaded), type(original))
+            self.assertEqual(loaded.json, original.json)
+        self.assertEqual(PlayerCharacter.from_json(player.json).json,
+                         player.json)
+
+    def test_optional_string(self):
+        player = PlayerCharacter('Aria', playername=None)
+        self.assertIsNone(codec.loads(codec.dumps([player]))[0].playername)
+        player.playername = ''
+        self.assertEqual(codec.loads(codec.dumps([player]))[0].playername, '')
+
+    def test_longest_string(self):
+        longest = 'x' * (codec.NONE - 1)
+        player = PlayerCharacter('Aria', playername=longest)
+        self.assertEqual(codec.loads(codec.dumps([player]))[0].playername,
+                         longest)
+        player.playername += 'x'  # the length that stands for None
+        self.assertRaises(ValueError, codec.dumps, [player])
+
+
+if __name__ == '__main__':
+    unittest.main()
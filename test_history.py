@@ -0,0 +1,61 @@
+'''Tests for history: undo and redo of encounter changes'''
+import unittest
+
+from battle_tracker import Session
+from dm_common import PlayerCharacter
+from history import History
+
+
+class HistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.session = Session('Session 1', seed=1)
+        self.session.add_player(PlayerCharacter('Aria', 2, 30))
+        self.session.add_player(PlayerCharacter('Brom', 1, 40))
+        self.encounter = self.session.add_encounter('Ambush')
+        self.encounter.add_monsters(3, 'Goblin', 1, 20)
+        self.encounter.next_turn()
+        self.history = History(self.encounter)
+
+    def order(self):
+        order = self.encounter.initiative_order
+        return (list(order), order.current, dict(order.waiting))
+
+    def test_undo_player_delay(self):
+        before = self.order()
+        aria = self.session.players[0]
+        self.encounter.delay(aria)
+        self.history.commit()
+        self.assertIn(aria, self.encounter.initiative_order.waiting)
+        self.assertTrue(self.history.undo())
+        self.assertEqual(self.order(), before)
+        self.assertNotIn(aria, self.encounter.initiative_order.waiting)
+        self.assertTrue(self.history.redo())
+        self.assertIn(aria, self.encounter.initiative_order.waiting)
+
+    def test_undo_player_resume(self):
+        brom = self.session.players[1]
+        self.encounter.ready(brom)
+        self.history.commit()
+        before = self.order()
+        self.encounter.resume(brom)
+        self.history.commit()
+        self.assertTrue(self.history.undo())
+        self.assertEqual(self.order(), before)
+
+    def test_undo_initiative_reroll(self):
+        before = self.order()
+        for _ in xrange(5):  # until someone's total changes
+            self.encounter.roll_initiative()
+            if self.order() != before:
+                break
+        self.history.commit()
+        self.assertNotEqual(self.order(), before)
+        self.assertTrue(self.history.undo())
+        self.assertEqual(self.order(), before)
+        order = self.encounter.initiative_order
+        self.assertIsNotNone(order.acting)
+
+
+if __name__ == '__main__':
+    unittest.main()
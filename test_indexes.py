@@ -0,0 +1,38 @@
+'''Tests for indexes: every hot query is served by an index'''
+import unittest
+
+import indexes
+
+
+class AdviseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.session = indexes.sample_database()
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_no_table_scans(self):
+        results = indexes.advise(self.session)
+        self.assertEqual(set(name for name, _, _, _ in results),
+                         set(indexes.WORKLOADS))
+        scans = ['{}: {} -> {}'.format(name, ' '.join(statement.split()),
+                                       bad)
+                 for name, statement, _, bad in results if bad]
+        self.assertEqual(scans, [])
+
+    def test_dropped_index_is_flagged(self):
+        self.session.execute('DROP INDEX character_encounter_encounter_id_idx')
+        results = indexes.advise(self.session, ['clear_initiative'])
+        self.assertTrue(results)
+        self.assertIn('character_encounter',
+                      [table for _, _, _, bad in results for table in bad])
+
+    def test_scans(self):
+        self.assertEqual(indexes.scans([
+            'SCAN TABLE character', 'SEARCH skill USING INDEX x (name=?)',
+            'SCAN effect']), ['character', 'effect'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+'''Tests for journal: recovering a session after a crash'''
+import os
+import shutil
+import tempfile
+import unittest
+
+from battle_tracker import BattleCmd, Session
+
+
+class RecoverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_commands(self, bt, *lines):
+        for line in lines:
+            bt.postcmd(bt.onecmd(line), line)
+
+    def test_dice_streams_survive_a_crash(self):
+        live = BattleCmd(journal_path=self.path)
+        live.start_session(Session('Session 1', seed=4))
+        self.run_commands(live, 'players add Aria 2 30', 'roll 3d6 4')
+        live.session.encounter.add_monsters(3, 'Goblin', 1, 20)
+        self.run_commands(live, 'area +6 ref 2d6 all',
+                          'affect "Goblin B" dazed', 'next', 'next', 'next',
+                          'roll')
+        recovered = BattleCmd(journal_path=self.path)
+        self.assertEqual(recovered.session.rng.random(),
+                         live.session.rng.random())
+        self.assertEqual(recovered.session.encounter.rng.random(),
+                         live.session.encounter.rng.random())
+
+    def test_clean_exit_leaves_nothing_to_recover(self):
+        bt = BattleCmd(journal_path=self.path)
+        self.run_commands(bt, 'players add Aria 2 30', 'EOF')
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(BattleCmd(journal_path=self.path).players, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
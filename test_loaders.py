@@ -0,0 +1,107 @@
+'''Tests for loaders: loading play sessions in a fixed number of queries'''
+import unittest
+
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+
+import loaders
+import models as M
+from create_db import setup_db
+
+HEROES = ['Hero {}'.format(k) for k in xrange(4)]
+GOBLINS = 6
+
+
+def fill(db, encounters):
+    '''A session of `encounters` encounters, each with the four heroes and
+    six goblins of its own in initiative'''
+    db.execute(M.Session.__table__.insert(), [{'name': 'Session'}])
+    db.execute(M.Character.__table__.insert(), [
+        {'name': name, 'is_player': True} for name in HEROES])
+    for i in xrange(encounters):
+        name = 'Encounter {}'.format(i)
+        goblins = ['Goblin {}-{}'.format(i, k) for k in xrange(GOBLINS)]
+        db.execute(M.Encounter.__table__.insert(), [
+            {'name': name, 'sessionname': 'Session'}])
+        db.execute(M.Character.__table__.insert(), [
+            {'name': goblin, 'is_player': False} for goblin in goblins])
+        db.execute(M.CharacterEncounter.__table__.insert(), [
+            {'charactername': character, 'encounter_id': name,
+             'init_score': 20 - j, 'position': j}
+            for j, character in enumerate(HEROES + goblins)])
+    db.commit()
+
+
+def walk(session):
+    '''Touches everything load_session loads at full depth'''
+    return sum(len(enc.players) + len(enc.monsters) +
+               sum(1 for entry in enc.init_order if entry.character)
+               for enc in session.encounters)
+
+
+class LoadSessionTest(unittest.TestCase):
+
+    SIZES = (1, 10, 100)
+    QUERIES = {loaders.SESSION: 1, loaders.ENCOUNTERS: 2,
+               loaders.INITIATIVE: 3, loaders.CHARACTERS: 5}
+
+    def setUp(self):
+        self.dbs = {}
+        for size in self.SIZES:
+            db = sessionmaker(bind=setup_db(':memory:'))()
+            fill(db, size)
+            self.dbs[size] = db
+
+    def tearDown(self):
+        for db in self.dbs.values():
+            db.close()
+
+    def count(self, db, func):
+        '''How many statements func() runs, and what it returned'''
+        statements = []
+
+        def record(*args):
+            statements.append(args[2])
+        event.listen(db.bind, 'before_cursor_execute', record)
+        try:
+            result = func()
+        finally:
+            event.remove(db.bind, 'before_cursor_execute', record)
+        return len(statements), result
+
+    def test_query_count_per_depth(self):
+        for depth, expected in sorted(self.QUERIES.items()):
+            for size, db in sorted(self.dbs.items()):
+                db.expunge_all()
+                queries, session = self.count(
+                    db, lambda: loaders.load_session(db, 'Session', depth))
+                self.assertEqual(queries, expected,
+                                 'depth {}, {} encounters'.format(depth, size))
+                self.assertEqual(session.name, 'Session')
+
+    def test_full_depth_needs_no_more_queries(self):
+        for size, db in sorted(self.dbs.items()):
+            db.expunge_all()
+            session = loaders.load_session(db, 'Session')
+            queries, loaded = self.count(db, lambda: walk(session))
+            self.assertEqual(queries, 0, '{} encounters'.format(size))
+            self.assertEqual(loaded, size * (len(HEROES) + GOBLINS) * 2)
+
+    def test_lazy_loading_grows(self):
+        db = self.dbs[10]
+        db.expunge_all()
+        queries, _ = self.count(
+            db, lambda: walk(db.query(M.Session).get('Session')))
+        self.assertGreater(queries, self.QUERIES[loaders.CHARACTERS])
+
+    def test_load_sessions(self):
+        db = self.dbs[10]
+        db.expunge_all()
+        queries, sessions = self.count(db, lambda: loaders.load_sessions(db))
+        self.assertEqual(queries, self.QUERIES[loaders.CHARACTERS])
+        self.assertEqual([s.name for s in sessions], ['Session'])
+        self.assertIsNone(loaders.load_session(db, 'Nowhere'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+'''Tests for persistence: writing tracker sessions to the models database'''
+import os
+import shutil
+import tempfile
+import unittest
+
+from sqlalchemy import select
+
+import models as M
+from battle_tracker import Session
+from create_db import setup_db
+from dm_common import PlayerCharacter
+from persistence import (BackgroundWriter, DatabaseWriter, coalesce,
+                         _clear_initiative, _insert_initiative)
+
+
+class DatabaseWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = setup_db(':memory:')
+        self.session = Session('Session 1', seed=1)
+        self.session.add_player(PlayerCharacter('Aria', 2, 30))
+        self.session.add_encounter('Ambush')
+        self.writer = DatabaseWriter(self.engine, self.session)
+        self.writer.flush()
+
+    def names(self, table):
+        return sorted(name for name, in self.engine.execute(
+            select([table.c.name])))
+
+    def test_new_encounter_is_written(self):
+        self.session.add_encounter('Bridge')
+        self.writer.flush()
+        self.assertEqual(self.names(M.Encounter.__table__),
+                         ['Ambush', 'Bridge'])
+
+    def test_renamed_session_is_written(self):
+        self.session.rename('Session 2')
+        self.session.add_encounter('Bridge')
+        self.writer.flush()
+        self.assertIn('Session 2', self.names(M.Session.__table__))
+        rows = self.engine.execute(select([
+            M.Encounter.__table__.c.sessionname]).where(
+            M.Encounter.__table__.c.name == 'Bridge')).fetchall()
+        self.assertEqual(rows, [('Session 2',)])
+
+    def test_initiative_of_new_encounter(self):
+        encounter = self.session.add_encounter('Bridge')
+        encounter.add_monsters(2, 'Goblin', 1, 20)
+        self.writer.flush()
+        table = M.CharacterEncounter.__table__
+        rows = self.engine.execute(select([table.c.charactername]).where(
+            table.c.encounter_id == 'Bridge')).fetchall()
+        self.assertEqual(len(rows), 3)
+
+    def test_monsters_named_per_encounter(self):
+        for name in ('Cave', 'Bridge'):
+            encounter = self.session.add_encounter(name)
+            encounter.add_monsters(1, 'Goblin', 1, 20)
+            encounter.monsters[0].damage(5 if name == 'Bridge' else 0)
+        self.writer.flush()
+        table = M.Character.__table__
+        rows = self.engine.execute(
+            select([table.c.name, table.c.current_hp]).where(
+                table.c.is_player == False)).fetchall()
+        self.assertEqual(sorted(rows), [('Session 1/Bridge/Goblin#0', 15),
+                                        ('Session 1/Cave/Goblin#0', 20)])
+
+    def test_existing_row_becomes_player(self):
+        character = M.Character.__table__
+        self.engine.execute(character.insert(), name='Brom', is_player=False)
+        self.session.add_player(PlayerCharacter('Brom', 1, 25,
+                                                playername='Sam'))
+        self.writer.flush()
+        row = self.engine.execute(
+            select([character.c.is_player, character.c.playername]).where(
+                character.c.name == 'Brom')).fetchone()
+        self.assertEqual(tuple(row), (True, 'Sam'))
+
+
+class CoalesceTest(unittest.TestCase):
+
+    def test_cleared_initiative_drops_earlier_rows(self):
+        row = {'charactername': 'Aria', 'encounter_id': 'Ambush',
+               'init_score': 12, 'position': 0}
+        first = [(_clear_initiative, [{'b_encounter': 'Ambush'}]),
+                 (_insert_initiative, [row])]
+        second = [(_clear_initiative, [{'b_encounter': 'Ambush'}])]
+        self.assertEqual(coalesce([first, second]), second)
+        self.assertEqual(coalesce([second, first]), first)
+
+    def test_later_rows_replace_earlier(self):
+        rows = [{'charactername': name, 'encounter_id': 'Ambush',
+                 'init_score': 10, 'position': 0} for name in 'AB']
+        batches = [[(_clear_initiative, [{'b_encounter': 'Ambush'}]),
+                    (_insert_initiative, [row])] for row in rows]
+        self.assertEqual(coalesce(batches)[1], (_insert_initiative, rows[1:]))
+
+
+
+class BackgroundWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        # the thread needs to see the same database, so not :memory:
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_metrics_and_close(self):
+        engine = setup_db(os.path.join(self.directory, 'test.db'))
+        session = Session('Session 1', seed=1)
+        session.add_player(PlayerCharacter('Aria', 2, 30))
+        writer = BackgroundWriter(engine, session)
+        for name in ('Ambush', 'Bridge', 'Cave'):
+            session.add_encounter(name)
+            writer.sync()
+        stats = writer.metrics()
+        self.assertEqual(stats['transactions'], 3)
+        self.assertLessEqual(stats['mean_flush_seconds'],
+                             stats['max_flush_seconds'])
+        writer.close()
+        writer.close()
+        self.assertFalse(writer.thread.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()